@@ -5,6 +5,7 @@ import swap.agents.ledger as ledger
 from swap.utils.stats import Stat
 
 import abc
+import copy
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,6 +43,14 @@ class Agent(metaclass=abc.ABCMeta):
     def classify(self, cl):
         pass
 
+    def copy(self):
+        """
+            Copy of this agent with its own copy of the ledger
+        """
+        agent = copy.copy(self)
+        agent.ledger = self.ledger.copy()
+        return agent
+
     @staticmethod
     def stats(bureau):
         """
@@ -4,6 +4,13 @@
 
 from swap.agents.agent import Agent
 from swap.utils import Singleton
+from swap.utils.codes import Codes
+from swap.agents.index import ScoreIndex
+from swap.agents.traces import UserTraces
+
+import numpy as np
+import copy
+import heapq
 
 
 class Bureau:
@@ -13,9 +20,16 @@ class Bureau:
     ----------
         agent_type: str
             Informative string to indicate agent types in that specific bureau
+        index: bool
+            Keep the agents ordered by score, for agents with a
+            single number as score. See range, top_k, bottom_k
+            and nearest
+        traces: bool
+            Record the confusion matrix counts of user agents after
+            each transaction that changes them, see UserTraces
     """
 
-    def __init__(self, agent_type):
+    def __init__(self, agent_type, index=False, traces=False):
         # type of agents, just a string? (e.g. users, subjects, machines,...)
         # maybe not required because we could look at the agents' subclass
 
@@ -24,6 +38,33 @@ class Bureau:
         self.agent_type = agent_type
         # dictionary to store all agents, key is agent-ID
         self._agents = dict()
+        # dense integer code of every agent id ever added, and
+        # the agents indexed by code
+        self.codes = Codes()
+        self._by_code = []
+        # agent codes ordered by score, and the ids of agents whose
+        # score changed since the index was last brought up to date
+        self.index = ScoreIndex() if index else None
+        self._unindexed = set()
+        # confusion matrix history of the agents, or None
+        self.traces = UserTraces() if traces else None
+
+        # ids of agents whose ledger needs to be recalculated
+        self._stale = set()
+        # ids of agents whose score changed since they last
+        # notified their connected agents
+        self._changed = set()
+        # ids of agents whose score changed by too little to
+        # notify their connected agents
+        self._skipped = set()
+        # ids of stale agents whose recalculation was put off until
+        # their score is read, see process_priority
+        self._deferred = set()
+
+        # After a fork, agents are shared with the other bureau until
+        # they are copied. ids of the agents this bureau has its own
+        # copy of, or None if nothing is shared
+        self._owned = None
 
     def add(self, agent, override=True):
         """
@@ -45,6 +86,36 @@ class Bureau:
         else:
             self._agents[agent.id] = agent
 
+        code = self.codes.code(agent.id)
+        if code == len(self._by_code):
+            self._by_code.append(agent)
+        else:
+            self._by_code[code] = agent
+
+        if self.index is not None:
+            self._unindexed.add(agent.id)
+
+        agent.ledger.bureau = self
+        if agent.ledger.stale:
+            self._stale.add(agent.id)
+        if agent.ledger.deferred:
+            self._deferred.add(agent.id)
+        if self._owned is not None:
+            self._owned.add(agent.id)
+
+    def reserve(self, ids):
+        """
+            Give codes to agent ids without adding the agents, for
+            example the ids of removed agents when restoring a bureau
+
+            Parameter:
+            ----------
+                ids: agent ids, in the order they get their codes
+        """
+        for id_ in ids:
+            self.codes.code(id_)
+        self._by_code.extend([None] * (len(self.codes) - len(self._by_code)))
+
     def get(self, agent_id, make_new=True):
         """ Get agent from bureau
 
@@ -57,7 +128,10 @@ class Bureau:
             agent
         """
         if agent_id in self._agents:
-            return self._agents[agent_id]
+            agent = self._agents[agent_id]
+            if self._owned is not None and agent_id not in self._owned:
+                agent = self._own(agent)
+            return agent
         elif make_new:
             agent = self.agent_type(agent_id)
             self.add(agent)
@@ -65,6 +139,102 @@ class Bureau:
         else:
             return None
 
+    def peek(self, agent_id):
+        """ Get agent from bureau without copying it
+
+        Parameter:
+        ----------
+            agent_id: id of agent
+
+        Returns:
+        --------
+            agent, or None if it is not in the bureau. The agent may be
+            shared with a fork of this bureau and must not be changed
+        """
+        return self._agents.get(agent_id)
+
+    def fork(self):
+        """
+        Copy of this bureau that shares its agents with this one.
+
+        Agents are copied the first time either bureau gets them with
+        get or get_code, so only agents that change are copied.
+        Iterating and peek still return shared agents.
+
+        Forking is still O(N) in the number of agents: the id and code
+        tables, the score index and the bookkeeping sets are copied,
+        which takes about 30ms for 200,000 agents. Only the agents
+        themselves are shared.
+
+        Returns:
+        --------
+            Bureau
+        """
+        child = copy.copy(self)
+        child._agents = dict(self._agents)
+        child._by_code = list(self._by_code)
+        child.codes = self.codes.copy()
+        if self.index is not None:
+            child.index = self.index.copy()
+        child._unindexed = set(self._unindexed)
+        if self.traces is not None:
+            child.traces = self.traces.copy()
+
+        child._stale = set(self._stale)
+        child._changed = set(self._changed)
+        child._skipped = set(self._skipped)
+        child._deferred = set(self._deferred)
+
+        # Neither bureau owns any agent any more
+        child._owned = set()
+        self._owned = set()
+
+        return child
+
+    def _own(self, agent):
+        """
+        Replace a shared agent with this bureau's own copy
+        """
+        agent = agent.copy()
+        agent.ledger.bureau = self
+        agent.ledger.deferred = agent.id in self._deferred
+
+        self._agents[agent.id] = agent
+        self._by_code[self.codes.get(agent.id)] = agent
+        self._owned.add(agent.id)
+
+        return agent
+
+    def merge(self, bureaus, ids):
+        """
+        Add the agents of other bureaus, with their pending changes
+
+        Parameter:
+        ----------
+            bureaus: bureaus of the same agent type that share no
+                agents with each other or this one
+            ids: ids of every agent of those bureaus, in the order
+                they get their codes here
+        """
+        agents = {}
+        for bureau in bureaus:
+            agents.update(bureau._agents)
+
+            self._changed |= bureau._changed
+            self._skipped |= bureau._skipped
+            self._deferred |= bureau._deferred
+
+        for id_ in ids:
+            self.add(agents[id_])
+
+        if self.traces is not None:
+            for bureau in bureaus:
+                if bureau.traces is not None:
+                    codes = np.array(
+                        [self.codes.get(id_) for id_ in bureau.codes],
+                        dtype=np.int32)
+                    self.traces.extend(bureau.traces, codes)
+
     def remove(self, agent_id):
         """ Remove agent from bureau
 
@@ -72,7 +242,107 @@ class Bureau:
         ----------
             agent_id: id of agent
         """
-        del self._agents[agent_id]
+        agent = self._agents.pop(agent_id)
+        agent.ledger.bureau = None
+        # The code stays assigned to this id
+        self._by_code[self.codes.get(agent_id)] = None
+        if self.index is not None:
+            self.index.discard(self.codes.get(agent_id))
+            self._unindexed.discard(agent_id)
+        if self._owned is not None:
+            self._owned.discard(agent_id)
+
+        self._stale.discard(agent_id)
+        self._changed.discard(agent_id)
+        self._skipped.discard(agent_id)
+        self._deferred.discard(agent_id)
+
+    def code(self, agent_id):
+        """ Get the dense integer code of an agent
+
+        Parameter:
+        ----------
+            agent_id: id of agent
+
+        Returns:
+        --------
+            int, or None if the agent was never added
+        """
+        return self.codes.get(agent_id)
+
+    def get_code(self, code):
+        """ Get agent from bureau by its code
+
+        Parameter:
+        ----------
+            code: dense integer code of agent
+
+        Returns:
+        --------
+            agent, or None if the agent was removed
+        """
+        agent = self._by_code[code]
+        if agent is not None and self._owned is not None:
+            agent = self.get(agent.id)
+        return agent
+
+    def score_changed(self, agent_id):
+        """
+        Record that an agent's score changed, so the score index
+        updates it before the next query
+        """
+        if self.index is not None:
+            self._unindexed.add(agent_id)
+
+    def _update_index(self):
+        """
+        Bring the score index up to date with every changed score
+        """
+        for id_ in self._unindexed:
+            code = self.codes.get(id_)
+            score = self._agents[id_].ledger._score
+            if score is None:
+                self.index.discard(code)
+            else:
+                self.index.update(code, score)
+
+        self._unindexed = set()
+
+    def range(self, lo, hi):
+        """ Ids of agents with a score between lo and hi
+
+        Scores are the last calculated ones, and don't include stale
+        changes. Needs the score index.
+
+        Returns:
+        --------
+            list of agent ids, lowest score first
+        """
+        self._update_index()
+        return self._ids(self.index.range(lo, hi))
+
+    def top_k(self, k):
+        """ Ids of the k agents with the highest scores, highest first
+        """
+        self._update_index()
+        return self._ids(self.index.top_k(k))
+
+    def bottom_k(self, k):
+        """ Ids of the k agents with the lowest scores, lowest first
+        """
+        self._update_index()
+        return self._ids(self.index.bottom_k(k))
+
+    def nearest(self, p, k=1):
+        """ Ids of the k agents with the scores nearest to p, nearest
+        first. For example nearest(.5, k) finds the k most uncertain
+        subjects
+        """
+        self._update_index()
+        return self._ids(self.index.nearest(p, k))
+
+    def _ids(self, codes):
+        return [self.codes.id(code) for code in codes]
 
     def has(self, agent_id):
         """ Check if agent is in bureau
@@ -87,19 +357,144 @@ class Bureau:
         """
         return agent_id in self._agents
 
+    def mark_stale(self, agent_id):
+        """
+        Record that an agent's ledger needs to be recalculated
+        """
+        self._stale.add(agent_id)
+
+    def clear_stale(self, agent_id):
+        self._stale.discard(agent_id)
+        self._deferred.discard(agent_id)
+
+    def stale_ids(self):
+        """
+        List of ids of agents whose ledger needs to be recalculated
+        """
+        return list(self._stale)
+
+    def mark_changed(self, agent_id):
+        """
+        Record that an agent's score changed and its connected
+        agents need to be notified
+        """
+        self._changed.add(agent_id)
+
+    def mark_skipped(self, agent_id):
+        """
+        Record that an agent's score changed, but by less than
+        config.notify_tol, so its connected agents were not notified
+        """
+        self._skipped.add(agent_id)
+
+    def clear_skipped(self, agent_id):
+        self._skipped.discard(agent_id)
+
+    def skipped_ids(self):
+        """
+        List of ids of agents holding back a score change
+        """
+        return list(self._skipped)
+
+    def skipped_error(self):
+        """
+        Largest score change held back from connected agents
+        """
+        return max((self._agents[id_].ledger.skipped
+                    for id_ in self._skipped), default=0.)
+
     def process_changes(self, bar=None):
-        for agent in self:
-            if bar is not None and agent.ledger.stale:
+        """
+        Recalculate the ledger of every stale agent
+        """
+        for id_ in list(self._stale):
+            if bar is not None:
+                bar.update(bar.value + 1)
+
+            self.get(id_).ledger.recalculate()
+
+    def process_priority(self, priority, margin=None, budget=None,
+                         bar=None, ids=None):
+        """
+        Recalculate stale agents in order of priority, and defer the
+        rest until their score is read
+
+        Parameter:
+        ----------
+            priority: function of an agent giving its priority,
+                lowest first
+            margin: (optional) defer agents with a priority
+                above margin
+            budget: (optional) recalculate at most this many agents
+            bar: (optional) progress bar, updated once per agent
+            ids: (optional) ids of the agents to consider, default
+                every stale agent
+
+        Returns:
+        --------
+            int, number of agents deferred
+        """
+        if ids is None:
+            ids = self._stale
+
+        # Ids aren't always comparable, the counter breaks ties
+        heap = [(priority(self._agents[id_]), i, id_)
+                for i, id_ in enumerate(ids)]
+        heapq.heapify(heap)
+
+        count = 0
+        while len(heap) > 0:
+            if budget is not None and count >= budget:
+                break
+            if margin is not None and heap[0][0] > margin:
+                break
+
+            _, _, id_ = heapq.heappop(heap)
+            self.get(id_).ledger.recalculate()
+            count += 1
+
+            if bar is not None:
                 bar.update(bar.value + 1)
 
-            agent.ledger.recalculate()
+        # Agents shared with a fork are not copied just to flag them,
+        # _own flags them if they are copied later
+        for _, _, id_ in heap:
+            if self._owned is None or id_ in self._owned:
+                self._agents[id_].ledger.deferred = True
+            self._deferred.add(id_)
+
+        return len(heap)
+
+    def deferred_ids(self):
+        """
+        List of ids of stale agents deferred by process_priority
+        """
+        return list(self._deferred)
+
+    def notify_changes(self, other_bureau, neighbours=None):
+        """
+        Every agent whose score changed notifies its connected agents
+
+        Parameter:
+        ----------
+            other_bureau: bureau of the connected agents
+            neighbours: (optional) function mapping an agent's code to
+                the codes of its connected agents in other_bureau,
+                for example Graph.subjects_of
+        """
+        changed = self._changed
+        self._changed = set()
 
-    def notify_changes(self, other_bureau):
-        for agent in self:
-            agent.ledger.notify_agents(self, other_bureau)
+        for id_ in changed:
+            ledger = self.get(id_).ledger
+            if neighbours is None:
+                ledger.notify_agents(self, other_bureau)
+            else:
+                codes = neighbours(self.code(id_))
+                ledger.notify_agents(self, other_bureau, codes)
 
     def calculate_changes(self):
-        return len([1 for i in self if i.ledger.stale])
+        return len(self._stale)
 
     # ----------------------------------------------------------------
 
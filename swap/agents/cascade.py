@@ -0,0 +1,127 @@
+################################################################
+# Instrumentation of the back_update cascade
+
+"""
+    Records what one SWAP.process_changes did, phase by phase: how many
+    agents each changed agent notified, how many transactions each
+    subject recalculation committed, and how far back in the subject's
+    history the change reached.
+
+    Ledgers record into the phase in current while a Report is
+    recording, see Report.phase. Outside of a report current is None
+    and nothing is recorded.
+"""
+
+from collections import Counter
+import contextlib
+import time
+
+# Phase being recorded, None when not instrumenting
+current = None
+
+
+class Phase:
+    """
+    Counts and wall time of one phase of process_changes
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.
+
+        # Number of notify calls, one per agent notified
+        self.notified = 0
+        # Histograms, {value: count}:
+        # agents notified by each changed agent
+        self.fanout = Counter()
+        # changed transactions committed by each recalculated subject
+        self.recomputed = Counter()
+        # transactions from the earliest change to the end of each
+        # recalculated subject's history
+        self.depth = Counter()
+
+    def record_fanout(self, n):
+        self.fanout[n] += 1
+
+    def record_recalculate(self, changed, depth):
+        self.recomputed[changed] += 1
+        self.depth[depth] += 1
+
+    def dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'notified': self.notified,
+            'fanout': dict(self.fanout),
+            'recomputed': dict(self.recomputed),
+            'depth': dict(self.depth)}
+
+    def __str__(self):
+        s = '%-20s %8.3fs notified %d\n' % \
+            (self.name, self.seconds, self.notified)
+        for name in ['fanout', 'recomputed', 'depth']:
+            histogram = getattr(self, name)
+            if len(histogram) > 0:
+                s += '    %-10s %s\n' % (name, _bins(histogram))
+        return s
+
+
+class Report:
+    """
+    Cascade report of one process_changes
+    """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Record everything in this context as a new phase
+        """
+        global current
+
+        phase = Phase(name)
+        self.phases.append(phase)
+
+        current = phase
+        start = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds = time.perf_counter() - start
+            current = None
+
+    @property
+    def seconds(self):
+        return sum(phase.seconds for phase in self.phases)
+
+    def dict(self):
+        return {
+            'seconds': self.seconds,
+            'phases': [phase.dict() for phase in self.phases]}
+
+    def __str__(self):
+        s = 'cascade %.3fs\n' % self.seconds
+        for phase in self.phases:
+            s += str(phase)
+        return s
+
+
+def _bins(histogram):
+    """
+    Histogram summarized in power of two bins, 'lo-hi:count'
+    """
+    bins = Counter()
+    for value, count in histogram.items():
+        bins[max(value, 0).bit_length()] += count
+
+    s = []
+    for bit in sorted(bins):
+        lo = 0 if bit == 0 else 1 << (bit - 1)
+        hi = (1 << bit) - 1
+        if lo == hi:
+            s.append('%d:%d' % (lo, bins[bit]))
+        else:
+            s.append('%d-%d:%d' % (lo, hi, bins[bit]))
+    return ' '.join(s)
@@ -0,0 +1,431 @@
+################################################################
+# Bipartite user-subject classification graph
+
+"""
+    Every classification is an edge between a user and a subject.
+    Edges are stored as parallel arrays indexed by edge number, in the
+    order they were added. Users and subjects are referred to by their
+    bureau codes (see Bureau.code).
+
+    Two indices sort the edge numbers by user and by subject, with
+    compressed row pointers, so all the edges of an agent are one
+    contiguous slice of the index, and one more of its delta. Edges
+    added since the index was built go in the small delta index, which
+    is merged into the index once it grows, see Index.
+
+    Removed edges are marked dead and left out of the slices until
+    enough of them pile up to compact the arrays, see Graph.remove.
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import copy
+import math
+
+# Columns of every edge
+_COLUMNS = ['_user', '_subject', '_annotation']
+
+
+class Graph:
+    """
+    User-subject graph of classifications
+    """
+
+    def __init__(self, capacity=1024):
+        self._n = 0
+
+        self._user = np.zeros(capacity, dtype=np.int32)
+        self._subject = np.zeros(capacity, dtype=np.int32)
+        self._annotation = np.zeros(capacity, dtype=np.int8)
+
+        self._by_user = Index()
+        self._by_subject = Index()
+
+        # Removed edges, see remove. None until an edge is removed
+        self._dead = None
+        self._removed = 0
+        # Dead marks are shared with another graph and have to be
+        # copied before marking more
+        self._dead_shared = False
+
+        # Edge arrays are shared with another graph and have to be
+        # copied before writing
+        self._shared = False
+
+    def add(self, user, subject, annotation):
+        """
+        Add one classification edge. The order of the transaction and
+        the user score the subject was given change as the ledgers
+        are updated, and are read from the subject's ledger
+
+        Parameters
+        ----------
+        user : int
+            user code
+        subject : int
+            subject code
+        annotation : int
+
+        Returns
+        -------
+        int
+            edge number
+        """
+        n = self._n
+        self._reserve(n + 1)
+
+        self._user[n] = user
+        self._subject[n] = subject
+        self._annotation[n] = annotation
+
+        self._n = n + 1
+        return n
+
+    def extend(self, users, subjects, annotations):
+        """
+        Add many classification edges at once, see Graph.add
+        """
+        n = self._n
+        m = n + len(users)
+        self._reserve(m)
+
+        self._user[n:m] = users
+        self._subject[n:m] = subjects
+        self._annotation[n:m] = annotations
+
+        self._n = m
+
+    @property
+    def users(self):
+        """
+        User code of each edge
+        """
+        return self._column('_user')
+
+    @property
+    def subjects(self):
+        """
+        Subject code of each edge
+        """
+        return self._column('_subject')
+
+    @property
+    def annotations(self):
+        return self._column('_annotation')
+
+    def _column(self, name):
+        column = getattr(self, name)[:self._n]
+        if self._removed > 0:
+            column = column[~self._dead[:self._n]]
+        return column
+
+    def remove(self, user, subjects):
+        """
+        Remove the edges between a user and some subjects
+
+        The edges are marked dead. Once half the edges are dead the
+        arrays are compacted, which renumbers the edges after them.
+
+        Parameters
+        ----------
+        user : int
+            user code
+        subjects : array_like
+            subject codes
+        """
+        edges = self.user_edges(user)
+        edges = edges[np.isin(self._subject[edges], subjects)]
+        if len(edges) == 0:
+            return
+
+        if self._dead is None:
+            self._dead = np.zeros(len(self._user), dtype=bool)
+        elif self._dead_shared:
+            self._dead = self._dead.copy()
+            self._dead_shared = False
+        self._dead[edges] = True
+        self._removed += len(edges)
+
+        if self._removed * 2 >= self._n:
+            self._compact()
+
+    def _compact(self):
+        """
+        Drop the dead edges from the arrays and indices, renumbering
+        the edges
+        """
+        n = self._n
+        keep = ~self._dead[:n]
+        m = int(np.count_nonzero(keep))
+        number = np.cumsum(keep) - 1
+
+        self._by_user.compact(self._user, keep, number, m)
+        self._by_subject.compact(self._subject, keep, number, m)
+
+        # Write to new arrays, which also ends any sharing with a fork
+        for name in _COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros_like(old)
+            new[:m] = old[:n][keep]
+            setattr(self, name, new)
+
+        self._n = m
+        self._dead = None
+        self._removed = 0
+        self._shared = False
+
+    def user_edges(self, user):
+        """
+        Edge numbers of every classification by a user, in the
+        order they were added
+        """
+        index = self._by_user.update(self._user, self._n)
+        return self._alive(index.slice(user))
+
+    def subject_edges(self, subject):
+        """
+        Edge numbers of every classification of a subject, in the
+        order they were added
+        """
+        index = self._by_subject.update(self._subject, self._n)
+        return self._alive(index.slice(subject))
+
+    def _alive(self, edges):
+        if self._removed > 0:
+            edges = edges[~self._dead[edges]]
+        return edges
+
+    def subjects_of(self, user):
+        """
+        Codes of the subjects a user classified
+        """
+        return self._subject[self.user_edges(user)]
+
+    def users_of(self, subject):
+        """
+        Codes of the users that classified a subject
+        """
+        return self._user[self.subject_edges(subject)]
+
+    def components(self, n_users=None, n_subjects=None):
+        """
+        Connected components of the graph, see components
+        """
+        return components(self.users, self.subjects, n_users, n_subjects)
+
+    # ----------------------------------------------------------------
+
+    def fork(self):
+        """
+        Copy of this graph that shares the edge arrays until
+        edges are added to it
+        """
+        child = copy.copy(self)
+        child._by_user = copy.copy(self._by_user)
+        child._by_subject = copy.copy(self._by_subject)
+        child._shared = True
+        # Unlike new edges, dead marks are written in place by both
+        child._dead_shared = self._dead_shared = self._dead is not None
+        return child
+
+    def _reserve(self, n):
+        """
+        Make room for at least n edges, doubling the capacity
+        """
+        capacity = len(self._user)
+        if n <= capacity and not self._shared:
+            return
+
+        # Existing edges never change, and the graph this one was
+        # forked from only writes beyond them, so a shared graph
+        # copies before its first write
+        self._shared = False
+        if n > capacity:
+            capacity = max(n, capacity * 2)
+        for name in _COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            setattr(self, name, new)
+
+        if self._dead is not None:
+            dead = np.zeros(capacity, dtype=bool)
+            dead[:self._n] = self._dead[:self._n]
+            self._dead = dead
+            self._dead_shared = False
+
+    def __len__(self):
+        return self._n - self._removed
+
+
+class Index:
+    """
+    Edge numbers sorted by row, a user or subject code, with
+    compressed row pointers.
+
+    Edges are added at the end of the graph. The ones added since
+    the index was last merged are kept in a delta index of their own,
+    rebuilt when it is read. The delta is merged into the index once
+    it has more edges than the square root of the index, so a merge
+    only moves edges in place, without sorting the index again.
+    """
+
+    # Deltas up to this size are never merged
+    MIN_DELTA = 4096
+
+    def __init__(self):
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.edges = np.zeros(0, dtype=np.int64)
+        # Number of edges in the index, and in the index and delta
+        self.built = 0
+        self.delta = None
+        self.delta_built = 0
+
+    def update(self, rows, n):
+        """
+        Bring the index up to date with the first n edges
+
+        Parameters
+        ----------
+        rows : np.ndarray
+            row of every edge
+        n : int
+            number of edges
+        """
+        if n == self.delta_built:
+            return self
+
+        added = n - self.built
+        if added > max(self.MIN_DELTA, math.sqrt(self.built)):
+            self._merge(rows, n)
+        else:
+            self.delta = _sort(rows[self.built:n], self.built)
+        self.delta_built = n
+        return self
+
+    def slice(self, row):
+        """
+        Edge numbers of a row, in the order they were added
+        """
+        edges = _slice(self.indptr, self.edges, row)
+        if self.delta is not None:
+            delta = _slice(*self.delta, row)
+            if len(delta) > 0:
+                edges = np.concatenate([edges, delta])
+        return edges
+
+    def _merge(self, rows, n):
+        """
+        Merge the edges from built to n into the index. Every row
+        keeps its edges first, followed by its new edges
+        """
+        new_indptr, new_edges = _sort(rows[self.built:n], self.built)
+        length = max(len(self.indptr), len(new_indptr)) - 1
+        old_start = _pad(self.indptr[:-1], length)
+        new_start = _pad(new_indptr[:-1], length)
+        old = _pad(np.diff(self.indptr), length)
+        new = _pad(np.diff(new_indptr), length)
+
+        indptr = np.zeros(length + 1, dtype=np.int64)
+        np.cumsum(old + new, out=indptr[1:])
+
+        # Edges of a row in the index move down by the new edges of
+        # the rows before it, the new edges go after them
+        edges = np.empty(n, dtype=np.int64)
+        shift = np.repeat(indptr[:-1] - old_start, old)
+        edges[np.arange(self.built) + shift] = self.edges
+        shift = np.repeat(indptr[:-1] + old - new_start, new)
+        edges[np.arange(len(new_edges)) + shift] = new_edges
+
+        self.indptr = indptr
+        self.edges = edges
+        self.built = n
+        self.delta = None
+
+    def compact(self, rows, keep, number, n):
+        """
+        Drop the edges not kept, giving the others their new numbers
+        """
+        if self.built < len(keep):
+            self._merge(rows, len(keep))
+
+        edges = self.edges[keep[self.edges]]
+        counts = np.bincount(rows[edges], minlength=len(self.indptr) - 1)
+        self.indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.edges = number[edges]
+        self.built = self.delta_built = n
+
+
+def _sort(rows, first=0):
+    """
+    Compressed row pointers and edge numbers sorted by row, for the
+    edges numbered from first
+    """
+    counts = np.bincount(rows)
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    edges = np.argsort(rows, kind='stable') + first
+    return indptr, edges
+
+
+def _pad(array, length):
+    """
+    Array padded with zeros to a length
+    """
+    padded = np.zeros(length, dtype=np.int64)
+    padded[:len(array)] = array
+    return padded
+
+
+def _slice(indptr, edges, row):
+    if row >= len(indptr) - 1:
+        return edges[:0]
+    return edges[indptr[row]:indptr[row + 1]]
+
+
+def components(users, subjects, n_users=None, n_subjects=None):
+    """
+    Connected components of a user-subject graph. Agents in different
+    components share no classifications, so their scores never affect
+    each other.
+
+    Parameters
+    ----------
+    users : array_like
+        user code of each edge
+    subjects : array_like
+        subject code of each edge
+    n_users : int
+        number of user codes, default one more than the largest code.
+        Users without edges are components of their own
+    n_subjects : int
+        number of subject codes, see n_users
+
+    Returns
+    -------
+    (int, np.ndarray, np.ndarray)
+        number of components, and the component label of every
+        user code and every subject code
+    """
+    users = np.asarray(users, dtype=np.int64)
+    subjects = np.asarray(subjects, dtype=np.int64)
+
+    if n_users is None:
+        n_users = int(users.max()) + 1 if len(users) > 0 else 0
+    if n_subjects is None:
+        n_subjects = int(subjects.max()) + 1 if len(subjects) > 0 else 0
+
+    # Users and subjects are the nodes of one graph, subjects
+    # numbered after the users
+    n = n_users + n_subjects
+    matrix = scipy.sparse.coo_matrix(
+        (np.ones(len(users), dtype=np.int8), (users, subjects + n_users)),
+        shape=(n, n))
+
+    count, labels = scipy.sparse.csgraph.connected_components(
+        matrix, directed=False)
+
+    return count, labels[:n_users], labels[n_users:]
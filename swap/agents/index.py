@@ -0,0 +1,193 @@
+################################################################
+# Score-ordered index of agents
+
+"""
+    Keeps agent codes sorted by score, for range and top-k queries
+    without sorting every agent.
+
+    Entries are (score, code) pairs kept in a list of short sorted
+    buckets, with the largest entry of each bucket in a separate list.
+    A bisect over the bucket maxima and then within one bucket finds
+    any position, and inserting or removing an entry only shifts the
+    entries of one bucket.
+"""
+
+import bisect
+import itertools
+
+
+class ScoreIndex:
+    """
+    Agent codes ordered by score
+    """
+
+    def __init__(self, load=500):
+        # Buckets are split once they hold twice this many entries
+        self._load = load
+
+        self._buckets = []
+        self._maxes = []
+        # Score each code is indexed by
+        self._scores = {}
+
+    def update(self, code, score):
+        """
+        Index a code by its new score, adding it if it is new
+        """
+        old = self._scores.get(code)
+        if old is not None:
+            if old == score:
+                return
+            self._remove((old, code))
+
+        self._scores[code] = score
+        self._insert((score, code))
+
+    def discard(self, code):
+        """
+        Remove a code from the index, if it is there
+        """
+        score = self._scores.pop(code, None)
+        if score is not None:
+            self._remove((score, code))
+
+    def range(self, lo, hi):
+        """
+        Codes with lo <= score <= hi, lowest score first
+        """
+        i, j = self._locate((lo, -1))
+        codes = []
+        for score, code in self._forward(i, j):
+            if score > hi:
+                break
+            codes.append(code)
+        return codes
+
+    def bottom_k(self, k):
+        """
+        Codes of the k lowest scores, lowest first
+        """
+        entries = itertools.islice(self._forward(0, 0), k)
+        return [code for _, code in entries]
+
+    def top_k(self, k):
+        """
+        Codes of the k highest scores, highest first
+        """
+        i = len(self._buckets) - 1
+        j = len(self._buckets[i]) if i >= 0 else 0
+        entries = itertools.islice(self._backward(i, j), k)
+        return [code for _, code in entries]
+
+    def nearest(self, p, k=1):
+        """
+        Codes of the k scores nearest to p, nearest first
+        """
+        i, j = self._locate((p, -1))
+        above = self._forward(i, j)
+        below = self._backward(i, j)
+
+        a = next(above, None)
+        b = next(below, None)
+        codes = []
+        while len(codes) < k and (a is not None or b is not None):
+            if b is None or (a is not None and a[0] - p <= p - b[0]):
+                codes.append(a[1])
+                a = next(above, None)
+            else:
+                codes.append(b[1])
+                b = next(below, None)
+
+        return codes
+
+    def score(self, code):
+        """
+        Score a code is indexed by, or None
+        """
+        return self._scores.get(code)
+
+    def copy(self):
+        index = ScoreIndex(self._load)
+        index._buckets = [list(bucket) for bucket in self._buckets]
+        index._maxes = list(self._maxes)
+        index._scores = dict(self._scores)
+        return index
+
+    # ----------------------------------------------------------------
+
+    def _locate(self, entry):
+        """
+        Position (bucket, offset) where entry would be inserted
+        """
+        i = bisect.bisect_left(self._maxes, entry)
+        if i == len(self._buckets):
+            if i == 0:
+                return 0, 0
+            return i - 1, len(self._buckets[-1])
+        return i, bisect.bisect_left(self._buckets[i], entry)
+
+    def _insert(self, entry):
+        if len(self._buckets) == 0:
+            self._buckets.append([entry])
+            self._maxes.append(entry)
+            return
+
+        i, j = self._locate(entry)
+        bucket = self._buckets[i]
+        bucket.insert(j, entry)
+        self._maxes[i] = bucket[-1]
+
+        if len(bucket) > 2 * self._load:
+            half = bucket[self._load:]
+            del bucket[self._load:]
+            self._buckets.insert(i + 1, half)
+            self._maxes[i] = bucket[-1]
+            self._maxes.insert(i + 1, half[-1])
+
+    def _remove(self, entry):
+        i, j = self._locate(entry)
+        bucket = self._buckets[i]
+        del bucket[j]
+
+        if len(bucket) == 0:
+            del self._buckets[i]
+            del self._maxes[i]
+        else:
+            self._maxes[i] = bucket[-1]
+
+    def _forward(self, i, j):
+        """
+        Entries from position (i, j) on, in order
+        """
+        buckets = self._buckets
+        while i < len(buckets):
+            bucket = buckets[i]
+            while j < len(bucket):
+                yield bucket[j]
+                j += 1
+            i += 1
+            j = 0
+
+    def _backward(self, i, j):
+        """
+        Entries before position (i, j), in reverse order
+        """
+        buckets = self._buckets
+        if len(buckets) == 0:
+            return
+
+        while i >= 0:
+            bucket = buckets[i]
+            j -= 1
+            while j >= 0:
+                yield bucket[j]
+                j -= 1
+            i -= 1
+            if i >= 0:
+                j = len(buckets[i])
+
+    def __contains__(self, code):
+        return code in self._scores
+
+    def __len__(self):
+        return len(self._scores)
@@ -1,6 +1,11 @@
 ################################################################
 #
 
+import swap.agents.cascade as cascade
+
+from array import array
+from collections.abc import Mapping
+import copy
 import logging
 logger = logging.getLogger(__name__)
 
@@ -18,8 +23,18 @@ class Ledger:
     the memory location of the relevant agent. This ledger is also intended
     for use with online bureaus to reduce memory load, and can dereference
     agents and rebuild reference trees arbitrarily from a bureau
+
+    There is a transaction in a user and a subject ledger for every
+    classification, so the ledger does not keep transaction objects.
+    Every transaction has a row, and every field a column: a typed
+    array with an entry per row, see Field. get, transactions and
+    iteration hand out transactions reading and writing their row.
+    Changes waiting to be committed are kept in changed.
     """
 
+    # Type of the transactions kept in the rows, set below
+    transaction_type = None
+
     # TODO
     # Make sure back_update works properly with this setup!
     # Naiive recalculate vs real recalculate...
@@ -33,56 +48,197 @@ class Ledger:
         """
 
         self.id = id_
-        # unordered dictionary of all transactions in this ledger
-        # the ordering is stored in the transactions, but is not necessary
-        # for most ledger operations; mostly just useful for logging
-        # and debugging
-        self.transactions = {}
+        # ids of the transactions, one per row
+        self._ids = []
+        # row of each transaction id
+        self._rows = {}
+        # a column for each field of the transactions
+        for field in self.transaction_type._columns:
+            setattr(self, field.column, array(field.typecode))
+        # order given to the next transaction. Orders are not reused
+        # when a transaction is removed
+        self._next_order = 0
 
         self.stale = True
+        # Bureau of this ledger's agent, which keeps track of
+        # stale and changed ledgers
         self.bureau = None
-        self.changed = []
+        # ids of changed transactions, in the order they first changed,
+        # and the change waiting to be committed, or None. A transaction
+        # is recorded once however many times it changes
+        self.changed = {}
 
         self._score = None
+        # Recalculation was put off until the score is read,
+        # see Bureau.process_priority
+        self.deferred = False
 
-    def _change(self, id_):
+    def _change(self, id_, change=None):
         """
-        Mark a transaction as having changed
+        Mark a transaction as having changed, with the change to commit.
+        Without a change, a change already waiting is kept
         """
-        self.changed.append(id_)
+        if change is not None or id_ not in self.changed:
+            self.changed[id_] = change
 
     @property
     def score(self):
         """
         Get the current score from the ledger
-        Recalculates the score if this ledger is stale
+        Recalculates the score if its recalculation was deferred
         """
         # if self.stale or self._score is None:
         #     raise StaleException(self)
+        if self.deferred:
+            self.recalculate()
         return self._score
 
+    @property
+    def transactions(self):
+        """
+        Transactions of this ledger by id
+        """
+        return Transactions(self)
+
     def add(self, transaction):
         """
         Add a transaction to the ledger
         """
         id_ = transaction.id
+        change = transaction.change
         # Record the transactions order
-        transaction.order = len(self.transactions)
+        transaction.order = self._next_order
+        self._next_order += 1
 
-        # Store this transaction
-        self.transactions[id_] = transaction
+        # Store this transaction. A transaction with the same id
+        # is replaced in its row
+        row = self._rows.get(id_)
+        if row is None:
+            row = self._place(transaction)
+        self._insert(row, transaction)
 
         # Mark this change
-        self._change(id_)
-        self.stale = True
+        self._change(id_, change)
+        self._mark_stale()
 
         return id_
 
+    def _place(self, transaction):
+        """
+        Row of a new transaction, at the end
+        """
+        return len(self._ids)
+
+    def _insert(self, row, transaction):
+        """
+        Store a transaction in a row, moving the rows after it down
+        unless it replaces the transaction in that row
+        """
+        id_ = transaction.id
+        if id_ in self._rows:
+            for field in self._columns:
+                field.write(getattr(self, field.column), row,
+                            field.__get__(transaction))
+        else:
+            for field in self._columns:
+                field.insert(getattr(self, field.column), row,
+                             field.__get__(transaction))
+            self._ids.insert(row, id_)
+            if row == len(self._ids) - 1:
+                self._rows[id_] = row
+            else:
+                self._renumber(row)
+
+        transaction._bind(self)
+
+    @property
+    def _columns(self):
+        return self.transaction_type._columns
+
+    def _renumber(self, row):
+        """
+        Bring the rows of the transaction ids from row on up to date
+        """
+        rows = self._rows
+        ids = self._ids
+        for i in range(row, len(ids)):
+            rows[ids[i]] = i
+
+    def _view(self, id_):
+        """
+        Transaction reading and writing the row of a transaction id
+        """
+        return self.transaction_type._bound(self, id_)
+
     def get(self, id_):
         """
         Get a transaction from the ledger
         """
-        return self.transactions[id_]
+        if id_ not in self._rows:
+            raise KeyError(id_)
+        return self._view(id_)
+
+    def remove(self, id_):
+        """
+        Remove a transaction from the ledger
+        """
+        transaction = self.get(id_).copy()
+
+        row = self._rows.pop(id_)
+        for field in self._columns:
+            field.delete(getattr(self, field.column), row)
+        del self._ids[row]
+        self._renumber(row)
+
+        self.changed.pop(id_, None)
+        self._mark_stale()
+
+        return transaction
+
+    def __setstate__(self, state):
+        state = dict(state)
+        transactions = state.pop('transactions', None)
+        self.__dict__.update(state)
+        if transactions is None:
+            return
+
+        # Pickled with an object for every transaction, before changes
+        # were deduplicated and orders were kept
+        chain = sorted(transactions.values(), key=lambda t: t.order)
+        self._ids = []
+        self._rows = {}
+        for field in self._columns:
+            setattr(self, field.column, array(field.typecode))
+        for row, transaction in enumerate(chain):
+            self._ids.append(transaction.id)
+            self._rows[transaction.id] = row
+            for field in self._columns:
+                field.insert(getattr(self, field.column), row,
+                             field.__get__(transaction))
+
+        self.changed = {}
+        for id_ in state['changed']:
+            self._change(id_, transactions[id_].change)
+        self._next_order = len(chain)
+        self.deferred = False
+
+    def copy(self):
+        """
+        Copy of this ledger and its transactions, not attached
+        to a bureau
+        """
+        # Not copy.copy, which would go through __getstate__ and
+        # __setstate__ meant for pickling
+        ledger = object.__new__(type(self))
+        ledger.__dict__.update(self.__dict__)
+        ledger.bureau = None
+        ledger.changed = dict(self.changed)
+        ledger._ids = list(self._ids)
+        ledger._rows = dict(self._rows)
+        for field in self._columns:
+            setattr(ledger, field.column,
+                    array(field.typecode, getattr(self, field.column)))
+        return ledger
 
     def recalculate(self):
         """
@@ -91,19 +247,29 @@ class Ledger:
         # Clear the record of changes
         self.clear_changes()
 
-    def notify_agents(self, this_bureau, other_bureau):
+    def notify_agents(self, this_bureau, other_bureau, codes=None):
         """
         This agent notifies all connected agents of a change
 
         If this ledger is part of a user, this ledger notifies all subjects
         that this user's score has changed.
+
+        The connected agents are found through the transactions, or
+        given as their codes in other_bureau, see swap.agents.graph
         """
-        # TODO
+        if codes is None:
+            agents = (t.agent(other_bureau) for t in self)
+        else:
+            agents = (other_bureau.get_code(code) for code in codes)
+
+        n = 0
+        for agent in agents:
+            if agent is not None:
+                agent.ledger.notify(self.id, this_bureau)
+                n += 1
 
-        for t in self:
-            agent = t.agent(other_bureau)
-            agent.ledger.notify(self.id, this_bureau)
-            # t.notify(self.id)
+        if cascade.current is not None:
+            cascade.current.record_fanout(n)
 
     def notify(self, id_, bureau):
         """
@@ -114,47 +280,97 @@ class Ledger:
         """
         agent = bureau.get(id_)
         self.update(id_)
-        self.transactions[id_].notify(agent)
+        self._view(id_).notify(agent)
+
+        if cascade.current is not None:
+            cascade.current.notified += 1
 
     def clear_changes(self):
         """
         Clear the record of changes
         """
         self.stale = False
-        self.changed = []
+        self.deferred = False
+        self.changed = {}
+
+        if self.bureau is not None:
+            self.bureau.clear_stale(self.id)
 
     def update(self, id_):
         """
         Mark a transaction that has changed
         """
-        self.stale = True
+        self._mark_stale()
         self._change(id_)
         # self.transactions[id_].notify()
 
+    def _mark_stale(self):
+        """
+        Mark this ledger as needing to be recalculated, and let the
+        bureau know
+        """
+        self.stale = True
+        if self.bureau is not None:
+            self.bureau.mark_stale(self.id)
+
+    def _mark_changed(self):
+        """
+        Let the bureau know this ledger's score changed, so it
+        notifies its connected agents
+        """
+        if self.bureau is not None:
+            self.bureau.mark_changed(self.id)
+
     def print_(self):
         print(self)
 
     def __str__(self):
         s = 'id %s transactions %d stale %s score %s\n' % \
-            (str(self.id), len(self.transactions),
+            (str(self.id), len(self),
              str(self.stale), str(self._score))
-        for t in sorted(self.transactions.values(), key=lambda t: t.order):
+        for t in sorted(self, key=lambda t: t.order):
             s += '%s\n' % str(t)
 
         return s
 
     def __repr__(self):
         s = 'id %s transactions %d stale %s score %s\n' % \
-            (str(self.id), len(self.transactions),
+            (str(self.id), len(self),
              str(self.stale), str(self._score))
 
         return s
 
     def __iter__(self):
-        return iter(self.transactions.values())
+        return (self._view(id_) for id_ in self._ids)
+
+    def __contains__(self, id_):
+        return id_ in self._rows
 
     def __len__(self):
-        return len(self.transactions)
+        return len(self._ids)
+
+
+class Transactions(Mapping):
+    """
+    Read only mapping of the transactions of a ledger by id
+    """
+
+    __slots__ = ('ledger',)
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+
+    def __getitem__(self, id_):
+        return self.ledger.get(id_)
+
+    def __contains__(self, id_):
+        return id_ in self.ledger._rows
+
+    def __iter__(self):
+        return iter(self.ledger._ids)
+
+    def __len__(self):
+        return len(self.ledger)
 
 
 class MissingReference(AttributeError):
@@ -164,22 +380,210 @@ class MissingReference(AttributeError):
     pass
 
 
+NAN = float('nan')
+
+
+class Field:
+    """
+    Field of a transaction, kept in a column of the ledger: a typed
+    array with an entry for every row, or two entries for a pair of
+    scores. Until the transaction is added to a ledger, the field is
+    kept in the transaction itself.
+
+    None is stored as nan in float columns, and as the smallest
+    number in integer columns.
+    """
+
+    __slots__ = ('name', 'column', 'typecode', 'width', 'none')
+
+    def __init__(self, name, typecode, width=1):
+        self.name = name
+        # Attribute of the ledger holding the column
+        self.column = '_%ss' % name
+        self.typecode = typecode
+        self.width = width
+        if typecode == 'd':
+            self.none = NAN
+        else:
+            self.none = -1 << (8 * array(typecode).itemsize - 1)
+
+    def __get__(self, transaction, owner=None):
+        if transaction is None:
+            return self
+        ledger = transaction._ledger
+        if ledger is None:
+            return transaction._values.get(self.name)
+        return self.read(
+            getattr(ledger, self.column), ledger._rows[transaction.id])
+
+    def __set__(self, transaction, value):
+        ledger = transaction._ledger
+        if ledger is None:
+            transaction._values[self.name] = value
+        else:
+            self.write(
+                getattr(ledger, self.column), ledger._rows[transaction.id],
+                value)
+
+    def read(self, column, row):
+        if self.width == 2:
+            u0 = column[2 * row]
+            if u0 != u0:
+                return None
+            return (u0, column[2 * row + 1])
+
+        value = column[row]
+        if value == self.none or value != value:
+            return None
+        return value
+
+    def write(self, column, row, value):
+        if self.width == 2:
+            column[2 * row:2 * row + 2] = self._pair(value)
+        elif value is None:
+            column[row] = self.none
+        elif self.typecode == 'd':
+            column[row] = value
+        else:
+            column[row] = int(value)
+
+    def insert(self, column, row, value):
+        if self.width == 2:
+            column[2 * row:2 * row] = self._pair(value)
+        else:
+            column.insert(row, self.none)
+            self.write(column, row, value)
+
+    def delete(self, column, row):
+        del column[self.width * row:self.width * (row + 1)]
+
+    def _pair(self, value):
+        if value is None:
+            return array('d', (NAN, NAN))
+        return array('d', value)
+
+
 class Transaction:
     """
     Records an interaction from an agent with this ledger
+
+    There is a transaction in each of the user and subject ledger for
+    every classification. Once added to a ledger, the fields of the
+    transaction are kept in the ledger's columns, see Field, and its
+    change in the ledger's changed. The ledger hands out new
+    transaction objects for the row, which compare equal to the
+    transaction that was added.
     """
 
+    __slots__ = ('id', '_ledger', '_values')
+    # Fields kept in columns: name, array typecode and number of
+    # entries per row
+    _fields = (
+        ('annotation', 'b', 1),
+        ('order', 'i', 1),
+        ('score', 'd', 1))
+    # Field a change replaces when it is committed, None if changes
+    # are not committed
+    _committed = None
+    # Fields saved when pickling
+    _state = ('id', 'annotation', 'order', 'score', 'change')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._layout()
+
+    @classmethod
+    def _layout(cls):
+        """
+        Give the class a Field for each of its fields
+        """
+        columns = []
+        for name, typecode, width in cls._fields:
+            field = Field(name, typecode, width)
+            setattr(cls, name, field)
+            columns.append(field)
+        cls._columns = tuple(columns)
+
+    @classmethod
+    def _bound(cls, ledger, id_):
+        """
+        Transaction for the row of id_ in a ledger
+        """
+        transaction = object.__new__(cls)
+        transaction.id = id_
+        transaction._ledger = ledger
+        transaction._values = None
+        return transaction
+
     def __init__(self, agent, annotation):
         self.id = agent.id
+        self._ledger = None
+        # Every field starts out None. The order is the place of the
+        # transaction in the ledger, given by the ledger
+        self._values = {}
         self.annotation = annotation
-        # stores the order this transaction has in the ledger
-        self.order = None
-        self.score = None
-        self.change = None
+
+    def _bind(self, ledger):
+        """
+        Read and write the fields in the ledger's row from now on
+        """
+        self._ledger = ledger
+        self._values = None
+
+    @property
+    def change(self):
+        """
+        Change waiting to be committed, or the committed value
+        """
+        ledger = self._ledger
+        if ledger is None:
+            return self._values.get('change')
+
+        change = ledger.changed.get(self.id)
+        if change is None and self._committed is not None:
+            return getattr(self, self._committed)
+        return change
+
+    @change.setter
+    def change(self, change):
+        ledger = self._ledger
+        if ledger is None:
+            self._values['change'] = change
+        else:
+            ledger.changed[self.id] = change
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction) or self._ledger is None:
+            return self is other
+        return self._ledger is other._ledger and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
 
     def agent(self, bureau):
         return bureau.get(self.id)
 
+    def copy(self):
+        """
+        Copy of this transaction, not part of a ledger
+        """
+        return copy.copy(self)
+
+    def __getstate__(self):
+        # A tuple of values pickles much smaller than a dict of
+        # field names
+        return tuple(getattr(self, name) for name in self._state)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before transactions were slotted, missing
+            # fields are None
+            state = tuple(state.get(name) for name in self._state)
+        self._ledger = None
+        self._values = {}
+        for name, value in zip(self._state, state):
+            setattr(self, name, value)
+
     def notify(self, agent):
         pass
 
@@ -197,6 +601,10 @@ class Transaction:
         return s
 
 
+Transaction._layout()
+Ledger.transaction_type = Transaction
+
+
 class StaleException(Exception):
 
     def __init__(self, ledger):
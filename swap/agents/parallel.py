@@ -0,0 +1,79 @@
+################################################################
+# Recalculates stale subject ledgers in a process pool
+
+"""
+    Each subject's score depends only on its own transactions and the
+    user scores already pushed to them, so stale subject ledgers can be
+    recalculated independently of each other.
+
+    Worker processes are forked, and read the ledgers from their copy
+    of the parent's memory instead of having them pickled. Only subject
+    ids go to the workers, and only the new scores come back.
+"""
+
+import swap.config as config
+
+import multiprocessing
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bureau being processed, inherited by forked worker processes
+_bureau = None
+
+
+def process_changes(bureau, bar=None, processes=None, chunksize=None):
+    """
+    Recalculate every stale ledger of a subject bureau in parallel
+
+    Falls back to Bureau.process_changes when fork is not available or
+    there are too few stale subjects to be worth it.
+
+    Parameters
+    ----------
+    bureau : swap.agents.bureau.Bureau
+        Bureau of Subject agents
+    bar : progressbar.ProgressBar
+        (optional) progress bar, updated once per subject
+    processes : int
+        Number of worker processes, default config.parallel.processes
+    chunksize : int
+        Subjects per worker task, default config.parallel.chunksize
+    """
+    global _bureau
+
+    if processes is None:
+        processes = config.parallel.processes
+    if chunksize is None:
+        chunksize = config.parallel.chunksize
+
+    ids = bureau.stale_ids()
+    if len(ids) <= chunksize or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        logger.debug('Recalculating %d subjects serially', len(ids))
+        bureau.process_changes(bar)
+        return
+
+    chunks = [ids[i:i + chunksize] for i in range(0, len(ids), chunksize)]
+    logger.debug('Recalculating %d subjects in %d chunks',
+                 len(ids), len(chunks))
+
+    _bureau = bureau
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes) as pool:
+            for updates in pool.imap_unordered(_compute, chunks):
+                for update in updates:
+                    bureau.get(update[0]).ledger.apply_update(update)
+
+                if bar is not None:
+                    bar.update(bar.value + len(updates))
+    finally:
+        _bureau = None
+
+
+def _compute(ids):
+    """
+    Worker task: recalculate a chunk of subject ledgers
+    """
+    return [_bureau.get(id_).ledger.compute_update() for id_ in ids]
@@ -4,8 +4,12 @@
 
 from swap.agents.agent import Agent
 import swap.agents.ledger as ledger
+import swap.agents.cascade as cascade
 import swap.config as config
 
+from array import array
+import sys
+import math
 import logging
 logger = logging.getLogger(__name__)
 
@@ -63,13 +67,9 @@ class Subject(Agent):
                 'Classification subject id %s ' % str(cl.subject) +
                 'does not match my id %s' % str(self.id))
         annotation = int(cl.annotation)
-        id_ = user.id
-
-        if id_ not in self.ledger.transactions:
-            t = Transaction(user, annotation)
-            self.ledger.add(t)
+        self.ledger.record(user, annotation, cl.key)
 
-    def set_gold_label(self, gold_label, subjects, users):
+    def set_gold_label(self, gold_label, subjects=None, users=None):
         """
             Set a subject's gold label
 
@@ -78,13 +78,17 @@ class Subject(Agent):
                     -1 no gold label
                      0 bogus object
                      1 real supernova
+                subjects, users: (Bureau) bureaus used to notify the
+                    users that classified this subject, or None to
+                    leave notifying them to the caller
         """
         old = self._gold
         new = gold_label
 
         if old != new:
             self._gold = gold_label
-            self.ledger.notify_agents(subjects, users)
+            if subjects is not None:
+                self.ledger.notify_agents(subjects, users)
 
     def isgold(self):
         return self.gold in [0, 1]
@@ -122,107 +126,549 @@ class Subject(Agent):
 
 
 class Ledger(ledger.Ledger):
+    """
+    Subject ledger. Transactions are kept in rows in their order, so
+    the transactions left and right of a transaction are in the rows
+    before and after its own. The score history, the score after each
+    transaction, is kept in the ledger's trace.
+
+    New transactions continue the trace from the score before them.
+    A changed user score instead changes the subject score through
+    its log-odds: the posterior log-odds is the prior log-odds plus the
+    sum of the log likelihood ratios of all transactions, so only the
+    old ratio has to be taken out and the new one put in. The trace is
+    then brought up to date lazily by refresh.
+    """
+
     def __init__(self, id_):
         super().__init__(id_)
-        # First change in the change cascade
-        # self.first_change = None
-        # Most recently added transaction
-        self.last = None
-        # Note: first_change and last are references to the
-        #       actual transactions, not their id numbers
+        # Keys of the transactions, one per row. None as long as no
+        # transaction has a key
+        self._keys = None
+        # Sum of the log likelihood ratios of all committed
+        # transactions, None until a user score changes
+        self._logodds = None
+        # Row of the earliest transaction changed since the last
+        # recalculate
+        self._first = None
+        # Row of the earliest transaction whose score is out of date
+        self._dirty = None
+        # Score history: the prior, then the score after each
+        # transaction in order. Entries up to the one of _dirty are
+        # up to date, see refresh. nan for a score not calculated yet
+        self._trace = array('d', [config.p0])
 
-    def recalculate(self):
+    @property
+    def last(self):
+        """
+        Last transaction in order
+        """
+        if not self._ids:
+            return None
+        return self._view(self._ids[-1])
 
-        transaction = self.first_change
-
-        if transaction is None:
-            # Assume nothing has changed since last backupdate
-            if len(self.transactions) == 0:
-                # nothing has changed and there are no transactions
-                # score is prior
-                score = config.p0
-            else:
-                # nothing has changed and there are transactions
-                # score is current score
-                score = self._score
-        else:
-            prior = transaction.get_prior()
-            while transaction is not None:
-                transaction.commit_change()
+    def record(self, user, annotation, key=None):
+        """
+        Add the transaction of a classification by a user, like add
+        but without making a Transaction first
+
+        Returns
+        -------
+        id of the user, or None if the user is already in the ledger
+        """
+        id_ = user.id
+        if id_ in self._rows:
+            return None
 
-                prior = transaction.calculate(prior)
-                transaction = transaction.right
+        keys = self._keys
+        if keys and _earlier(key, keys[-1]):
+            # Goes before the end, see _place
+            return self.add(Transaction(user, annotation, key))
+
+        row = len(self._ids)
+        self._ids.append(id_)
+        self._rows[id_] = row
+        self._annotations.append(annotation)
+        self._orders.append(self._next_order)
+        self._next_order += 1
+        self._user_scores.extend(user.score)
+        self._trace.append(NAN)
+        if key is not None and keys is None:
+            keys = self._keys = [None] * row
+        if keys is not None:
+            keys.append(key)
+
+        if self._dirty is None:
+            self._dirty = row
+        if self._logodds is not None:
+            self._logodds += self._llr(row)
+        self._change(id_)
+        self._mark_stale()
 
-            score = prior
+        if not config.back_update:
+            self._set_score(self._walk(self._dirty))
+
+        return id_
 
-        self._score = score
+    def recalculate(self):
+        if cascade.current is not None:
+            cascade.current.record_recalculate(
+                len(self.changed), self._depth())
+
+        # Commit the changes, see Transaction.commit_change
+        annotations = self._annotations
+        user_scores = self._user_scores
+        rows = self._rows
+        logodds = self._logodds
+        changed = False
+        for id_, change in self.changed.items():
+            if change is None:
+                continue
+            row = rows[id_]
+            old0, old1 = user_scores[2 * row], user_scores[2 * row + 1]
+            u0, u1 = change
+            if u0 == old0 and u1 == old1:
+                continue
+
+            user_scores[2 * row] = u0
+            user_scores[2 * row + 1] = u1
+            changed = True
+            if logodds is not None:
+                annotation = annotations[row]
+                logodds += llr(annotation, u0, u1) - \
+                    llr(annotation, old0, old1)
+        self._logodds = logodds
+
+        first = self._first
+        dirty = self._dirty
+        if first is not None and not changed and \
+                (dirty is None or dirty >= first):
+            # Only new transactions, or the same user scores: the trace
+            # goes on from the earliest change
+            self._walk(first)
+        elif first is not None and (dirty is None or first < dirty):
+            self._dirty = first
+
+        score = self._calculate()
+
+        self._set_score(score)
         super().recalculate()
         return score
 
+    def refresh(self):
+        """
+        Recalculate the scores of every transaction after the
+        earliest change
+        """
+        if self._dirty is not None:
+            self._walk(self._dirty)
+
+    def _walk(self, row):
+        """
+        Calculate the scores of the transactions from a row on, each
+        from the score before it, see posterior
+
+        Returns
+        -------
+        float
+            score after the last transaction
+        """
+        annotations = self._annotations
+        user_scores = self._user_scores
+        trace = self._trace
+
+        score = trace[row]
+        for row in range(row, len(annotations)):
+            score = posterior(
+                score, annotations[row],
+                user_scores[2 * row], user_scores[2 * row + 1])
+            trace[row + 1] = score
+
+        self._dirty = None
+        return score
+
+    def _calculate_row(self, row):
+        """
+        Calculate the subject score after the transaction in a row,
+        from the score of the row before it
+        """
+        score = posterior(
+            self._trace[row], self._annotations[row],
+            self._user_scores[2 * row], self._user_scores[2 * row + 1])
+        self._trace[row + 1] = score
+        return score
+
+    def _llr(self, row):
+        return llr(self._annotations[row],
+                   self._user_scores[2 * row], self._user_scores[2 * row + 1])
+
+    def trace(self):
+        """
+        Score history of the subject: the prior, then the score after
+        each transaction in order.
+
+        The array is a copy: later changes to the ledger don't show in
+        it, and it doesn't hold on to the ledger's own trace.
+        """
+        self.refresh()
+        return array('d', self._trace)
+
+    def compute_update(self):
+        """
+        Recalculate this ledger and its transaction scores, returning
+        the results in a compact form that apply_update can merge into
+        another copy of this ledger.
+
+        Used by worker processes in parallel back_update.
+        """
+        # Row of the earliest transaction score that can change
+        start = self._first
+        if self._dirty is not None and (start is None or self._dirty < start):
+            start = self._dirty
+
+        self.recalculate()
+        self.refresh()
+
+        suffix = None
+        if start is not None:
+            suffix = self._trace[start + 1:]
+        return (self.id, self._logodds, self._score, start, suffix)
+
+    def apply_update(self, update):
+        """
+        Merge the results of compute_update into this ledger
+        """
+        _, logodds, score, start, suffix = update
+        if cascade.current is not None:
+            cascade.current.record_recalculate(
+                len(self.changed), self._depth())
+        self._set_score(score)
+
+        # Commit the same changes as the worker did
+        user_scores = self._user_scores
+        rows = self._rows
+        for id_, change in self.changed.items():
+            if change is not None:
+                row = rows[id_]
+                user_scores[2 * row:2 * row + 2] = array('d', change)
+        self._logodds = logodds
+
+        if start is not None:
+            self._trace[start + 1:] = suffix
+        self._dirty = None
+        self.clear_changes()
+
+    def copy(self):
+        ledger = super().copy()
+        ledger._trace = array('d', self._trace)
+        if self._keys is not None:
+            ledger._keys = list(self._keys)
+        return ledger
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if 'transactions' not in state:
+            return
+
+        # Pickled with an object for every transaction, linked to the
+        # transactions before and after it. Their orders follow the
+        # links
+        chain = sorted(state['transactions'].values(), key=lambda t: t.order)
+        self.__dict__.pop('last', None)
+        self._keys = None
+        self._logodds = None
+        self._trace = array(
+            'd', [config.p0] + [NAN if t.score is None else t.score
+                                for t in chain])
+        self._first = min(
+            (self._rows[id_] for id_ in self.changed), default=None)
+        self._dirty = self._first
+
     def add(self, transaction):
-        if transaction.id in self.transactions:
+        if transaction.id in self._rows:
             return None
 
-        # Link last transaction to this one
-        if self.last is not None:
-            self.last.right = transaction
-            transaction.left = self.last
-
         # Store this transaction
         id_ = super().add(transaction)
+        row = self._rows[id_]
+        if row < len(self._ids) - 1:
+            self._splice(row)
+        if self._logodds is not None:
+            self._logodds += self._llr(row)
 
         if not config.back_update:
-            self._score = transaction.calculate()
-            # TODO
-            # calculate new score
-            # but not by calling recalcluate
-
-        # Determine if most first change in cascade
-        # self._change(transaction)
-        # Assign this as last added
-        self.last = transaction
+            # The scores before it are up to date, and the ones after
+            # it follow from its own
+            if self._dirty < row:
+                self._walk(self._dirty)
+            score = transaction.calculate()
+            if row < len(self._ids) - 1:
+                score = self._walk(row + 1)
+            self._dirty = None
+            self._set_score(score)
 
         return id_
 
-    @property
-    def first_change(self):
-        if len(self.changed) == 0:
-            return None
+    def _place(self, transaction):
+        # Find the place of this transaction by its key. Transactions
+        # without a key go last, as do transactions with the same key
+        key = transaction.key
+        row = len(self._ids)
+        if self._keys is not None:
+            while row > 0 and _earlier(key, self._keys[row - 1]):
+                row -= 1
+        return row
+
+    def _insert(self, row, transaction):
+        key = transaction.key
+        super()._insert(row, transaction)
+
+        self._trace.insert(row + 1, NAN)
+        if key is not None and self._keys is None:
+            self._keys = [None] * (len(self._ids) - 1)
+        if self._keys is not None:
+            self._keys.insert(row, key)
+
+        # The rows of the changed transactions after it moved down,
+        # and their scores are out of date
+        if self._first is not None and self._first >= row:
+            self._first += 1
+        if self._dirty is None or self._dirty >= row:
+            self._dirty = row
+
+    def _splice(self, row):
+        """
+        Give a transaction added before the end of the ledger the
+        order of its position, shifting the orders after it
+        """
+        orders = self._orders
+        order = 0
+        if row > 0:
+            order = orders[row - 1] + 1
+        orders[row] = order
 
-        def order(id_):
-            return self.transactions[id_].order
-        id_ = min(self.changed, key=order)
+        for i in range(row + 1, len(orders)):
+            if orders[i] > order:
+                break
+            order += 1
+            orders[i] = order
 
-        return self.transactions[id_]
+        self._next_order = max(self._next_order, orders[-1] + 1)
 
-    # def _change(self, transaction):
-    #     """
-    #         Determine which transaction changed first in the ledger
-    #     """
-    #     # Usefule when recalculating a subject score, for example, as
-    #     # that needs to be calculated in order
+    def reorder(self, ids):
+        """
+        Put the transactions in the order of ids, giving them the
+        orders 0, 1, ... Every transaction score is out of date
+        afterwards
+        """
+        rows = [self._rows[id_] for id_ in ids]
+        for field in self._columns:
+            old = getattr(self, field.column)
+            new = array(field.typecode)
+            for row in rows:
+                new.extend(old[field.width * row:field.width * (row + 1)])
+            setattr(self, field.column, new)
+        if self._keys is not None:
+            self._keys = [self._keys[row] for row in rows]
+
+        self._orders = array('i', range(len(ids)))
+        self._ids = list(ids)
+        self._renumber(0)
+        self._next_order = len(ids)
+
+        self._trace = array('d', [config.p0] + [NAN] * len(ids))
+        self._dirty = 0 if ids else None
+        self._first = min(
+            (self._rows[id_] for id_ in self.changed), default=None)
+
+    def remove(self, id_):
+        row = self._rows[id_]
+        transaction = super().remove(id_)
+        del self._trace[row + 1]
+        if self._keys is not None:
+            del self._keys[row]
+        if self._logodds is not None:
+            self._logodds -= llr(transaction.annotation,
+                                 *transaction.user_score)
+
+        # The rows after the removed transaction moved up
+        first = self._first
+        if first == row:
+            first = min(
+                (self._rows[other] for other in self.changed), default=None)
+        elif first is not None and first > row:
+            first -= 1
+        self._first = first
+
+        # Every score after the removed transaction is out of date
+        dirty = self._dirty
+        if dirty is not None and dirty > row:
+            dirty -= 1
+        if dirty is None or dirty >= row:
+            dirty = row if row < len(self._ids) else None
+        self._dirty = dirty
 
-    #     if self.first_change is None:
-    #         self.first_change = transaction
-    #     else:
-    #         old = self.first_change.order
-    #         new = transaction.order
+        if not config.back_update:
+            self.refresh()
+            self._set_score(self._calculate())
+
+        return transaction
+
+    def notify(self, id_, bureau):
+        agent = bureau.get(id_)
+        self._mark_stale()
+        self._change(id_, agent.score)
+
+        if cascade.current is not None:
+            cascade.current.notified += 1
+
+    def _set_score(self, score):
+        """
+        Set the score, keeping the bureau's score index up to date
+        """
+        if score != self._score:
+            self._score = score
+            if self.bureau is not None:
+                self.bureau.score_changed(self.id)
+
+    def _calculate(self):
+        """
+        Score after every transaction: the end of the trace, or from
+        the log-odds while the trace is out of date
+        """
+        if len(self._ids) == 0:
+            return config.p0
+        if self._dirty is None:
+            return self._trace[-1]
+
+        if self._logodds is None:
+            self._logodds = math.fsum(
+                self._llr(row) for row in range(len(self._ids)))
+        return expit(logit(config.p0) + self._logodds)
+
+    def clear_changes(self):
+        super().clear_changes()
+        self._first = None
 
-    #         if new < old:
-    #             self.first_change = transaction
+    def _change(self, id_, change=None):
+        super()._change(id_, change)
+
+        # Track the earliest changed transaction
+        row = self._rows[id_]
+        if self._first is None or row < self._first:
+            self._first = row
+
+    @property
+    def first_change(self):
+        if self._first is None:
+            return None
+        return self._view(self._ids[self._first])
+
+    def _depth(self):
+        """
+        Number of transactions from the earliest change to the end,
+        counted in orders
+        """
+        if self._first is None:
+            return 0
+        orders = self._orders
+        return orders[-1] - orders[self._first] + 1
 
 
 class Transaction(ledger.Transaction):
-    def __init__(self, user, annotation):
+    # Score, key and links while the transaction is not part of
+    # a ledger are kept with its fields
+    __slots__ = ()
+    _fields = (
+        ('annotation', 'b', 1),
+        ('order', 'i', 1),
+        ('user_score', 'd', 2))
+    _committed = 'user_score'
+    # The score and key are kept in the ledger's trace and keys
+    _state = ledger.Transaction._state + ('key', 'user_score')
+
+    def __init__(self, user, annotation, key=None):
         super().__init__(user, annotation)
 
-        self.user_score = None
-        self.right = None
-        self.left = None
+        # Orders the transaction in the ledger, see config.order_key.
+        # The score is kept in the ledger's trace
+        self.key = key
 
         self.notify(user)
         self.commit_change()
 
+    @property
+    def score(self):
+        ledger = self._ledger
+        if ledger is None:
+            return self._values.get('score')
+        score = ledger._trace[ledger._rows[self.id] + 1]
+        return None if score != score else score
+
+    @score.setter
+    def score(self, score):
+        ledger = self._ledger
+        if ledger is None:
+            self._values['score'] = score
+        else:
+            ledger._trace[ledger._rows[self.id] + 1] = \
+                NAN if score is None else score
+
+    @property
+    def key(self):
+        ledger = self._ledger
+        if ledger is None:
+            return self._values.get('key')
+        if ledger._keys is None:
+            return None
+        return ledger._keys[ledger._rows[self.id]]
+
+    @key.setter
+    def key(self, key):
+        if self._ledger is not None:
+            raise AttributeError('Key of a transaction in a ledger is fixed')
+        self._values['key'] = key
+
+    @property
+    def left(self):
+        """
+        Transaction before this one in the ledger
+        """
+        return self._neighbour('left', -1)
+
+    @left.setter
+    def left(self, transaction):
+        self._link('left', transaction)
+
+    @property
+    def right(self):
+        """
+        Transaction after this one in the ledger
+        """
+        return self._neighbour('right', 1)
+
+    @right.setter
+    def right(self, transaction):
+        self._link('right', transaction)
+
+    def _neighbour(self, side, step):
+        ledger = self._ledger
+        if ledger is None:
+            return self._values.get(side)
+
+        row = ledger._rows[self.id] + step
+        if 0 <= row < len(ledger._ids):
+            return ledger._view(ledger._ids[row])
+        return None
+
+    def _link(self, side, transaction):
+        # Only transactions outside a ledger can be linked by hand,
+        # the links of the others follow their rows
+        if self._ledger is not None:
+            raise AttributeError(
+                'Links of a transaction in a ledger follow its order')
+        self._values[side] = transaction
+
     def commit_change(self):
         self.user_score = self.change
 
@@ -240,38 +686,20 @@ class Transaction(ledger.Transaction):
         return self.left.score
 
     def calculate(self, prior=None):
-        # Calculation when annotation 1
-        #           s*u1
-        # -------------------------
-        #    s*u1 + (1-s)*(1-u0)
+        """
+        Calculate the subject score after this transaction, see
+        posterior.
 
-        # Calculation when annotation 0
-        #           s*(1-u1)
-        # -------------------------
-        #    s*(1-u1) + (1-s)*u0
+        Without a prior, continues from the score of the previous
+        transaction in the ledger.
+        """
+        if prior is None and self._ledger is not None:
+            return self._ledger._calculate_row(self._ledger._rows[self.id])
 
         if prior is None:
             prior = self.get_prior()
-        u0, u1 = self.user_score
-
-        if self.annotation == 1:
-            a = prior * u1
-            b = (1 - prior) * (1 - u0)
-        elif self.annotation == 0:
-            a = prior * (1 - u1)
-            b = (1 - prior) * (u0)
-
-        # Preliminary catch of zero division error
-        # TODO: Figure out how to handle it
-        try:
-            score = a / (a + b)
-        # leave score unchanged
-        except ZeroDivisionError as e:
-            logger.exception(e)
-            score = prior
-
-        self.score = score
-        return score
+        self.score = posterior(prior, self.annotation, *self.user_score)
+        return self.score
 
     def __str__(self):
         score = self.score
@@ -282,3 +710,80 @@ class Transaction(ledger.Transaction):
         s += ' score %.5f user_score %.3f %.3f' % \
             (score, self.user_score[0], self.user_score[1])
         return s
+
+
+Ledger.transaction_type = Transaction
+NAN = ledger.NAN
+
+
+def _earlier(key, other):
+    """
+    Check if key orders before other. Missing keys never do
+    """
+    return key is not None and other is not None and key < other
+
+
+def posterior(prior, annotation, u0, u1):
+    """
+    Subject score after a user's annotation, given the score before
+    it and the user's confusion matrix
+
+    annotation 1:        s*u1
+                  ---------------------
+                  s*u1 + (1-s)*(1-u0)
+
+    annotation 0:      s*(1-u1)
+                  ---------------------
+                  s*(1-u1) + (1-s)*u0
+    """
+    if annotation == 1:
+        a = prior * u1
+        b = (1 - prior) * (1 - u0)
+    else:
+        a = prior * (1 - u1)
+        b = (1 - prior) * u0
+
+    # Preliminary catch of zero division error
+    # TODO: Figure out how to handle it
+    try:
+        return a / (a + b)
+    # leave score unchanged
+    except ZeroDivisionError as e:
+        logger.exception(e)
+        return prior
+
+
+def llr(annotation, u0, u1):
+    """
+    Log likelihood ratio of a subject being real given a user's
+    annotation and confusion matrix
+
+    annotation 1:  log( u1 / (1-u0) )
+    annotation 0:  log( (1-u1) / u0 )
+    """
+    if annotation == 1:
+        real, bogus = u1, 1 - u0
+    else:
+        real, bogus = 1 - u1, u0
+
+    return _log(real) - _log(bogus)
+
+
+def logit(p):
+    return _log(p) - _log(1 - p)
+
+
+def expit(x):
+    """
+    Inverse of logit, safe against overflow for large |x|
+    """
+    if x >= 0:
+        return 1 / (1 + math.exp(-x))
+    e = math.exp(x)
+    return e / (1 + e)
+
+
+def _log(x):
+    # A perfect (or perfectly wrong) user score saturates instead
+    # of failing
+    return math.log(max(x, sys.float_info.min))
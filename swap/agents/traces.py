@@ -0,0 +1,219 @@
+################################################################
+# Confusion matrix history of users
+
+"""
+    Keeps the counts behind each user's confusion matrix after every
+    transaction that changed them, that is every transaction with a
+    gold label, for user trace plots and skill drift analyses.
+
+    Records are kept as rows of a table of 32 bit ints, in the order
+    they happened, and are read back as views of the table. Rows never
+    change once recorded, so the table is shared with copies until
+    either adds to it, and the records grouped by user are kept until
+    more are recorded.
+"""
+
+import swap.utils.arrays as array_file
+import swap.config as config
+
+import copy
+import numpy as np
+
+
+class UserTraces:
+    """
+    (seen, matched) counts of both classes of users, after each
+    transaction that changed them
+    """
+
+    FIELDS = ('user', 'no_seen', 'no_matched', 'yes_seen', 'yes_matched')
+    MAGIC = b'SWAPUTRC'
+    # Format version, bumped when the arrays change meaning
+    VERSION = 1
+
+    def __init__(self, capacity=1024):
+        self._n = 0
+        self._table = np.zeros((capacity, len(self.FIELDS)), dtype=np.int32)
+        # The table is shared with another store and has to be
+        # copied before recording, see copy
+        self._shared = False
+        # by_user of the first _grouped[0] records
+        self._grouped = None
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Store of records in the layout of table
+        """
+        traces = cls(max(len(table), 1))
+        traces._table[:len(table)] = table
+        traces._n = len(table)
+        return traces
+
+    def record(self, code, no, yes):
+        """
+        Record the counters of a user
+
+        Parameters
+        ----------
+        code : int
+            user code
+        no, yes : swap.agents.user.Counter
+        """
+        self._reserve(self._n + 1)
+        self._table[self._n] = (
+            code, no.seen, no.matched, yes.seen, yes.matched)
+        self._n += 1
+
+    def _reserve(self, n):
+        """
+        Make room for at least n records, doubling the capacity
+        """
+        capacity = len(self._table)
+        if n <= capacity and not self._shared:
+            return
+
+        self._shared = False
+        if n > capacity:
+            capacity = max(n, capacity * 2)
+        table = np.zeros((capacity, len(self.FIELDS)), dtype=np.int32)
+        table[:self._n] = self._table[:self._n]
+        self._table = table
+
+    def table(self):
+        """
+        All records, one row per record with a column for each of
+        FIELDS. A read only view, which keeps its records when more
+        are recorded.
+        """
+        return _view(self._table[:self._n])
+
+    def columns(self):
+        """
+        (field : np.ndarray) parallel columns of the records
+        """
+        table = self.table()
+        return {name: table[:, i] for i, name in enumerate(self.FIELDS)}
+
+    def user(self, code):
+        """
+        Records of one user, without the user column. A read only
+        view, see by_user.
+        """
+        codes, offsets, counts = self.by_user()
+        i = np.searchsorted(codes, code)
+        if i == len(codes) or codes[i] != code:
+            return counts[:0]
+        return counts[offsets[i]:offsets[i + 1]]
+
+    def by_user(self):
+        """
+        Records grouped by user, in order within each user
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray, np.ndarray)
+            user codes, the start of each user's records and the end of
+            the last, and the records without the user column. The
+            arrays are read only and kept until more records are
+            recorded.
+        """
+        if self._grouped is not None and self._grouped[0] == self._n:
+            return self._grouped[1:]
+
+        table = self._table[:self._n]
+        order = np.argsort(table[:, 0], kind='stable')
+        table = table[order]
+
+        codes, counts = np.unique(table[:, 0], return_counts=True)
+        offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        grouped = (_view(codes), _view(offsets), _view(table[:, 1:]))
+        self._grouped = (self._n,) + grouped
+        return grouped
+
+    def user_scores(self):
+        """
+        (code, u0, u1) score traces of every user with records
+        """
+        codes, offsets, counts = self.by_user()
+        u0, u1 = self.scores(counts)
+        for i, code in enumerate(codes.tolist()):
+            lo = offsets[i]
+            hi = offsets[i + 1]
+            yield code, u0[lo:hi], u1[lo:hi]
+
+    @staticmethod
+    def scores(counts):
+        """
+        User scores (u0, u1) of records, see swap.agents.user.Counter
+        """
+        gamma = config.gamma
+        counts = counts.astype(np.float64)
+        u0 = (counts[:, 1] + gamma) / (counts[:, 0] + gamma * 2)
+        u1 = (counts[:, 3] + gamma) / (counts[:, 2] + gamma * 2)
+        return u0, u1
+
+    def copy(self):
+        """
+        Copy of this store that shares the table until either records
+        more
+        """
+        traces = copy.copy(self)
+        traces._shared = True
+        return traces
+
+    def extend(self, other, codes):
+        """
+        Add the records of another store
+
+        Parameters
+        ----------
+        other : UserTraces
+        codes : np.ndarray
+            code here of every user code of the other store
+        """
+        n = self._n + len(other)
+        self._reserve(n)
+        table = self._table[self._n:n]
+        table[:] = other.table()
+        table[:, 0] = codes[table[:, 0]]
+        self._n = n
+
+    def save(self, fname, compress=False):
+        """
+        Save the records to a file, see swap.utils.arrays
+        """
+        array_file.write(
+            fname, self.MAGIC, {'version': self.VERSION},
+            {'records': self.table()}, compress)
+
+    @classmethod
+    def load(cls, fname):
+        header, arrays = array_file.read(fname, cls.MAGIC, mmap=False)
+        if header['version'] > cls.VERSION:
+            raise ValueError(
+                'User traces %s have format version %d, newer than %d' %
+                (fname, header['version'], cls.VERSION))
+
+        return cls.from_table(arrays['records'])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_table'] = self._table[:self._n]
+        state['_shared'] = False
+        state['_grouped'] = None
+        return state
+
+    def __len__(self):
+        return self._n
+
+
+def _view(array):
+    """
+    Read only view of an array
+    """
+    array = array.view()
+    array.flags.writeable = False
+    return array
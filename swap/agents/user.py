@@ -6,8 +6,11 @@
 from swap.agents.agent import Agent
 from swap.utils.stats import MultiStat
 import swap.agents.ledger as ledger
+import swap.agents.cascade as cascade
 import swap.config as config
 
+from array import array
+
 
 class User(Agent):
     """
@@ -39,10 +42,7 @@ class User(Agent):
                 'Classification user name %s ' % str(cl.user) +
                 'does not match my id %s' % str(self.id))
         annotation = cl.annotation
-
-        if subject.id not in self.ledger.transactions:
-            t = Transaction(subject, annotation)
-            self.ledger.add(t)
+        self.ledger.record(subject, annotation)
 
     # def export(self):
     #     """
@@ -166,14 +166,62 @@ class Ledger(ledger.Ledger):
         super().__init__(id_)
         self.no = Counter()
         self.yes = Counter()
+        # Score the connected subjects were last notified of
+        self._pushed = None
 
         self.recalculate()
+        self._pushed = self._score
 
     @ledger.Ledger.score.setter
     def score(self, new):
         if self._score != new:
             self._score = new
 
+            # Changes within config.notify_tol of what the subjects
+            # already have are held back
+            if self._pushed is None or self.skipped > config.notify_tol:
+                self._mark_changed()
+            else:
+                self._mark_skipped()
+
+    @property
+    def skipped(self):
+        """
+        Largest difference between the current score and the score
+        the connected subjects were last notified of
+        """
+        if self._pushed is None:
+            return 0.
+        return max(abs(a - b) for a, b in zip(self._score, self._pushed))
+
+    def notify_agents(self, this_bureau, other_bureau, codes=None):
+        super().notify_agents(this_bureau, other_bureau, codes)
+
+        self._pushed = self._score
+        if self.bureau is not None:
+            self.bureau.clear_skipped(self.id)
+
+    def _mark_skipped(self):
+        """
+        Let the bureau know this ledger's score changed by too little
+        to notify its connected agents
+        """
+        if self.bureau is not None:
+            self.bureau.mark_skipped(self.id)
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if 'transactions' in state:
+            # Pickled with an object for every transaction, before
+            # small changes were held back
+            self._pushed = self._score
+
+    def copy(self):
+        ledger = super().copy()
+        ledger.no = self.no.copy()
+        ledger.yes = self.yes.copy()
+        return ledger
+
     def add(self, transaction):
         # Remove gold label from transaction, will be put back in when
         # recalculating
@@ -185,6 +233,48 @@ class Ledger(ledger.Ledger):
 
         return id_
 
+    def record(self, subject, annotation):
+        """
+        Add the transaction of a classification of a subject, like add
+        but without making a Transaction first
+
+        Returns
+        -------
+        id of the subject, or None if the subject is already in the
+        ledger
+        """
+        id_ = subject.id
+        if id_ in self._rows:
+            return None
+
+        self._rows[id_] = len(self._ids)
+        self._ids.append(id_)
+        self._annotations.append(annotation)
+        self._orders.append(self._next_order)
+        self._next_order += 1
+        self._scores.extend(_NO_SCORE)
+        self._golds.append(_NO_GOLD)
+
+        self._change(id_, subject.gold)
+        self._mark_stale()
+
+        if not config.back_update:
+            self.recalculate()
+
+        return id_
+
+    def remove(self, id_):
+        transaction = super().remove(id_)
+        # Un-count the gold label the transaction was counted with
+        self.action(transaction, 'old')
+        if self.counter(transaction.gold) is not None:
+            self._record()
+
+        if not config.back_update:
+            self.recalculate()
+
+        return transaction
+
     def counter(self, gold):
         if gold == 0:
             return self.no
@@ -193,31 +283,44 @@ class Ledger(ledger.Ledger):
 
     def action(self, transaction, version):
         t = transaction
-        c = self.counter(t.gold)
+        self._count(t.gold, t.matched, version)
+
+    def _count(self, gold, matched, version):
+        c = self.counter(gold)
         if c is not None:
             if version == 'new':
-                if t.matched:
+                if matched:
                     c.match()
                 else:
                     c.see()
             elif version == 'old':
-                if t.matched:
+                if matched:
                     c.unmatch()
                 else:
                     c.unsee()
 
     def recalculate(self):
-        # print(self.changed)
-        for i in self.changed:
-            # print(i, self.id)
-            t = self.transactions[i]
-
-            if t.changed:
-                self.action(t, 'old')
-                t.commit_change()
-                self.action(t, 'new')
-
-                t.score = self._calculate()
+        # Works on the columns directly, see Transaction
+        annotations = self._annotations
+        golds = self._golds
+        scores = self._scores
+        rows = self._rows
+        for id_, change in self.changed.items():
+            row = rows[id_]
+            gold = golds[row]
+            if gold == _NO_GOLD:
+                gold = None
+
+            if change is not None and gold != change:
+                annotation = annotations[row]
+                counted = self.counter(gold) is not None
+                self._count(gold, annotation == gold, 'old')
+                golds[row] = change
+                self._count(change, annotation == change, 'new')
+
+                scores[2 * row:2 * row + 2] = array('d', self._calculate())
+                if counted or self.counter(change) is not None:
+                    self._record()
 
         score = self._calculate()
 
@@ -226,16 +329,40 @@ class Ledger(ledger.Ledger):
         self.score = score
         return score
 
+    def notify(self, id_, bureau):
+        agent = bureau.get(id_)
+        self._mark_stale()
+        self._change(id_, agent.gold)
+
+        if cascade.current is not None:
+            cascade.current.notified += 1
+
     def _calculate(self):
         return (self.no.score, self.yes.score)
 
+    def _record(self):
+        """
+        Record the counters in the bureau's user traces, if it keeps
+        them
+        """
+        bureau = self.bureau
+        if bureau is not None and bureau.traces is not None:
+            bureau.traces.record(bureau.code(self.id), self.no, self.yes)
+
 
 class Transaction(ledger.Transaction):
+    __slots__ = ()
+    _fields = (
+        ('annotation', 'b', 1),
+        ('order', 'i', 1),
+        ('score', 'd', 2),
+        ('gold', 'b', 1))
+    _committed = 'gold'
+    _state = ledger.Transaction._state + ('gold',)
+
     def __init__(self, subject, annotation):
         super().__init__(subject, annotation)
 
-        self.gold = None
-
         # TODO store current score
 
         self.notify(subject)
@@ -265,11 +392,34 @@ class Transaction(ledger.Transaction):
         return s
 
 
+Ledger.transaction_type = Transaction
+
+# Transaction score and gold label of a new transaction in the columns
+_NO_SCORE = (ledger.NAN, ledger.NAN)
+_NO_GOLD = Transaction.gold.none
+
+
 class Counter:
+    __slots__ = ('seen', 'matched')
+
     def __init__(self):
         self.seen = 0
         self.matched = 0
 
+    def __setstate__(self, state):
+        # Counters pickled before they were slotted have a dict as
+        # state, slotted ones (None, dict of slots)
+        if isinstance(state, tuple):
+            state = state[1]
+        self.seen = state['seen']
+        self.matched = state['matched']
+
+    def copy(self):
+        counter = Counter()
+        counter.seen = self.seen
+        counter.matched = self.matched
+        return counter
+
     def calculate(self):
         def formula(n, total):
             # alpha = 2
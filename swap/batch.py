@@ -0,0 +1,648 @@
+################################################################
+"""
+    BatchSWAP:
+        Array-backed implementation of dynamic SWAP. Processes whole
+        columns of integer-coded classifications with numpy kernels
+        instead of feeding one Classification at a time through the
+        agent and ledger object graph. BatchSWAP.converge iterates
+        static SWAP over the same arrays to a fixed point.
+"""
+
+from swap.utils.history import History, HistoryExport, HistoryStore
+from swap.utils.scores import Score, ScoreExport
+from swap.utils.classification import Classification
+from swap.utils.codes import Codes
+
+import swap.config as config
+
+import numpy as np
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSWAP:
+    """
+        Vectorized dynamic SWAP (config.back_update = False).
+
+        Classifications are passed as three parallel integer columns:
+        user code, subject code and annotation. Codes are dense indices
+        starting at 0; the external user and subject ids they stand for
+        are kept in BatchSWAP.users and BatchSWAP.subjects, and can be
+        registered with BatchSWAP.encode. Codes that were never
+        registered stand for themselves.
+
+        Scores are the same as feeding the classifications in the same
+        order to SWAP.classify with back_update disabled, up to rounding
+        in log and exp:
+
+            - a repeated (user, subject) pair is ignored
+            - a subject's score is updated with the user's confusion
+              matrix as it was just before this classification
+            - the user's confusion matrix is then updated if the
+              subject is a gold standard
+    """
+
+    def __init__(self):
+        self.users = Codes()
+        self.subjects = Codes()
+
+        # Per-user confusion counts. Rows are
+        # seen gold 0, matched gold 0, seen gold 1, matched gold 1
+        self._counts = np.zeros((4, 0), dtype=np.int64)
+        # Per-subject sum of log likelihood ratios and gold label
+        self._logodds = np.zeros(0)
+        self._gold = np.zeros(0, dtype=np.int64)
+        # Sorted (user, subject) keys already classified
+        self._pairs = np.zeros(0, dtype=np.int64)
+
+        # Processed classification columns, in processing order
+        self._user = np.zeros(0, dtype=np.int64)
+        self._subject = np.zeros(0, dtype=np.int64)
+        self._annotation = np.zeros(0, dtype=np.int64)
+        self._scores = np.zeros(0)
+
+    @classmethod
+    def from_swap(cls, swap):
+        """
+        Build a BatchSWAP from the classifications and gold labels
+        of a SWAP.
+
+        Classifications are processed one subject at a time, so the
+        dynamic score histories differ from the original run. Static
+        results like converge do not depend on the order.
+
+        User and subject codes are the same as in the SWAP bureaus.
+
+        Parameters
+        ----------
+        swap : swap.swap.SWAP
+        """
+        batch = cls()
+        for id_ in swap.users.codes:
+            batch.users.code(id_)
+        for id_ in swap.subjects.codes:
+            batch.subjects.code(id_)
+        batch.set_gold_labels(swap.golds)
+
+        classifications = []
+        for subject in swap.subjects:
+            for t in sorted(subject.ledger, key=lambda t: t.order):
+                classifications.append(
+                    Classification(t.id, subject.id, t.annotation))
+
+        batch.classify_all(classifications)
+        return batch
+
+    def encode(self, classifications):
+        """
+        Convert classifications to integer columns, registering any
+        new user and subject ids
+
+        Parameters
+        ----------
+        classifications : iterable
+            Classification objects, or classification dicts accepted
+            by Classification.generate
+
+        Returns
+        -------
+        tuple
+            (users, subjects, annotations) numpy arrays
+        """
+        users = []
+        subjects = []
+        annotations = []
+        for cl in classifications:
+            if not isinstance(cl, Classification):
+                cl = Classification.generate(cl)
+            users.append(self.users.code(cl.user))
+            subjects.append(self.subjects.code(cl.subject))
+            annotations.append(cl.annotation)
+
+        def column(data):
+            return np.array(data, dtype=np.int64)
+        return column(users), column(subjects), column(annotations)
+
+    def classify_all(self, classifications):
+        """
+        Encode and process an iterable of classifications
+        """
+        self.classify(*self.encode(classifications))
+
+    def classify(self, users, subjects, annotations):
+        """
+        Process a batch of integer-coded classifications
+
+        Batches can be processed one after another; state carries
+        over exactly as if all classifications had been in one batch.
+
+        Parameters
+        ----------
+        users : array_like
+            user code of each classification
+        subjects : array_like
+            subject code of each classification
+        annotations : array_like
+            annotation (0 or 1) of each classification
+        """
+        users = np.asarray(users, dtype=np.int64)
+        subjects = np.asarray(subjects, dtype=np.int64)
+        annotations = np.asarray(annotations, dtype=np.int64)
+
+        if not len(users) == len(subjects) == len(annotations):
+            raise ValueError('Classification columns differ in length')
+        if len(users) == 0:
+            return
+        if np.any((annotations != 0) & (annotations != 1)):
+            raise ValueError('Annotations must be 0 or 1')
+
+        self._grow(users.max() + 1, subjects.max() + 1)
+
+        keep = self._first_seen(users, subjects)
+        users = users[keep]
+        subjects = subjects[keep]
+        annotations = annotations[keep]
+
+        logger.debug('Processing %d classifications', len(users))
+        gold = self._gold[subjects]
+        u0, u1 = self._user_scores(users, gold, annotations)
+        scores = self._subject_scores(subjects, annotations, u0, u1)
+
+        self._user = np.concatenate((self._user, users))
+        self._subject = np.concatenate((self._subject, subjects))
+        self._annotation = np.concatenate((self._annotation, annotations))
+        self._scores = np.concatenate((self._scores, scores))
+
+    def set_gold_labels(self, golds):
+        """
+        Define the subjects that should be treated as gold standards.
+        Subjects not in golds lose their gold label.
+
+        Confusion counts of users that already classified a relabelled
+        subject are corrected, as SWAP does the next time those users
+        classify.
+
+        Parameters
+        ----------
+        golds : dict
+            (subject id : gold label) Mapping of subject to its gold label
+        """
+        codes = [self.subjects.code(id_) for id_ in golds]
+        self._grow(len(self.users), len(self.subjects))
+
+        old = self._gold.copy()
+        self._gold[:] = -1
+        self._gold[codes] = list(golds.values())
+
+        changed = np.flatnonzero(old != self._gold)
+        if len(changed) == 0:
+            return
+
+        logger.debug('Gold label changed for %d subjects', len(changed))
+        mask = np.isin(self._subject, changed)
+        users = self._user[mask]
+        annotations = self._annotation[mask]
+        subjects = self._subject[mask]
+
+        self._count(users, old[subjects], annotations, -1)
+        self._count(users, self._gold[subjects], annotations, 1)
+
+    def converge(self, tol=None, max_iter=None, soft=True):
+        """
+        Static SWAP over every processed classification, iterated
+        to a fixed point.
+
+        Each iteration is one vectorized sweep: user confusion matrices
+        are counted from the current subject labels, then every subject
+        score is recalculated from scratch with those matrices. The
+        first iteration counts gold subjects only, which is the same
+        as a back_update SWAP. With soft labels, later iterations also
+        count non-gold subjects, weighted by their score from the
+        previous iteration, until no user or subject score changes by
+        more than tol.
+
+        Does not change the dynamic scores of this BatchSWAP.
+
+        Parameters
+        ----------
+        tol : float
+            Largest score change to stop at, default
+            config.fixed_point.tol
+        max_iter : int
+            Iteration limit, default config.fixed_point.max_iter
+        soft : bool
+            Count non-gold subjects. Without soft labels the first
+            iteration is already the fixed point.
+
+        Returns
+        -------
+        Convergence
+            Final scores, iteration count and residuals
+        """
+        if tol is None:
+            tol = config.fixed_point.tol
+        if max_iter is None:
+            max_iter = config.fixed_point.max_iter
+
+        users = self._user
+        subjects = self._subject
+        annotations = self._annotation
+        n_users = len(self.users)
+        n_subjects = len(self.subjects)
+
+        gold = self._gold[subjects]
+        is_gold = gold != -1
+        # How much each classification counts towards its user's
+        # matrix, and how much of that is as a real subject
+        weight = is_gold.astype(float)
+        real = (gold == 1).astype(float)
+
+        u0 = np.full(n_users, .5)
+        u1 = np.full(n_users, .5)
+        p = np.full(n_subjects, config.p0)
+        base = _logit(config.p0)
+
+        residuals = []
+        converged = False
+        for i in range(max_iter):
+            counts = np.zeros((4, n_users))
+            matched0 = (annotations == 0)
+            matched1 = (annotations == 1)
+            for row, w in enumerate((
+                    weight - real, (weight - real) * matched0,
+                    real, real * matched1)):
+                counts[row] = np.bincount(
+                    users, weights=w, minlength=n_users)
+
+            new_u0, new_u1 = self._confusion(counts)
+            logodds = np.bincount(
+                subjects, minlength=n_subjects,
+                weights=_llr(annotations, new_u0[users], new_u1[users]))
+            new_p = _expit(base + logodds)
+
+            residual = max(
+                np.max(np.abs(new_u0 - u0), initial=0),
+                np.max(np.abs(new_u1 - u1), initial=0),
+                np.max(np.abs(new_p - p), initial=0))
+            residuals.append(float(residual))
+            logger.debug('Iteration %d residual %e', i + 1, residual)
+
+            u0, u1, p = new_u0, new_u1, new_p
+            if not soft or residual <= tol:
+                converged = True
+                break
+
+            weight = np.ones(len(users))
+            real = np.where(is_gold, gold == 1, p[subjects])
+
+        logger.info('%s after %d iterations, residual %e',
+                    'Converged' if converged else 'Stopped',
+                    len(residuals), residuals[-1] if residuals else 0)
+
+        return Convergence(self, u0, u1, p, residuals, converged)
+
+    @property
+    def golds(self):
+        """
+        Compile a list of all the subject -> gold mappings being used
+
+        Returns
+        -------
+        dict
+            {subject id: gold label}
+        """
+        codes = np.flatnonzero(self._gold != -1)
+        return {self.subjects.id(i): int(self._gold[i]) for i in codes}
+
+    @property
+    def user_scores(self):
+        """
+        Current confusion matrix of each user
+
+        Returns
+        -------
+        dict
+            {user id: (score 0, score 1)}
+        """
+        u0, u1 = self._confusion(self._counts)
+        return {id_: (float(u0[i]), float(u1[i]))
+                for i, id_ in enumerate(self.users)}
+
+    @property
+    def subject_scores(self):
+        """
+        Current score of each subject with at least one classification
+
+        Returns
+        -------
+        dict
+            {subject id: score}
+        """
+        codes = np.unique(self._subject)
+        scores = _expit(_logit(config.p0) + self._logodds[codes])
+        return {self.subjects.id(i): float(p) for i, p in zip(codes, scores)}
+
+    # ----------------------------------------------------------------
+
+    def score_export(self, thresholds=None):
+        """
+        Generate object containing subject score data
+
+        Returns
+        -------
+        swap.utils.scores.ScoreExport
+            ScoreExport
+        """
+        history = self.history_export()
+        if thresholds is None:
+            unretired = history.score_export(all_golds=False)
+            thresholds = unretired.thresholds
+
+        retired = history.score_export(thresholds, all_golds=True)
+        retired.set_retired_flags()
+
+        return retired
+
+    def history_export(self):
+        """
+        Generate object containing subject score history
+
+        Returns
+        -------
+        swap.utils.history.HistoryExport
+            HistoryExport
+        """
+        logger.info('Generating history export')
+        order = np.argsort(self._subject, kind='stable')
+        subjects = self._subject[order]
+        scores = self._scores[order]
+
+        codes, first = np.unique(subjects, return_index=True)
+        bounds = list(first[1:]) + [len(subjects)]
+
+        history = {}
+        for code, lo, hi in zip(codes, first, bounds):
+            id_ = self.subjects.id(code)
+            trace = [config.p0] + scores[lo:hi].tolist()
+            history[id_] = History(id_, int(self._gold[code]), trace)
+
+        logger.debug('done')
+        return HistoryExport(history)
+
+    def history_store(self, delta=False):
+        """
+        Subject score histories in one array, without building a list
+        per subject
+
+        Returns
+        -------
+        swap.utils.history.HistoryStore
+        """
+        order = np.argsort(self._subject, kind='stable')
+        codes, counts = np.unique(self._subject[order], return_counts=True)
+
+        # Each trace is the prior followed by the subject's scores
+        offsets = np.zeros(len(codes) + 1, dtype=np.int64)
+        np.cumsum(counts + 1, out=offsets[1:])
+        scores = np.empty(offsets[-1], dtype=np.float64)
+        prior = np.zeros(offsets[-1], dtype=bool)
+        prior[offsets[:-1]] = True
+        scores[prior] = config.p0
+        scores[~prior] = self._scores[order]
+
+        ids = [self.subjects.id(code) for code in codes.tolist()]
+        return HistoryStore.from_scores(
+            ids, self._gold[codes], offsets, scores, delta)
+
+    # ----------------------------------------------------------------
+
+    def _grow(self, n_users, n_subjects):
+        """
+        Extend the per-user and per-subject arrays to fit new codes
+        """
+        self.users.extend(n_users)
+        self.subjects.extend(n_subjects)
+
+        n = n_users - self._counts.shape[1]
+        if n > 0:
+            pad = np.zeros((4, n), dtype=np.int64)
+            self._counts = np.concatenate((self._counts, pad), axis=1)
+
+        n = n_subjects - len(self._logodds)
+        if n > 0:
+            self._logodds = np.concatenate((self._logodds, np.zeros(n)))
+            self._gold = np.concatenate(
+                (self._gold, np.full(n, -1, dtype=np.int64)))
+
+    def _first_seen(self, users, subjects):
+        """
+        Mask of classifications whose (user, subject) pair has not
+        been seen before, in this or any previous batch
+        """
+        keys = (users << 32) | subjects
+        _, first = np.unique(keys, return_index=True)
+
+        keep = np.zeros(len(keys), dtype=bool)
+        keep[first] = True
+        keep &= ~np.isin(keys, self._pairs)
+
+        self._pairs = np.union1d(self._pairs, keys[keep])
+        return keep
+
+    @staticmethod
+    def _increments(gold, annotations):
+        """
+        Contribution of each classification to its user's
+        confusion counts
+        """
+        inc = np.zeros((4, len(gold)), dtype=np.int64)
+        inc[0] = gold == 0
+        inc[1] = (gold == 0) & (annotations == 0)
+        inc[2] = gold == 1
+        inc[3] = (gold == 1) & (annotations == 1)
+        return inc
+
+    def _count(self, users, gold, annotations, sign):
+        inc = self._increments(gold, annotations)
+        n = self._counts.shape[1]
+        for row in range(4):
+            self._counts[row] += sign * np.bincount(
+                users, weights=inc[row], minlength=n).astype(np.int64)
+
+    @staticmethod
+    def _confusion(counts):
+        gamma = config.gamma
+        u0 = (counts[1] + gamma) / (counts[0] + gamma * 2)
+        u1 = (counts[3] + gamma) / (counts[2] + gamma * 2)
+        return u0, u1
+
+    def _user_scores(self, users, gold, annotations):
+        """
+        Confusion matrix of the classifying user just before each
+        classification, then commit the batch to the user counts
+        """
+        inc = self._increments(gold, annotations)
+        before = _group_exclusive_cumsum(users, inc)
+        before += self._counts[:, users]
+
+        self._count(users, gold, annotations, 1)
+        return self._confusion(before)
+
+    def _subject_scores(self, subjects, annotations, u0, u1):
+        """
+        Sequential Bayesian update of each subject's score, as a
+        running sum of log likelihood ratios.
+
+        The sweep adds the k-th classification of every subject at
+        once, for k = 0, 1, ... up to the longest subject history, so
+        each subject's sum is accumulated in the same order as its
+        subject.Ledger does.
+        """
+        llr = _llr(annotations, u0, u1)
+        base = _logit(config.p0)
+
+        n = len(subjects)
+        order = np.argsort(subjects, kind='stable')
+        start = _group_starts(subjects[order])
+        rank = np.arange(n) - np.maximum.accumulate(
+            np.where(start, np.arange(n), 0))
+
+        by_rank = order[np.argsort(rank, kind='stable')]
+        bounds = np.cumsum(np.bincount(rank))
+
+        scores = np.empty(n)
+        lo = 0
+        for hi in bounds:
+            idx = by_rank[lo:hi]
+            s = subjects[idx]
+
+            self._logodds[s] += llr[idx]
+            scores[idx] = _expit(base + self._logodds[s])
+            lo = hi
+
+        return scores
+
+
+class Convergence:
+    """
+        Result of BatchSWAP.converge
+    """
+
+    def __init__(self, batch, u0, u1, p, residuals, converged):
+        self._batch = batch
+        self._u0 = u0
+        self._u1 = u1
+        self._p = p
+        # Largest score change in each iteration
+        self.residuals = residuals
+        self.converged = converged
+
+    @property
+    def iterations(self):
+        return len(self.residuals)
+
+    @property
+    def user_scores(self):
+        """
+        Confusion matrix of each user
+
+        Returns
+        -------
+        dict
+            {user id: (score 0, score 1)}
+        """
+        return {id_: (float(self._u0[i]), float(self._u1[i]))
+                for i, id_ in enumerate(self._batch.users)}
+
+    @property
+    def subject_scores(self):
+        """
+        Score of each subject with at least one classification
+
+        Returns
+        -------
+        dict
+            {subject id: score}
+        """
+        codes = np.unique(self._batch._subject)
+        return {self._batch.subjects.id(i): float(self._p[i])
+                for i in codes}
+
+    def score_export(self, thresholds=None):
+        """
+        Generate object containing subject score data
+
+        Returns
+        -------
+        swap.utils.scores.ScoreExport
+            ScoreExport
+        """
+        batch = self._batch
+        codes, ncl = np.unique(batch._subject, return_counts=True)
+
+        scores = {}
+        for code, n in zip(codes, ncl):
+            id_ = batch.subjects.id(code)
+            gold = int(batch._gold[code])
+            scores[id_] = Score(id_, gold, float(self._p[code]), ncl=int(n))
+
+        export = ScoreExport(scores, new_golds=False, thresholds=thresholds)
+        export.set_retired_flags()
+        return export
+
+    def __str__(self):
+        return 'converged %s iterations %d residual %e' % \
+            (self.converged, self.iterations,
+             self.residuals[-1] if self.residuals else 0)
+
+
+def _group_starts(groups):
+    """
+    Mask marking the first element of each run in a sorted array
+    """
+    start = np.ones(len(groups), dtype=bool)
+    start[1:] = groups[1:] != groups[:-1]
+    return start
+
+
+def _group_exclusive_cumsum(groups, values):
+    """
+    For each column of values, the sum of all earlier columns
+    belonging to the same group
+    """
+    order = np.argsort(groups, kind='stable')
+    ordered = values[:, order]
+
+    excl = np.cumsum(ordered, axis=1) - ordered
+    start = _group_starts(groups[order])
+    excl -= excl[:, np.flatnonzero(start)][:, np.cumsum(start) - 1]
+
+    out = np.empty_like(excl)
+    out[:, order] = excl
+    return out
+
+
+def _llr(annotations, u0, u1):
+    """
+    Vectorized subject.llr
+    """
+    yes = annotations == 1
+    real = np.where(yes, u1, 1 - u1)
+    bogus = np.where(yes, 1 - u0, u0)
+    return _log(real) - _log(bogus)
+
+
+def _logit(p):
+    return _log(p) - _log(1 - p)
+
+
+def _expit(x):
+    x = np.asarray(x, dtype=float)
+    e = np.exp(-np.abs(x))
+    return np.where(x >= 0, 1 / (1 + e), e / (1 + e))
+
+
+def _log(x):
+    return np.log(np.maximum(x, sys.float_info.min))
@@ -59,11 +59,20 @@ class OnlineControl(swap.control.Control):
         # return subjects whose scores have changed
         pass
 
-    def get_classifications(self):
+    def get_classifications(self, after=None):
+        """
+        Cursor over the classifications of the dump, then those
+        received from caesar
+
+        Parameters
+        ----------
+        after : int
+            Only get classifications with a greater classification_id
+        """
         logger.info('Loading dual cursors of dump and caesar classifications')
 
-        cursor1 = DB().classifications.getClassifications()
-        cursor2 = DB().caesar.getClassifications()
+        cursor1 = DB().classifications.getClassifications(after=after)
+        cursor2 = DB().caesar.getClassifications(after=after)
 
         return DualCursor(cursor1, cursor2)
 
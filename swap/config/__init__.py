@@ -43,15 +43,76 @@ fpr = 0.01
 # Setting this flag to false uses the traditional SWAP methodology
 back_update = False
 
+# Classification field that orders each subject's history, for
+# example 'classification_id' or 'time_stamp'. A classification that
+# arrives with an earlier key than the ones already in a subject's
+# history is spliced into place. None keeps the arrival order
+order_key = None
+
+# User score changes no larger than this are not pushed to the
+# subjects the user classified. See Bureau.skipped_error
+notify_tol = 0.
+
+# Record a cascade report of every process_changes, see
+# SWAP.reports and swap.agents.cascade
+instrument = False
+
+# Record the confusion matrix counts of every user after each
+# transaction with a gold label, see Bureau.traces and
+# swap.agents.traces
+user_traces = False
+
 # Operator used in controversial and consensus score calculation
 controversial_version = 'pow'
 
 
+# Recalculate stale subject ledgers in a process pool during
+# back_update. Needs the fork start method to share ledgers with
+# the worker processes.
+class parallel:
+    active = False
+    # Number of worker processes, None uses every cpu
+    processes = None
+    # Number of subjects sent to a worker at a time
+    chunksize = 1000
+
+
+# Recalculate the stale subjects nearest to the retirement thresholds
+# of the last score export first in back_update, see SWAP.thresholds.
+# Subjects more than margin (in log-odds) from both thresholds, or
+# beyond the first budget subjects, are deferred until their score is
+# read or SWAP.process_deferred runs.
+class priority:
+    active = False
+    margin = 1.
+    budget = None
+
+
+# Fixed point iteration of static SWAP, see BatchSWAP.converge.
+# Stops once no user or subject score changes by more than tol
+class fixed_point:
+    tol = 1e-6
+    max_iter = 100
+
+
+# Checkpoint files of SWAP state, see swap.utils.checkpoint.
+# Compressed checkpoints are smaller but slower to save and load
+class checkpoint:
+    compress = False
+
+
 # Activate debug mode for control
 # limits how many classifications Control will iterate through
 class control:
     debug = False
     amount = 100000
+    # Number of classifications passed to SWAP.classify_many at a time
+    batch_size = 10000
+    # With back_update, process changes after every window of this
+    # many classifications, or of this many seconds of classification
+    # time_stamp, instead of once at the end. None disables either
+    window_size = None
+    window_seconds = None
 
 
 # Database config options
@@ -12,10 +12,12 @@ Contains classes to control a SWAP instance
 
 import swap.config as config
 from swap.swap import SWAP
+from swap.replay import replay
 from swap.db import DB
 from swap.utils.classification import Classification
 from swap.utils.golds import GoldGetter
 from swap.db import Query
+import swap.utils.checkpoint as checkpoint
 
 import progressbar
 import logging
@@ -50,10 +52,17 @@ class Control:
 
         .. note::
             Iterates through the classification collection of the
-            database and proccesss each classification one at a time
-            in the order returned by the db.
+            database and passes the classifications to SWAP in batches
+            of config.control.batch_size, in the order returned by the
+            db.
+            With back_update, changes are processed at the end of every
+            window set in config.control, and once more at the end.
             Parameters like max_batch_size are hard-coded.
             Prints status.
+
+            A SWAP that already processed classifications, like one
+            from a checkpoint, only gets the classifications after its
+            last_classification, see resume.
         """
 
         if amount is None:
@@ -63,33 +72,99 @@ class Control:
         self.init_swap()
 
         # get classifications
-        cursor = self.get_classifications()
+        last = self.swap.last_classification
+        cursor = self.get_classifications(last)
 
         # loop over classification cursor to process
-        # classifications one at a time
-        logger.info('Start: SWAP Processing %d classifications', amount)
+        # classifications in batches
+        if last is None:
+            logger.info('Start: SWAP Processing %d classifications', amount)
+        else:
+            logger.info('Start: SWAP Processing classifications after %s',
+                        str(last))
+
+        if config.back_update:
+            window = Window(
+                config.control.window_size, config.control.window_seconds)
+        else:
+            window = Window()
 
         count = 0
+        batch = []
         with progressbar.ProgressBar(max_value=amount) as bar:
             bar.update(count)
             # Loop over all classifications of the query
             # Note that the exact size of the query might be lower than
             # n_classifications if not all classifications are being queried
             for cl in cursor:
-                # process classification in swap
-                cl = Classification.generate(cl)
-                self._delegate(cl)
-                bar.update(count)
+                if window.full(cl):
+                    self._delegate_many(batch)
+                    batch = []
+                    self._end_window(window, count)
+                    window.reset()
+
+                window.add(cl)
+                batch.append(Classification.generate(cl))
                 count += 1
 
+                last = _newest(last, cl)
+
                 if config.control.debug and count > config.control.amount:
                     break
 
+                if len(batch) >= config.control.batch_size:
+                    self._delegate_many(batch)
+                    batch = []
+                    bar.update(count)
+
+            self._delegate_many(batch)
+            bar.update(count)
+
+        self.swap.last_classification = last
         if config.back_update:
             logger.info('back_update active: processing changes')
             self.swap.process_changes()
         logger.info('done')
 
+    def replay(self):
+        """
+        Process all classifications in DB with a new SWAP, each
+        connected component of users and subjects in its own worker
+        process. See swap.replay.
+
+        The scores are the same as Control.run without back_update
+        windows.
+        """
+        logger.info('Start: SWAP replay by connected components')
+        last = None
+        classifications = []
+        for cl in self.get_classifications():
+            classifications.append(Classification.generate(cl))
+            last = _newest(last, cl)
+
+        self.swap = replay(classifications, self.get_gold_labels())
+        self.swap.last_classification = last
+        logger.info('done')
+
+    def resume(self, fname, amount=None):
+        """
+        Continue the SWAP of a checkpoint with the classifications
+        added to the database since it was saved
+
+        Gold labels that changed since are applied to the subjects
+        they changed for, and only the classifications after the
+        checkpoint's last_classification are read from the database.
+
+        Parameters
+        ----------
+        fname : str
+            SWAP checkpoint, see swap.utils.checkpoint
+        amount : int
+            Number of classifications, for the progress bar
+        """
+        self.swap = checkpoint.load(fname)
+        self.run(amount)
+
     def _delegate(self, cl):
         """
         Passes classification to SWAP
@@ -104,11 +179,43 @@ class Control:
         """
         self.swap.classify(cl)
 
+    def _delegate_many(self, classifications):
+        """
+        Passes a batch of classifications to SWAP, in order
+
+        Parameters
+        ----------
+        classifications : list
+            Classifications being delegated
+        """
+        self.swap.classify_many(classifications)
+
+    def _end_window(self, window, count):
+        """
+        Process the changes of a back_update window
+
+        Purpose is to allow subclasses to do something with the scores
+        between windows
+
+        Parameters
+        ----------
+        window : Window
+            Window that just ended
+        count : int
+            Number of classifications processed so far
+        """
+        logger.info('Processing changes of %d classifications, %d total',
+                    window.count, count)
+        self.swap.process_changes(with_bar=False)
+
     def init_swap(self):
         """
         Create a new SWAP instance, also passes SWAP the appropriate
         gold labels.
 
+        An existing SWAP keeps its gold labels, and only the ones that
+        changed are updated.
+
         Returns
         -------
         SWAP
@@ -133,16 +240,21 @@ class Control:
         return self.gold_getter.golds
 
     @staticmethod
-    def get_classifications():
+    def get_classifications(after=None):
         """
         Get the cursor containing classifications from db
 
+        Parameters
+        ----------
+        after : int
+            Only get classifications with a greater classification_id
+
         Returns
         -------
         swap.db.Cursor
             Cursor with classifications
         """
-        return DB().classifications.getClassifications()
+        return DB().classifications.getClassifications(after=after)
 
     def getSWAP(self):
         """
@@ -208,3 +320,72 @@ class MetaDataControl(Control):
         classifications = DB().classifications.aggregate(q.build())
 
         return classifications
+
+
+class Window:
+    """
+    Micro-batch window of classifications for back_update.
+
+    A window is full once it holds size classifications, or once a
+    classification's time_stamp is at least seconds after the first
+    one in the window. Without size or seconds it is never full.
+    """
+
+    def __init__(self, size=None, seconds=None):
+        self.size = size
+        self.seconds = seconds
+
+        self.count = 0
+        self.start = None
+
+    def full(self, cl):
+        """
+        Check if a classification belongs in the next window
+
+        Parameters
+        ----------
+        cl : dict
+            classification from the database
+        """
+        if self.count == 0:
+            return False
+
+        if self.size is not None and self.count >= self.size:
+            return True
+
+        if self.seconds is not None and self.start is not None:
+            time = cl.get('time_stamp')
+            if time is not None and \
+                    _seconds(time - self.start) >= self.seconds:
+                return True
+
+        return False
+
+    def add(self, cl):
+        if self.start is None:
+            self.start = cl.get('time_stamp')
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+        self.start = None
+
+
+def _newest(last, cl):
+    """
+    Greater of last and the classification_id of a classification
+    from the database
+    """
+    id_ = cl.get('classification_id')
+    if id_ is None or (last is not None and last >= id_):
+        return last
+    return id_
+
+
+def _seconds(delta):
+    """
+    Length of a time_stamp difference in seconds
+    """
+    if hasattr(delta, 'total_seconds'):
+        return delta.total_seconds()
+    return delta
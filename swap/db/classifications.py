@@ -37,7 +37,7 @@ class Classifications(Collection):
 
     #######################################################################
 
-    def getClassifications(self, query=None, **kwargs):
+    def getClassifications(self, query=None, after=None, **kwargs):
         """
         Returns all classifications.
 
@@ -48,6 +48,8 @@ class Classifications(Collection):
         ----------
         query : list
             Use a custom query instead
+        after : int
+            Only return classifications with a greater classification_id
         **kwargs
             Any other variables to pass to mongo, like
             allowDiskUse, batchSize, etc
@@ -63,12 +65,17 @@ class Classifications(Collection):
         #     {'$project': {'user_id': 1, 'subject_id': 1,
         #                   'annotation': 1, 'session_id': 1}}
         # ]
+        match = {'seen_before': False}
+        if after is not None:
+            match['classification_id'] = {'$gt': after}
+
         query = [
-            {'$match': {'seen_before': False}},
+            {'$match': match},
             {'$sort': {'classification_id': 1}},
             # {'$match': {'classification_id': {'$lt': 25000000}}},
             {'$project': {'user_id': 1, 'subject_id': 1,
-                          'annotation': 1, 'session_id': 1}}
+                          'annotation': 1, 'session_id': 1,
+                          'time_stamp': 1, 'classification_id': 1}}
         ]
 
         # set batch size as specified in kwargs,
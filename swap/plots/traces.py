@@ -6,26 +6,21 @@ import matplotlib.pyplot as plt
 def plot_user(swap, fname):
     """
         Generate a trace plot of the average of each user's scores
-        change with each classification
+        change with each classification of a gold subject
+
+        Needs the user traces of config.user_traces
 
         Args:
             fname: Save the plot to file.
                    Shows the plot instead if None
     """
-    export = swap.export()
+    traces = swap.users.traces
+    if traces is None:
+        raise ValueError('SWAP has no user traces, see config.user_traces')
+
     data = []
-    for item in export['users'].values():
-        h0 = item['score_0_history']
-        h1 = item['score_1_history']
-
-        h = []
-        for i, v0 in enumerate(h0):
-            if len(h1) <= i:
-                v1 = h1[-1]
-            else:
-                v1 = h1[i]
-            h.append((v0 + v1) / 2)
-        data.append((1, h))
+    for _, u0, u1 in traces.user_scores():
+        data.append((1, list((u0 + u1) / 2)))
 
     plot_tracks(data, 'User Combined Tracks', fname, scale='log')
 
@@ -68,7 +63,7 @@ def plot_tracks(data, title, fname, dpi=300, scale='log'):
             break
 
         ax.plot(
-            [0.01] + history,
+            [0.01] + list(history),
             range(len(history) + 1),
             "-",
             color=cmap[gold],
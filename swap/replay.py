@@ -0,0 +1,178 @@
+################################################################
+"""
+    Replays a stream of classifications with SWAP, one connected
+    component of the user-subject graph at a time.
+
+    Users and subjects that share no classifications, directly or
+    through other agents, never affect each other's scores. Each
+    component is processed by its own SWAP in a worker process, and
+    the agents of every component are merged into one SWAP that is the
+    same as processing the whole stream serially.
+"""
+
+from swap.swap import SWAP
+from swap.agents.graph import components
+from swap.utils.classification import Classification
+from swap.utils.codes import Codes
+
+import swap.config as config
+
+import multiprocessing
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Classifications and gold labels being replayed, inherited by
+# forked worker processes
+_job = None
+
+
+def replay(classifications, golds=None, processes=None):
+    """
+    Process classifications with SWAP, each connected component
+    in parallel.
+
+    Same as a new SWAP with these gold labels processing the
+    classifications with classify_many, followed by process_changes
+    when back_update is active. Changes are processed once at the end,
+    there are no back_update windows.
+
+    Falls back to the serial run when fork is not available or there
+    is only one component.
+
+    Parameters
+    ----------
+    classifications : iterable
+        Classification objects, or dicts accepted by
+        Classification.generate
+    golds : dict
+        (subject id : gold label) gold labels
+    processes : int
+        Number of worker processes, default config.parallel.processes
+
+    Returns
+    -------
+    swap.swap.SWAP
+    """
+    global _job
+
+    if golds is None:
+        golds = {}
+    if processes is None:
+        processes = config.parallel.processes
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    classifications = [
+        cl if isinstance(cl, Classification) else Classification.generate(cl)
+        for cl in classifications]
+
+    # Codes in the order a serial SWAP would create the agents:
+    # gold subjects first, then every agent when first classified
+    users = Codes()
+    subjects = Codes()
+    for id_ in golds:
+        subjects.code(id_)
+
+    user_codes = np.array(
+        [users.code(cl.user) for cl in classifications], dtype=np.int64)
+    subject_codes = np.array(
+        [subjects.code(cl.subject) for cl in classifications], dtype=np.int64)
+
+    count, user_labels, subject_labels = components(
+        user_codes, subject_codes, len(users), len(subjects))
+    logger.info('Replaying %d classifications in %d components',
+                len(classifications), count)
+
+    if count < 2 or processes < 2 or \
+            'fork' not in multiprocessing.get_all_start_methods():
+        _job = (classifications, golds)
+        try:
+            return _run((np.arange(len(classifications)), list(golds)))
+        finally:
+            _job = None
+
+    # Chunk of every component, a few chunks per process to even
+    # out their sizes
+    chunk_of = _balance(
+        np.bincount(subject_labels[subject_codes], minlength=count),
+        min(count, processes * 4))
+    subject_chunks = chunk_of[subject_labels]
+
+    cl_chunks = subject_chunks[subject_codes]
+    gold_chunks = subject_chunks[[subjects.get(id_) for id_ in golds]]
+    gold_ids = np.array(list(golds), dtype=object)
+
+    tasks = []
+    for chunk in range(chunk_of.max() + 1):
+        tasks.append((
+            np.flatnonzero(cl_chunks == chunk),
+            list(gold_ids[gold_chunks == chunk])))
+
+    _job = (classifications, golds)
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes, initializer=_init_worker) as pool:
+            parts = pool.map(_run, tasks)
+    finally:
+        _job = None
+
+    swap = SWAP()
+    swap.users.merge([part.users for part in parts], users)
+    swap.subjects.merge([part.subjects for part in parts], subjects)
+
+    # Classification edges in the order they were first added
+    key = user_codes * len(subjects) + subject_codes
+    _, first = np.unique(key, return_index=True)
+    first.sort()
+
+    annotations = [classifications[i].annotation for i in first]
+    swap.graph.extend(user_codes[first], subject_codes[first], annotations)
+
+    return swap
+
+
+def _balance(sizes, n):
+    """
+    Assign components to n chunks, largest first to the chunk with
+    the fewest classifications so far
+
+    Returns
+    -------
+    np.ndarray
+        chunk of every component
+    """
+    chunk_of = np.zeros(len(sizes), dtype=np.int64)
+    loads = np.zeros(n, dtype=np.int64)
+
+    for component in np.argsort(-sizes, kind='stable'):
+        chunk = int(np.argmin(loads))
+        chunk_of[component] = chunk
+        loads[chunk] += sizes[component]
+
+    return chunk_of
+
+
+def _init_worker():
+    # Workers can't start process pools of their own
+    config.parallel.active = False
+
+
+def _run(task):
+    """
+    Worker task: replay the classifications and gold labels of
+    some components with a SWAP of their own
+    """
+    classifications, golds = _job
+    indices, gold_ids = task
+
+    swap = SWAP()
+    swap.set_gold_labels(
+        {id_: golds[id_] for id_ in gold_ids}, with_bar=False)
+    swap.classify_many(classifications[i] for i in indices)
+
+    if config.back_update:
+        swap.process_changes(with_bar=False)
+
+    return swap
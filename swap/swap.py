@@ -10,11 +10,14 @@
 """
 
 from swap.agents.bureau import Bureau
-from swap.agents.subject import Subject
+from swap.agents.subject import Subject, logit
 from swap.agents.user import User
+from swap.agents.graph import Graph
+import swap.agents.parallel as parallel
+from swap.agents.cascade import Report
 from swap.utils.stats import Stats
 from swap.utils.scores import ScoreExport, Score
-from swap.utils.history import History, HistoryExport
+from swap.utils.history import History, HistoryExport, HistoryStore
 from swap.utils.classification import Classification
 
 from swap.db import DB
@@ -22,6 +25,8 @@ from swap.db import DB
 import swap.config as config
 
 import progressbar
+import contextlib
+import copy
 import logging
 
 logger = logging.getLogger(__name__)
@@ -57,12 +62,28 @@ class SWAP:
         """
 
         # initialize bureaus to manage user / subject agents
-        self.users = Bureau(User)
-        self.subjects = Bureau(Subject)
+        self.users = Bureau(User, traces=config.user_traces)
+        self.subjects = Bureau(Subject, index=True)
+        # classifications as edges between user and subject codes
+        self.graph = Graph()
 
         self._history = None
         self._history_stale = True
 
+        # Retirement thresholds (bogus, real) of the last score export,
+        # used to prioritize subjects in process_changes
+        self.thresholds = None
+
+        # Gold labels of the subjects, see _gold_labels
+        self._golds = None
+
+        # classification_id of the newest classification read from the
+        # database, Control.run continues after it
+        self.last_classification = None
+
+        # Cascade report of every process_changes with config.instrument
+        self.reports = []
+
         # Directive to update - if True, then a volunteer agent's posterior
         # probability of containing an interesting object will be updated
         # whenever an expertly classified "gold standard" subject is
@@ -110,14 +131,143 @@ class SWAP:
         subject = self.subjects.get(cl.subject)
         user = self.users.get(cl.user)
 
-        if not config.back_update:
+        self._classify(cl, subject, user)
+
+        # if not config.back_update:
+        #     self.process_changes()
+
+    def classify_many(self, classifications):
+        """
+            Process classifications in order
+
+            Same result as calling classify on each classification, but
+            each user and subject is looked up once per call.
+
+            Parameters
+            ----------
+            classifications : iterable
+                Classification objects, or dicts accepted by
+                Classification.generate
+
+            Returns
+            -------
+            int
+                Number of classifications processed
+        """
+        self._history_stale = True
+
+        users = {}
+        subjects = {}
+
+        count = 0
+        for cl in classifications:
+            if not isinstance(cl, Classification):
+                cl = Classification.generate(cl)
+
+            user = users.get(cl.user)
+            if user is None:
+                user = users[cl.user] = self.users.get(cl.user)
+
+            subject = subjects.get(cl.subject)
+            if subject is None:
+                subject = subjects[cl.subject] = self.subjects.get(cl.subject)
+
+            self._classify(cl, subject, user)
+            count += 1
+
+        return count
+
+    def _classify(self, cl, subject, user):
+        # A user ledger with no pending changes already has its
+        # current score
+        if not config.back_update and user.ledger.stale:
             user.ledger.recalculate()
 
+        if user.id in subject.ledger:
+            # The user classified the subject before. The classification
+            # that comes first by key is kept, otherwise the first one
+            # to arrive
+            key = subject.ledger.get(user.id).key
+            if cl.key is None or key is None or not cl.key < key:
+                return
+            self._retract(user.id, [subject.id])
+
         subject.classify(cl, user)
         user.classify(cl, subject)
 
-        # if not config.back_update:
-        #     self.process_changes()
+        self.graph.add(
+            self.users.code(user.id), self.subjects.code(subject.id),
+            cl.annotation)
+
+    def retract(self, cl):
+        """
+            Remove a classification
+
+            Takes the transaction out of the subject and user ledgers.
+            Run process_changes to rescore the affected users and
+            subjects.
+
+            Parameters
+            ----------
+            cl : swap.utils.classification.Classification, dict
+                Classification to be removed
+
+            Returns
+            -------
+            bool
+                False if there was no such classification
+        """
+        if not isinstance(cl, Classification):
+            cl = Classification.generate(cl)
+
+        return self._retract(cl.user, [cl.subject]) > 0
+
+    def retract_user(self, user_id):
+        """
+            Remove every classification of a user, and the user
+
+            Run process_changes to rescore the affected subjects.
+
+            Parameters
+            ----------
+            user_id
+                id of the user
+
+            Returns
+            -------
+            int
+                Number of classifications removed
+        """
+        user = self.users.peek(user_id)
+        if user is None:
+            return 0
+
+        count = self._retract(user_id, [t.id for t in user.ledger])
+        self.users.remove(user_id)
+        return count
+
+    def _retract(self, user_id, subject_ids):
+        self._history_stale = True
+
+        user = self.users.get(user_id, make_new=False)
+        if user is None:
+            return 0
+
+        removed = []
+        for id_ in subject_ids:
+            subject = self.subjects.get(id_, make_new=False)
+            if subject is None or user_id not in subject.ledger:
+                continue
+
+            subject.ledger.remove(user_id)
+            user.ledger.remove(id_)
+            removed.append(self.subjects.code(id_))
+
+        self.graph.remove(self.users.code(user_id), removed)
+        logger.debug('Retracted %d classifications of user %s',
+                     len(removed), str(user_id))
+
+        return len(removed)
 
     # def _classify_user(self, cl):
     #     """
@@ -148,7 +298,7 @@ class SWAP:
     #     # process the classification
     #     subject.classify(cl, user)
 
-    def process_changes(self):
+    def process_changes(self, with_bar=None):
         """
         Process changes to agent ledgers
 
@@ -165,35 +315,79 @@ class SWAP:
         of this change.
 
         Then any subject agent which is connected to a user whose score has
-        changed recalculates its score.
+        changed recalculates its score. With config.priority active and
+        known thresholds, only the subjects nearest to the thresholds are
+        recalculated, see process_deferred.
+
+        With config.instrument, each call adds a cascade report to
+        SWAP.reports.
+
+        Parameters
+        ----------
+        with_bar : bool
+            Show progress bars, default config.back_update
         """
+        if with_bar is None:
+            with_bar = config.back_update
 
-        with_bar = config.back_update
+        report = Report() if config.instrument else None
+
+        def phase(name):
+            if report is None:
+                return contextlib.nullcontext()
+            return report.phase(name)
 
         # TODO make sure notify_agents is called on each ledger
 
-        def run(bureau):
+        def run(bureau, in_parallel=False, priority=None):
+            def process(bar=None):
+                if priority is not None:
+                    deferred = bureau.process_priority(
+                        priority, config.priority.margin,
+                        config.priority.budget, bar)
+                    logger.info('Deferred %d stale %ss', deferred,
+                                bureau.agent_type.class_name)
+                elif in_parallel:
+                    parallel.process_changes(bureau, bar)
+                else:
+                    bureau.process_changes(bar)
+
             if with_bar:
                 name = bureau.agent_type.class_name
                 logger.info('processing %s score changes', name)
                 with progressbar.ProgressBar(
                         max_value=bureau.calculate_changes()) as bar:
                     bar.update(0)
-                    bureau.process_changes(bar)
+                    process(bar)
                 logger.info('done')
 
             else:
-                bureau.process_changes()
+                process()
 
         logger.info('Notifying user agents of subject changes')
-        self.subjects.notify_changes(self.users)
+        with phase('notify users'):
+            self.subjects.notify_changes(self.users, self.graph.users_of)
 
-        run(self.users)
+        with phase('recalculate users'):
+            run(self.users)
 
         logger.info('Notifying subject agents of user changes')
-        self.users.notify_changes(self.subjects)
+        with phase('notify subjects'):
+            self.users.notify_changes(self.subjects, self.graph.subjects_of)
 
-        run(self.subjects)
+        skipped = self.users.skipped_ids()
+        if len(skipped) > 0:
+            logger.info('%d users held back score changes up to %e',
+                        len(skipped), self.users.skipped_error())
+
+        # Subject ledgers only depend on their own transactions
+        # once user scores are fixed, so they can run in parallel
+        with phase('recalculate subjects'):
+            run(self.subjects, config.parallel.active, self._priority())
+
+        if report is not None:
+            self.reports.append(report)
+            logger.info('%s', report)
 
         # logger.info('processing user score changes')
         # with progressbar.ProgressBar(
@@ -209,6 +403,54 @@ class SWAP:
         #     self.subjects.process_changes(bar)
         # logger.info('done')
 
+    def process_deferred(self, limit=None):
+        """
+        Recalculate subjects deferred by process_changes, nearest to
+        the retirement thresholds first. Meant for idle time, deferred
+        subjects are otherwise recalculated when their score is read.
+
+        Parameters
+        ----------
+        limit : int
+            Most subjects to recalculate, default all of them
+
+        Returns
+        -------
+        int
+            Number of subjects still deferred
+        """
+        ids = self.subjects.deferred_ids()
+        if len(ids) == 0:
+            return 0
+
+        priority = self._priority(force=True)
+        return self.subjects.process_priority(priority, budget=limit, ids=ids)
+
+    def _priority(self, force=False):
+        """
+        Priority of a stale subject in process_changes: the log-odds
+        distance of its last score to the nearest retirement threshold.
+        Subjects without a score go first.
+
+        None unless config.priority is active and there are thresholds
+        """
+        if not force and not config.priority.active:
+            return None
+        if self.thresholds is None:
+            return (lambda subject: 0.) if force else None
+
+        bounds = [logit(t) for t in self.thresholds]
+
+        def distance(subject):
+            score = subject.ledger._score
+            if score is None:
+                return 0.
+
+            score = logit(score)
+            return min(abs(score - bound) for bound in bounds)
+
+        return distance
+
     # def getUserAgent(self, user_id):
     #     """
     #         Get a User agent from the Bureau. Creates a new one
@@ -264,30 +506,131 @@ class SWAP:
             This function is for defining all subjects that are
             gold on initialization
 
+            Only the subjects whose label differs from the current
+            gold labels are changed, see update_gold_labels.
+
             Parameters
             ----------
             golds : dict
                 (subject id : gold label) Mapping of subject to its gold label
         """
-        # Removes gold label from all subjects not in the golds list
         logger.info('Processing gold labels')
-        if with_bar:
-            bar = progressbar.ProgressBar(max_value=len(self.subjects))
-        for subject in self.subjects:
-            if subject.id not in golds:
-                subject.set_gold_label(-1, self.subjects, self.users)
+        current = self._gold_labels()
 
-            if with_bar:
-                bar.update(bar.value + 1)
+        # Removes gold label from all subjects not in the golds list
+        changes = {id_: -1 for id_ in current if id_ not in golds}
         # Assigns the new gold label to subjects in the list
-        # Also tells the Bureau to make a new subject agent if it
-        # doesn't exist yet
+        # Also makes a new subject agent if it doesn't exist yet
         for id_, gold in golds.items():
-            subject = self.subjects.get(id_, make_new=True)
-            subject.set_gold_label(gold, self.subjects, self.users)
+            if current.get(id_, -1) != gold or id_ not in self.subjects:
+                changes[id_] = gold
+
+        self.update_gold_labels(changes, with_bar)
 
         # self.process_changes()
 
+    def update_gold_labels(self, changes, with_bar=False):
+        """
+            Change the gold labels of some subjects, and leave the
+            others as they are
+
+            All labels are set first, then the users that classified a
+            relabelled subject are notified, using the classification
+            graph to find them.
+
+            Parameters
+            ----------
+            changes : dict
+                (subject id : gold label) New gold labels, -1 removes
+                a subject's gold label
+        """
+        golds = self._gold_labels()
+        logger.info('Changing %d gold labels', len(changes))
+        if with_bar:
+            bar = progressbar.ProgressBar(max_value=len(changes))
+
+        # Subjects are only fetched with get when their label changes,
+        # so a fork only copies those subjects
+        changed = []
+        for id_, gold in changes.items():
+            subject = self.subjects.peek(id_)
+            if subject is None or subject.gold != gold:
+                subject = self.subjects.get(id_, make_new=True)
+                if subject.gold != gold:
+                    subject.set_gold_label(gold)
+                    changed.append(subject)
+
+            if gold == -1:
+                golds.pop(id_, None)
+            else:
+                golds[id_] = gold
+
+            if with_bar:
+                bar.update(bar.value + 1)
+
+        for subject in changed:
+            codes = self.graph.users_of(self.subjects.code(subject.id))
+            subject.ledger.notify_agents(self.subjects, self.users, codes)
+
+    def _gold_labels(self):
+        """
+            Gold labels as of the last set_gold_labels, kept up to date
+            by update_gold_labels. Found from the subjects the first
+            time
+        """
+        if self._golds is None:
+            self._golds = self.golds
+        return self._golds
+
+    def __setstate__(self, state):
+        if 'graph' in state:
+            self.__dict__.update(state)
+            return
+
+        # Pickled before agents had codes and classifications were
+        # kept in a graph. Start from a new SWAP and add the agents
+        # and their classifications to it
+        self.__init__()
+        for agent in state['users']._agents.values():
+            self.users.add(agent)
+        for agent in state['subjects']._agents.values():
+            self.subjects.add(agent)
+
+        for user in self.users:
+            code = self.users.code(user.id)
+            for t in sorted(user.ledger, key=lambda t: t.order):
+                self.graph.add(code, self.subjects.code(t.id), t.annotation)
+
+    def fork(self):
+        """
+            Copy of this SWAP for what-if runs, like trying a different
+            gold set.
+
+            The fork shares users, subjects and classifications with
+            this instance, and each side copies an agent the first time
+            it changes it. Changing either instance does not affect the
+            other.
+
+            Forking copies the bureaus' tables, see Bureau.fork, so it
+            costs O(N) in the number of agents, but no agent or edge is
+            copied until it changes.
+
+            Returns
+            -------
+            SWAP
+        """
+        child = copy.copy(self)
+        child.users = self.users.fork()
+        child.subjects = self.subjects.fork()
+        child.graph = self.graph.fork()
+
+        child._history = None
+        child._history_stale = True
+        child.reports = list(self.reports)
+        if self._golds is not None:
+            child._golds = dict(self._golds)
+        return child
+
     @property
     def golds(self):
         """
@@ -355,6 +698,7 @@ class SWAP:
 
         retired = self.history.score_export(thresholds, all_golds=True)
         retired.set_retired_flags()
+        self.thresholds = retired.thresholds
 
         return retired
 
@@ -370,6 +714,9 @@ class SWAP:
         """
         Genearte object containing subject score history
 
+        The score lists are views of the subject ledgers' traces and
+        follow later changes to the scores.
+
         Returns
         -------
         swap.utils.history.HistoryExport
@@ -377,23 +724,51 @@ class SWAP:
         """
 
         logger.info('Generating history export')
+        self.process_deferred()
+
         history = {}
         for subject in self.subjects:
             if len(subject.ledger) == 0:
                 continue
 
-            # Generate list of subject scores
-            scores = [config.p0]
-            for t in sorted(subject.ledger, key=lambda t: t.order):
-                scores.append(t.score)
-
-            # Create History object
+            # Score histories are copies of the ledgers' traces, only
+            # their out of date ends are recalculated
             id_ = subject.id
-            history[id_] = History(id_, subject.gold, scores)
+            history[id_] = History(id_, subject.gold, subject.ledger.trace())
 
         logger.debug('done')
         return HistoryExport(history)
 
+    def history_store(self, delta=False):
+        """
+        Copy the subject score histories to one array
+
+        Parameters
+        ----------
+        delta : bool
+            Delta encode the scores
+
+        Returns
+        -------
+        swap.utils.history.HistoryStore
+        """
+        logger.info('Generating history store')
+        self.process_deferred()
+
+        ids = []
+        golds = []
+        traces = []
+        for subject in self.subjects:
+            if len(subject.ledger) == 0:
+                continue
+
+            ids.append(subject.id)
+            golds.append(subject.gold)
+            traces.append(subject.ledger.trace())
+
+        logger.debug('done')
+        return HistoryStore.from_traces(ids, golds, traces, delta)
+
     def debug_str(self):
         s = ''
         for u in self.users:
@@ -23,6 +23,8 @@ from swap.swap import SWAP
 from swap.control import Control
 from swap.ui.ui import Interface
 from swap.ui.utils import load_pickle, write_log
+import swap.utils.checkpoint as checkpoint
+import swap.config as config
 
 import os
 import csv
@@ -60,12 +62,28 @@ class SWAPInterface(Interface):
         parser.add_argument(
             '--load', nargs=1,
             metavar='file',
-            help='Load a pickled SWAP object')
+            help='Load a SWAP checkpoint or a pickled object')
 
         parser.add_argument(
             '--run', action='store_true',
             help='Run the SWAP algorithm')
 
+        parser.add_argument(
+            '--resume', nargs=1,
+            metavar='file',
+            help='With --run, continue the SWAP of a checkpoint with the '
+                 'classifications added since it was saved')
+
+        parser.add_argument(
+            '--components', action='store_true',
+            help='With --run, process each connected component of users '
+                 'and subjects in its own process, see config.parallel')
+
+        parser.add_argument(
+            '--cascade', action='store_true',
+            help='With --run, record and print what each back_update '
+                 'process_changes did, see config.instrument')
+
         parser.add_argument(
             '--train', nargs=1,
             metavar='n',
@@ -89,10 +107,11 @@ class SWAPInterface(Interface):
             metavar='file',
             help='Generate subject track plot and output to file')
 
-        # parser.add_argument(
-        #     '--utraces', nargs=1,
-        #     metavar='file',
-        #     help='Generate user track plots and output to file')
+        parser.add_argument(
+            '--utraces', nargs=1,
+            metavar='file',
+            help='Generate user track plots and output to file, '
+                 'see config.user_traces')
 
         parser.add_argument(
             '--user', nargs=1,
@@ -151,6 +170,11 @@ class SWAPInterface(Interface):
         parser.add_argument(
             '--test-reorder', action='store_true')
 
+        parser.add_argument(
+            '--converge', action='store_true',
+            help='Iterate static SWAP over all classifications until '
+                 'scores stop changing, see config.fixed_point')
+
         parser.add_argument(
             '--scores-from-csv', nargs=1,
             metavar='file',
@@ -166,6 +190,11 @@ class SWAPInterface(Interface):
             metavar='file',
             help='Export user scores to csv')
 
+        parser.add_argument(
+            '--history-store', nargs=1,
+            metavar='file',
+            help='Save subject score histories as a history store')
+
     def call(self, args):
         swap = None
         scores = None
@@ -201,14 +230,18 @@ class SWAPInterface(Interface):
                 fname = self.f(args.user[0])
                 plots.plot_user_cm(swap, fname)
 
-            # if args.utraces:
-            #     fname = self.f(args.user[0])
-            #     plots.traces.plot_user(swap, fname)
+            if args.utraces:
+                fname = self.f(args.utraces[0])
+                plots.traces.plot_user(swap, fname)
 
             if args.log:
                 fname = self.f(args.log[0])
                 write_log(swap, fname)
 
+            if args.cascade:
+                for i, report in enumerate(swap.reports):
+                    print('process_changes %d\n%s' % (i, report))
+
             if args.stats:
                 s = swap.stats_str()
                 print(s)
@@ -225,10 +258,21 @@ class SWAPInterface(Interface):
             if args.test_reorder:
                 self.reorder_classifications(swap)
 
+            if args.converge:
+                from swap.batch import BatchSWAP
+                result = BatchSWAP.from_swap(swap).converge()
+                print(result)
+                logger.info(result)
+                scores = result.score_export()
+
             if args.export_user_scores:
                 fname = self.f(args.export_user_scores[0])
                 self.export_user_scores(swap, fname)
 
+            if args.history_store:
+                fname = self.f(args.history_store[0])
+                swap.history_store().save(fname)
+
         if scores is not None:
             if args.save_scores:
                 fname = self.f(args.save_scores[0])
@@ -266,6 +310,11 @@ class SWAPInterface(Interface):
         """
         control = self.getControl()
 
+        if args.cascade:
+            config.instrument = True
+        if args.utraces:
+            config.user_traces = True
+
         # Random test/train split
         if args.train:
             train = int(args.train[0])
@@ -289,7 +338,12 @@ class SWAPInterface(Interface):
         #     consensus = int(args.extreme_min[1])
         #     control.gold_getter.extreme_min(controversial, consensus)
 
-        control.run()
+        if args.components:
+            control.replay()
+        elif args.resume:
+            control.resume(args.resume[0])
+        else:
+            control.run()
         swap = control.getSWAP()
 
         return swap
@@ -307,20 +361,9 @@ class SWAPInterface(Interface):
                 ids = [t.id for t in subject.ledger]
                 ids = list(sorted(ids, key=lambda item: random.random()))
 
-                previous = None
-                for i, id_ in enumerate(ids):
-                    t = subject.ledger.get(id_)
-                    t.order = i
-                    t.right = None
-
-                    if previous is None:
-                        t.left = None
-                    else:
-                        previous.right = t
-                        t.left = previous
-
+                subject.ledger.reorder(ids)
+                for id_ in ids:
                     subject.ledger.update(id_)
-                    previous = t
 
                 n += 1
         print(n)
@@ -385,7 +428,19 @@ class SWAPInterface(Interface):
             with open(self.f(m_fname), 'w') as file:
                 file.write(manifest)
 
-        super().save(obj, fname)
+        if isinstance(obj, SWAP):
+            checkpoint.save(obj, fname)
+        else:
+            super().save(obj, fname)
+
+    @staticmethod
+    def load(fname):
+        """
+        Load a SWAP checkpoint, or any other pickled object
+        """
+        if checkpoint.is_checkpoint(fname):
+            return checkpoint.load(fname)
+        return load_pickle(fname)
 
     @staticmethod
     def getControl():
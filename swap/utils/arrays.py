@@ -0,0 +1,187 @@
+################################################################
+"""
+    Files of named numpy arrays, used by SWAP checkpoints and the
+    score history store
+
+    File layout:
+
+        magic        8 bytes, the kind of file
+        uint64       length of the header
+        header       JSON: the caller's fields, and the dtype, shape
+                     and position of every array
+        arrays       each starting at a multiple of ALIGN bytes from
+                     the start of the data, raw or zlib compressed
+
+    Raw arrays can be memory mapped when reading.
+"""
+
+import numpy as np
+import json
+import struct
+import zlib
+
+ALIGN = 64
+
+
+def write(fname, magic, header, arrays, compress=False):
+    """
+    Write arrays to a file
+
+    Parameters
+    ----------
+    fname : str
+    magic : bytes
+        8 bytes at the start of the file
+    header : dict
+        JSON serializable fields stored with the arrays
+    arrays : dict
+        (name : np.ndarray) arrays
+    compress : bool
+        zlib compress the arrays
+    """
+    header = dict(header)
+    header['compress'] = compress
+    header['arrays'] = {}
+
+    # Array data, with each array's position in it
+    blobs = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        data = array.tobytes()
+        if compress:
+            data = zlib.compress(data)
+
+        header['arrays'][name] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'offset': offset,
+            'size': len(data)}
+
+        blobs.append(data)
+        padding = align(len(data)) - len(data)
+        blobs.append(b'\0' * padding)
+        offset += len(data) + padding
+
+    head = json.dumps(header).encode()
+    start = align(len(magic) + 8 + len(head))
+
+    with open(fname, 'wb') as file:
+        file.write(magic)
+        file.write(struct.pack('<Q', len(head)))
+        file.write(head)
+        file.write(b'\0' * (start - file.tell()))
+        for data in blobs:
+            file.write(data)
+
+
+def read(fname, magic, mmap=True):
+    """
+    Read the header of a file, the arrays are read when accessed
+
+    Parameters
+    ----------
+    fname : str
+    magic : bytes
+        8 bytes the file has to start with
+    mmap : bool
+        Memory map raw arrays instead of reading them
+
+    Returns
+    -------
+    (dict, Arrays)
+        header and arrays
+    """
+    with open(fname, 'rb') as file:
+        if file.read(len(magic)) != magic:
+            raise ValueError('%s is not a %s file' % (fname, magic.decode()))
+
+        length, = struct.unpack('<Q', file.read(8))
+        header = json.loads(file.read(length).decode())
+
+    start = align(len(magic) + 8 + length)
+    return header, Arrays(fname, header, start, mmap)
+
+
+def has_magic(fname, magic):
+    with open(fname, 'rb') as file:
+        return file.read(len(magic)) == magic
+
+
+def encode_ids(arrays, name, ids):
+    """
+    Store agent ids as name.ids
+
+    Returns
+    -------
+    str
+        'int' or 'str' when they all are, otherwise 'mixed' with ids
+        as strings and a flag of the ones that are ints
+    """
+    if all(type(id_) is int for id_ in ids):
+        arrays[name + '.ids'] = np.array(ids, dtype=np.int64)
+        return 'int'
+
+    arrays[name + '.ids'] = np.array([str(id_) for id_ in ids], dtype=str)
+    if all(type(id_) is str for id_ in ids):
+        return 'str'
+
+    if not all(type(id_) in (int, str) for id_ in ids):
+        raise TypeError('Can\'t save agent ids of type %s' %
+                        str({type(id_) for id_ in ids}))
+
+    arrays[name + '.id_is_int'] = np.array(
+        [type(id_) is int for id_ in ids], dtype=bool)
+    return 'mixed'
+
+
+def decode_ids(arrays, name, kind):
+    """
+    Agent ids stored by encode_ids, as a list
+    """
+    ids = arrays[name + '.ids'].tolist()
+    if kind == 'mixed':
+        is_int = arrays[name + '.id_is_int'].tolist()
+        ids = [int(id_) if flag else id_ for id_, flag in zip(ids, is_int)]
+    return ids
+
+
+def align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+class Arrays:
+    """
+    Reads the arrays of a file by name
+    """
+
+    def __init__(self, fname, header, start, mmap):
+        self.fname = fname
+        self.header = header
+        self.start = start
+        self.compress = header.get('compress', False)
+        self.mmap = mmap and not self.compress
+
+    def __contains__(self, name):
+        return name in self.header['arrays']
+
+    def __getitem__(self, name):
+        entry = self.header['arrays'][name]
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        offset = self.start + entry['offset']
+
+        if entry['size'] == 0:
+            return np.zeros(shape, dtype=dtype)
+
+        if self.mmap:
+            return np.memmap(
+                self.fname, dtype=dtype, mode='r',
+                offset=offset, shape=shape)
+
+        with open(self.fname, 'rb') as file:
+            file.seek(offset)
+            data = file.read(entry['size'])
+        if self.compress:
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
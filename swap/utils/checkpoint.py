@@ -0,0 +1,530 @@
+################################################################
+"""
+    Checkpoint files of SWAP state
+
+    A checkpoint keeps the bureaus, ledgers, transactions and the
+    classification graph as flat numpy arrays, one entry per agent or
+    per transaction, instead of pickling the object graph. The
+    transaction columns are copied from and to the columns of the ledgers,
+    and loading builds the agents straight from the arrays.
+
+    The file is an array file, see swap.utils.arrays, starting with
+    b'SWAPCKPT'. The ledgers keep their own arrays, so loading reads
+    the arrays rather than memory mapping them.
+"""
+
+from swap.swap import SWAP
+from swap.agents.subject import Subject
+from swap.agents.subject import Transaction as SubjectTransaction
+from swap.agents.user import User
+from swap.agents.user import Transaction as UserTransaction
+from swap.agents.traces import UserTraces
+
+import swap.utils.arrays as array_file
+import swap.config as config
+
+from array import array
+import numpy as np
+import datetime
+import gc
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SWAPCKPT'
+# Format version, bumped when the arrays change meaning
+VERSION = 1
+
+# Gold labels and user transaction golds that are None
+_NONE = -2
+
+
+def save(swap, fname, compress=None):
+    """
+    Save a SWAP to a checkpoint file
+
+    Cascade reports and cached exports are not saved. A fork is saved
+    as an independent SWAP.
+
+    Parameters
+    ----------
+    swap : swap.swap.SWAP
+    fname : str
+    compress : bool
+        zlib compress the arrays, default config.checkpoint.compress
+    """
+    if compress is None:
+        compress = config.checkpoint.compress
+
+    logger.info('Saving checkpoint %s', fname)
+    arrays = {}
+    header = {
+        'version': VERSION,
+        'thresholds': _list(swap.thresholds),
+        'last_classification': swap.last_classification,
+    }
+
+    header['users'] = _save_bureau(arrays, 'users', swap.users)
+    header['subjects'] = _save_bureau(arrays, 'subjects', swap.subjects)
+    _save_users(arrays, swap.users, swap.subjects)
+    header['keys'] = _save_subjects(arrays, swap.subjects, swap.users)
+
+    traces = swap.users.traces
+    header['user_traces'] = traces is not None
+    if traces is not None:
+        arrays['users.traces'] = traces.table()
+
+    graph = swap.graph
+    arrays['graph.users'] = graph.users
+    arrays['graph.subjects'] = graph.subjects
+    arrays['graph.annotations'] = graph.annotations
+
+    array_file.write(fname, MAGIC, header, arrays, compress)
+
+    logger.info('done')
+
+
+def load(fname):
+    """
+    Load a SWAP from a checkpoint file
+
+    Parameters
+    ----------
+    fname : str
+
+    Returns
+    -------
+    swap.swap.SWAP
+    """
+    logger.info('Loading checkpoint %s', fname)
+    header, arrays = array_file.read(fname, MAGIC, mmap=False)
+    if header['version'] > VERSION:
+        raise ValueError(
+            'Checkpoint %s has format version %d, newer than %d' %
+            (fname, header['version'], VERSION))
+
+    # Building a few objects per transaction sets off the cyclic
+    # garbage collector over and over, and it would find nothing
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        swap = _load(arrays, header)
+    finally:
+        if enabled:
+            gc.enable()
+
+    logger.info('done')
+    return swap
+
+
+def is_checkpoint(fname):
+    """
+    Check if a file is a checkpoint, rather than a pickle
+    """
+    return array_file.has_magic(fname, MAGIC)
+
+
+def _load(arrays, header):
+    swap = SWAP()
+    if header['thresholds'] is not None:
+        swap.thresholds = tuple(header['thresholds'])
+    swap.last_classification = header.get('last_classification')
+
+    user_ids = array_file.decode_ids(
+        arrays, 'users', header['users']['ids'])
+    subject_ids = array_file.decode_ids(
+        arrays, 'subjects', header['subjects']['ids'])
+    swap.users.reserve(user_ids)
+    swap.subjects.reserve(subject_ids)
+
+    _load_users(arrays, swap.users, user_ids, subject_ids)
+    _load_subjects(
+        arrays, swap.subjects, subject_ids, user_ids, header['keys'])
+    _load_marks(arrays, 'users', swap.users, user_ids)
+    _load_marks(arrays, 'subjects', swap.subjects, subject_ids)
+
+    swap.users.traces = None
+    if header.get('user_traces'):
+        swap.users.traces = UserTraces.from_table(arrays['users.traces'])
+
+    swap.graph.extend(
+        arrays['graph.users'], arrays['graph.subjects'],
+        arrays['graph.annotations'])
+
+    return swap
+
+
+# ----------------------------------------------------------------
+
+
+def _save_bureau(arrays, name, bureau):
+    """
+    Ids, and the arrays every ledger has. Agents are stored in the
+    order of their codes, skipping removed agents
+
+    Returns
+    -------
+    dict
+        header entry of the bureau
+    """
+    ids = list(bureau.codes)
+    kind = array_file.encode_ids(arrays, name, ids)
+
+    agents = [bureau.peek(id_) for id_ in ids]
+    arrays[name + '.present'] = np.array(
+        [agent is not None for agent in agents], dtype=bool)
+    ledgers = [agent.ledger for agent in agents if agent is not None]
+
+    arrays[name + '.next_order'] = np.array(
+        [ledger._next_order for ledger in ledgers], dtype=np.int64)
+    arrays[name + '.stale'] = np.array(
+        [ledger.stale for ledger in ledgers], dtype=bool)
+    # Agents shared with a fork are only deferred in the bureau
+    arrays[name + '.deferred'] = np.array(
+        [ledger.id in bureau._deferred for ledger in ledgers], dtype=bool)
+
+    arrays[name + '.changed'] = _codes(bureau, bureau._changed)
+    arrays[name + '.skipped'] = _codes(bureau, bureau._skipped)
+
+    return {'ids': kind}
+
+
+def _save_ledgers(arrays, name, ledgers, transaction, other):
+    """
+    Per ledger transactions and changed transactions, as compressed
+    row pointers and the codes of the other agents
+    """
+    arrays[name + '.t_ptr'] = _pointers(ledgers)
+    arrays[name + '.c_ptr'] = _pointers(ledger.changed for ledger in ledgers)
+
+    codes = {id_: code for code, id_ in enumerate(other.codes)}
+    arrays[name + '.t_id'] = np.array(
+        [codes[id_] for ledger in ledgers for id_ in ledger._ids],
+        dtype=np.int32)
+    arrays[name + '.t_annotation'] = _column(ledgers, transaction.annotation)
+    arrays[name + '.t_order'] = _column(
+        ledgers, transaction.order).astype(np.int64)
+    arrays[name + '.c_id'] = np.array(
+        [codes[id_] for ledger in ledgers for id_ in ledger.changed],
+        dtype=np.int32)
+
+
+def _save_users(arrays, users, subjects):
+    ledgers = [user.ledger for user in _agents(users)]
+    t = UserTransaction
+    _save_ledgers(arrays, 'users', ledgers, t, subjects)
+
+    for label in ['no', 'yes']:
+        counters = [getattr(ledger, label) for ledger in ledgers]
+        arrays['users.%s_seen' % label] = np.array(
+            [c.seen for c in counters], dtype=np.int64)
+        arrays['users.%s_matched' % label] = np.array(
+            [c.matched for c in counters], dtype=np.int64)
+
+    _pairs(arrays, 'users.score', [ledger._score for ledger in ledgers])
+    _pairs(arrays, 'users.pushed', [ledger._pushed for ledger in ledgers])
+
+    gold = _labels(_column(ledgers, t.gold))
+    arrays['users.t_score'] = _column(ledgers, t.score)
+    arrays['users.t_change'] = _changes(ledgers, gold)
+    arrays['users.t_gold'] = gold
+
+
+def _save_subjects(arrays, subjects, users):
+    """
+    Returns
+    -------
+    str
+        kind of the transaction order keys, see _save_keys
+    """
+    agents = _agents(subjects)
+    ledgers = [subject.ledger for subject in agents]
+    t = SubjectTransaction
+    _save_ledgers(arrays, 'subjects', ledgers, t, users)
+
+    arrays['subjects.gold'] = np.array(
+        [subject.gold for subject in agents], dtype=np.int8)
+    arrays['subjects.score'] = _floats(ledger._score for ledger in ledgers)
+    arrays['subjects.logodds'] = _floats(
+        ledger._logodds for ledger in ledgers)
+
+    # Rows of the earliest changed and out of date transactions
+    # in each ledger
+    arrays['subjects.first'] = np.array(
+        [-1 if ledger._first is None else ledger._first
+         for ledger in ledgers], dtype=np.int64)
+    arrays['subjects.dirty'] = np.array(
+        [-1 if ledger._dirty is None else ledger._dirty
+         for ledger in ledgers], dtype=np.int64)
+
+    # Transaction scores are kept in the traces, after the prior
+    arrays['subjects.t_score'] = np.concatenate(
+        [np.zeros(0)] +
+        [np.frombuffer(ledger._trace, dtype=np.float64)[1:]
+         for ledger in ledgers])
+    user_score = _column(ledgers, t.user_score)
+    arrays['subjects.t_change'] = _changes(ledgers, user_score)
+    arrays['subjects.t_user_score'] = user_score
+
+    keys = []
+    for ledger in ledgers:
+        keys.extend(ledger._keys or [None] * len(ledger))
+    return _save_keys(arrays, keys)
+
+
+def _save_keys(arrays, keys):
+    """
+    Transaction order keys: None when no transaction has a key,
+    otherwise 'int', 'float' or 'datetime', with the keys and a mask
+    of the transactions that have one
+    """
+    values = [key for key in keys if key is not None]
+    if len(values) == 0:
+        return None
+
+    if all(isinstance(key, datetime.datetime) for key in values):
+        kind = 'datetime'
+        array = np.array(values, dtype='datetime64[us]')
+    elif all(isinstance(key, int) for key in values):
+        kind = 'int'
+        array = np.array(values, dtype=np.int64)
+    elif all(isinstance(key, (int, float)) for key in values):
+        kind = 'float'
+        array = np.array(values, dtype=np.float64)
+    else:
+        raise TypeError('Can\'t save order keys of type %s' %
+                        str({type(key) for key in values}))
+
+    arrays['subjects.t_key'] = array
+    arrays['subjects.t_has_key'] = np.array(
+        [key is not None for key in keys], dtype=bool)
+    return kind
+
+
+def _agents(bureau):
+    """
+    Agents of a bureau in the order of their codes
+    """
+    agents = (bureau.peek(id_) for id_ in bureau.codes)
+    return [agent for agent in agents if agent is not None]
+
+
+def _column(ledgers, field):
+    """
+    Column of a transaction field, the columns of the ledgers one
+    after the other. Pairs of scores are two columns
+    """
+    dtype = np.dtype(field.typecode)
+    column = np.concatenate([np.zeros(0, dtype)] + [
+        np.frombuffer(getattr(ledger, field.column), dtype=dtype)
+        for ledger in ledgers])
+    if field.width == 2:
+        column = column.reshape(-1, 2)
+    return column
+
+
+def _changes(ledgers, committed):
+    """
+    Pending changes of the transactions, the committed column where
+    nothing is pending
+    """
+    changes = committed.copy()
+    start = 0
+    for ledger in ledgers:
+        for id_, change in ledger.changed.items():
+            if change is not None:
+                changes[start + ledger._rows[id_]] = change
+        start += len(ledger)
+    return changes
+
+
+def _codes(bureau, ids):
+    return np.array([bureau.code(id_) for id_ in ids], dtype=np.int32)
+
+
+def _pointers(rows):
+    lengths = [len(row) for row in rows]
+    pointers = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=pointers[1:])
+    return pointers
+
+
+def _floats(values):
+    return np.array(
+        [np.nan if value is None else value for value in values],
+        dtype=np.float64)
+
+
+def _pairs(arrays, name, values):
+    """
+    (u0, u1) scores as two float columns, nan for None
+    """
+    none = (np.nan, np.nan)
+    arrays[name] = np.array(
+        [none if value is None else value for value in values],
+        dtype=np.float64).reshape(-1, 2)
+
+
+def _labels(column):
+    """
+    Labels of an integer column with _NONE for None
+    """
+    return np.where(
+        column == UserTransaction.gold.none, _NONE, column).astype(np.int8)
+
+
+def _list(value):
+    return None if value is None else [float(x) for x in value]
+
+
+# ----------------------------------------------------------------
+
+
+def _load_marks(arrays, name, bureau, ids):
+    for code in arrays[name + '.changed'].tolist():
+        bureau.mark_changed(ids[code])
+    for code in arrays[name + '.skipped'].tolist():
+        bureau.mark_skipped(ids[code])
+
+
+def _present(arrays, name, ids):
+    present = arrays[name + '.present']
+    return [ids[code] for code in np.flatnonzero(present).tolist()]
+
+
+def _ledger_columns(arrays, name, other_ids):
+    """
+    Per ledger and per transaction columns shared by users
+    and subjects, as lists
+    """
+    columns = {}
+    for column in ['next_order', 'stale', 'deferred', 't_ptr', 'c_ptr']:
+        columns[column] = arrays['%s.%s' % (name, column)].tolist()
+
+    columns['t_id'] = [
+        other_ids[code] for code in arrays[name + '.t_id'].tolist()]
+    columns['c_id'] = [
+        other_ids[code] for code in arrays[name + '.c_id'].tolist()]
+    return columns
+
+
+def _restore_ledger(ledger, columns, k, fields, changes):
+    """
+    Rows of a ledger from the saved columns. fields maps transaction
+    fields to their columns over every ledger, changes are the pending
+    changes of the rows
+    """
+    ledger._next_order = columns['next_order'][k]
+    ledger.stale = columns['stale'][k]
+    ledger.deferred = columns['deferred'][k]
+
+    t_ptr = columns['t_ptr']
+    start, end = t_ptr[k], t_ptr[k + 1]
+    ids = columns['t_id'][start:end]
+    ledger._ids = ids
+    ledger._rows = {id_: row for row, id_ in enumerate(ids)}
+    for field, column in fields.items():
+        setattr(ledger, field.column,
+                array(field.typecode, column[start:end].tobytes()))
+
+    c_ptr = columns['c_ptr']
+    ledger.changed = {
+        id_: changes[start + ledger._rows[id_]]
+        for id_ in columns['c_id'][c_ptr[k]:c_ptr[k + 1]]}
+
+
+def _load_users(arrays, users, ids, subject_ids):
+    columns = _ledger_columns(arrays, 'users', subject_ids)
+    t = UserTransaction
+    gold = arrays['users.t_gold']
+    fields = {
+        t.annotation: _typed(arrays['users.t_annotation'], t.annotation),
+        t.order: _typed(arrays['users.t_order'], t.order),
+        t.score: _typed(arrays['users.t_score'], t.score),
+        t.gold: _typed(np.where(gold == _NONE, t.gold.none, gold), t.gold)}
+    changes = [None if label == _NONE else label
+               for label in arrays['users.t_change'].tolist()]
+
+    counts = {name: arrays['users.' + name].tolist() for name in [
+        'no_seen', 'no_matched', 'yes_seen', 'yes_matched']}
+    score = _tuples(arrays['users.score'])
+    pushed = _tuples(arrays['users.pushed'])
+
+    for k, id_ in enumerate(_present(arrays, 'users', ids)):
+        user = User(id_)
+        ledger = user.ledger
+        _restore_ledger(ledger, columns, k, fields, changes)
+
+        ledger.no.seen = counts['no_seen'][k]
+        ledger.no.matched = counts['no_matched'][k]
+        ledger.yes.seen = counts['yes_seen'][k]
+        ledger.yes.matched = counts['yes_matched'][k]
+        ledger._score = score[k]
+        ledger._pushed = pushed[k]
+
+        users.add(user)
+
+
+def _load_subjects(arrays, subjects, ids, user_ids, keys):
+    columns = _ledger_columns(arrays, 'subjects', user_ids)
+    t_ptr = columns['t_ptr']
+    t = SubjectTransaction
+    fields = {
+        t.annotation: _typed(arrays['subjects.t_annotation'], t.annotation),
+        t.order: _typed(arrays['subjects.t_order'], t.order),
+        t.user_score: _typed(
+            arrays['subjects.t_user_score'], t.user_score)}
+    changes = _tuples(arrays['subjects.t_change'])
+    t_score = np.asarray(arrays['subjects.t_score'], dtype=np.float64)
+
+    gold = arrays['subjects.gold'].tolist()
+    score = _none_floats(arrays['subjects.score'])
+    logodds = _none_floats(arrays['subjects.logodds'])
+    first = arrays['subjects.first'].tolist()
+    dirty = arrays['subjects.dirty'].tolist()
+
+    t_key = None
+    if keys is not None:
+        values = iter(arrays['subjects.t_key'].tolist())
+        t_key = [next(values) if has else None
+                 for has in arrays['subjects.t_has_key'].tolist()]
+
+    for k, id_ in enumerate(_present(arrays, 'subjects', ids)):
+        subject = Subject(id_, gold[k])
+        ledger = subject.ledger
+        _restore_ledger(ledger, columns, k, fields, changes)
+
+        ledger._score = score[k]
+        ledger._logodds = logodds[k]
+
+        # Transaction scores from _dirty on are out of date until the
+        # next refresh
+        ledger._trace.frombytes(t_score[t_ptr[k]:t_ptr[k + 1]].tobytes())
+        if t_key is not None:
+            row_keys = t_key[t_ptr[k]:t_ptr[k + 1]]
+            if any(key is not None for key in row_keys):
+                ledger._keys = row_keys
+        if first[k] >= 0:
+            ledger._first = first[k]
+        if dirty[k] >= 0:
+            ledger._dirty = dirty[k]
+
+        subjects.add(subject)
+
+
+def _typed(column, field):
+    """
+    Saved column in the type of the ledger column of a field
+    """
+    return np.ascontiguousarray(column, dtype=np.dtype(field.typecode))
+
+
+def _tuples(array):
+    """
+    Two float columns as (u0, u1) tuples, None for nan
+    """
+    return [None if u0 != u0 else (u0, u1) for u0, u1 in array.tolist()]
+
+
+def _none_floats(array):
+    return [None if x != x else x for x in array.tolist()]
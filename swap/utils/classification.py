@@ -1,4 +1,6 @@
 
+import swap.config as config
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -8,7 +10,7 @@ class Classification:
         Object to represent each individual classification
     """
 
-    def __init__(self, user, subject, annotation):
+    def __init__(self, user, subject, annotation, key=None):
         """
             Parameters
             ----------
@@ -22,6 +24,9 @@ class Classification:
                 (optional) expert assigned label
             metadata : dict
                 (optional) any additional metadata associated
+            key
+                (optional) ordering key of the classification, see
+                config.order_key
         """
 
         if type(annotation) is not int:
@@ -30,6 +35,7 @@ class Classification:
         self.user = user
         self.subject = subject
         self.annotation = annotation
+        self.key = key
 
     def __str__(self):
         return 'user %s subject %s annotation %d' % \
@@ -51,7 +57,11 @@ class Classification:
         subject = cl['subject_id']
         annotation = cl['annotation']
 
-        c = Classification(user, subject, annotation)
+        key = None
+        if config.order_key is not None:
+            key = cl.get(config.order_key)
+
+        c = Classification(user, subject, annotation, key)
 
         return c
 
@@ -0,0 +1,69 @@
+################################################################
+# Interning of user and subject ids as dense integer codes
+
+"""
+    External ids are ints for subjects, and ints or session id
+    strings for users. Codes number them 0, 1, 2, ... in the order
+    they are first seen, so per-agent data can be kept in plain
+    arrays indexed by code.
+"""
+
+
+class Codes:
+    """
+    Two-way mapping between external ids and dense integer codes.
+
+    Codes are never reused, an id keeps its code for the lifetime
+    of the mapping.
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self._ids = []
+
+    def code(self, id_):
+        """
+        Get the code of an id, registering it if it is new
+        """
+        if id_ not in self._codes:
+            self._codes[id_] = len(self._ids)
+            self._ids.append(id_)
+        return self._codes[id_]
+
+    def get(self, id_):
+        """
+        Get the code of an id, or None if it was never registered
+        """
+        return self._codes.get(id_)
+
+    def id(self, code):
+        """
+        Get the id a code stands for
+        """
+        return self._ids[code]
+
+    def copy(self):
+        codes = Codes()
+        codes._codes = dict(self._codes)
+        codes._ids = list(self._ids)
+        return codes
+
+    def extend(self, n):
+        """
+        Register unknown codes below n as their own ids
+        """
+        for code in range(len(self._ids), n):
+            if code in self._codes:
+                raise ValueError(
+                    'Code %d is already used by id %s' %
+                    (self._codes[code], str(code)))
+            self.code(code)
+
+    def __contains__(self, id_):
+        return id_ in self._codes
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
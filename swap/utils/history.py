@@ -1,6 +1,10 @@
 
 from swap.utils.scores import ScoreIterator, Score, ScoreExport
 from swap.utils.golds import GoldGetter
+import swap.utils.arrays as array_file
+
+import numpy as np
+import itertools
 
 
 class History:
@@ -49,6 +53,15 @@ class HistoryExport:
     def get(self, id_):
         return self.history[id_]
 
+    def store(self, delta=False):
+        """
+        Copy the score histories to a HistoryStore
+        """
+        histories = list(self.history.values())
+        return HistoryStore.from_traces(
+            [h.id for h in histories], [h.gold for h in histories],
+            [h.scores for h in histories], delta)
+
     def traces(self):
 
         def func(history):
@@ -75,3 +88,253 @@ class HistoryExport:
         def func(history):
             return (history.id, history.gold, history.scores)
         return ScoreIterator(self.history, func)
+
+
+class HistoryStore:
+    """
+    Score histories of all subjects in one float32 array
+
+    The trace of the subject at position i, its prior and then its
+    score after each classification, is
+    scores[offsets[i]:offsets[i + 1]]. Every trace has at least one
+    score.
+
+    Delta encoded stores keep the first score of each trace and then
+    the change from one score to the next. They decode by summing, so
+    their scores are only as close as the float32 rounding of each
+    step, and step queries read every step up to k.
+    """
+
+    MAGIC = b'SWAPHIST'
+    # Format version, bumped when the arrays change meaning
+    VERSION = 1
+
+    def __init__(self, ids, golds, offsets, scores, delta=False):
+        """
+        Parameters
+        ----------
+        ids : list
+            Subject ids
+        golds : np.ndarray
+            Subject gold labels 1, 0 or -1
+        offsets : np.ndarray
+            Start of each trace, and the end of the last one
+        scores : np.ndarray
+            Stored scores, delta encoded or not
+        delta : bool
+        """
+        self.ids = ids
+        self.golds = golds
+        self.offsets = offsets
+        self.scores = scores
+        self.delta = delta
+
+        # Position of each subject id, built when first needed
+        self._index = None
+
+    @classmethod
+    def from_traces(cls, ids, golds, traces, delta=False):
+        """
+        Build a store from sequences of scores
+
+        Parameters
+        ----------
+        ids : list
+        golds : list
+        traces : list
+            Score history of each subject
+        delta : bool
+            Delta encode the scores
+        """
+        lengths = np.fromiter(
+            (len(trace) for trace in traces), np.int64, len(traces))
+        offsets = np.zeros(len(traces) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        scores = np.fromiter(
+            itertools.chain.from_iterable(traces), np.float64, offsets[-1])
+        return cls.from_scores(ids, golds, offsets, scores, delta)
+
+    @classmethod
+    def from_scores(cls, ids, golds, offsets, scores, delta=False):
+        """
+        Build a store from concatenated traces
+        """
+        golds = np.asarray(golds, dtype=np.int8)
+        if delta:
+            scores = np.asarray(scores, dtype=np.float64)
+            encoded = np.empty(len(scores), dtype=np.float64)
+            encoded[1:] = np.diff(scores)
+            starts = offsets[:-1]
+            encoded[starts] = scores[starts]
+            scores = encoded
+
+        return cls(list(ids), golds, offsets,
+                   np.asarray(scores, dtype=np.float32), delta)
+
+    def save(self, fname, compress=False):
+        """
+        Save the store to a file, see swap.utils.arrays
+        """
+        arrays = {}
+        header = {
+            'version': self.VERSION,
+            'delta': self.delta,
+            'ids': array_file.encode_ids(arrays, 'subjects', self.ids)}
+        arrays['golds'] = self.golds
+        arrays['offsets'] = self.offsets
+        arrays['scores'] = self.scores
+
+        array_file.write(fname, self.MAGIC, header, arrays, compress)
+
+    @classmethod
+    def load(cls, fname, mmap=True):
+        """
+        Load a store from a file. Uncompressed scores are memory
+        mapped unless mmap is False
+        """
+        header, arrays = array_file.read(fname, cls.MAGIC, mmap)
+        if header['version'] > cls.VERSION:
+            raise ValueError(
+                'History store %s has format version %d, newer than %d' %
+                (fname, header['version'], cls.VERSION))
+
+        ids = array_file.decode_ids(arrays, 'subjects', header['ids'])
+        return cls(ids, arrays['golds'], arrays['offsets'],
+                   arrays['scores'], header['delta'])
+
+    @property
+    def lengths(self):
+        """
+        Number of scores in each trace
+        """
+        return np.diff(self.offsets)
+
+    def position(self, id_):
+        """
+        Position of a subject in the store
+        """
+        if self._index is None:
+            self._index = {id_: i for i, id_ in enumerate(self.ids)}
+        return self._index[id_]
+
+    def trace(self, id_):
+        """
+        Score history of a subject
+        """
+        i = self.position(id_)
+        scores = self.scores[self.offsets[i]:self.offsets[i + 1]]
+        if self.delta:
+            return np.cumsum(scores, dtype=np.float64).astype(np.float32)
+        return scores
+
+    def score(self, id_, k):
+        """
+        Score of a subject after k classifications. The prior is the
+        score after 0, and subjects with fewer than k classifications
+        keep their last score
+        """
+        if k < 0:
+            raise ValueError('k must not be negative')
+
+        i = self.position(id_)
+        start = self.offsets[i]
+        end = min(start + k, self.offsets[i + 1] - 1) + 1
+        if self.delta:
+            return float(np.sum(self.scores[start:end], dtype=np.float64))
+        return float(self.scores[end - 1])
+
+    def step(self, k):
+        """
+        Score of every subject after k classifications, see score
+
+        Returns
+        -------
+        np.ndarray
+            scores in the order of ids
+        """
+        if k < 0:
+            raise ValueError('k must not be negative')
+
+        starts = self.offsets[:-1]
+        last = self.offsets[1:] - 1
+        if not self.delta:
+            return self.scores[np.minimum(starts + k, last)]
+
+        total = np.zeros(len(starts), dtype=np.float64)
+        for j in range(k + 1):
+            positions = starts + j
+            valid = positions <= last
+            if not valid.any():
+                break
+            total[valid] += self.scores[positions[valid]]
+        return total.astype(np.float32)
+
+    def decoded(self):
+        """
+        All scores, decoded
+        """
+        if not self.delta:
+            return self.scores
+
+        summed = np.cumsum(self.scores, dtype=np.float64)
+        starts = self.offsets[:-1]
+        base = summed[starts] - self.scores[starts]
+        summed -= np.repeat(base, self.lengths)
+        return summed.astype(np.float32)
+
+    def retire(self, thresholds):
+        """
+        Retirement of every subject, see History.retire
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            number of classifications until retirement, and the score
+            then
+        """
+        scores = self.decoded()
+        starts = self.offsets[:-1]
+        index = self.offsets[1:] - 1
+
+        if thresholds is not None:
+            bogus, real = thresholds
+            crossed = np.flatnonzero((scores < bogus) | (scores > real))
+            subject = np.searchsorted(self.offsets, crossed, 'right') - 1
+            subject, first = np.unique(subject, return_index=True)
+            index[subject] = crossed[first]
+
+        return index - starts, scores[index]
+
+    def score_export(self, thresholds=None, all_golds=False,
+                     gold_getter=None):
+        """
+        Score export of the subjects, see HistoryExport.score_export
+        """
+        ncl, p = self.retire(thresholds)
+
+        scores = {}
+        for id_, gold, n, p_ in zip(
+                self.ids, self.golds.tolist(), ncl.tolist(), p.tolist()):
+            scores[id_] = Score(id_, gold, p_, ncl=n)
+
+        return ScoreExport(
+            scores, gold_getter=gold_getter,
+            thresholds=thresholds, new_golds=all_golds)
+
+    def traces(self):
+        """
+        (gold, trace) of every subject, as in HistoryExport.traces
+        """
+        scores = self.decoded()
+        for i, gold in enumerate(self.golds.tolist()):
+            yield gold, scores[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        scores = self.decoded()
+        for i, id_ in enumerate(self.ids):
+            yield id_, int(self.golds[i]), \
+                scores[self.offsets[i]:self.offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.ids)
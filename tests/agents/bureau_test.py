@@ -8,8 +8,11 @@ from swap.agents.bureau import AgentIterator
 from swap.agents.agent import Agent
 from swap.agents.user import User
 from swap.agents.subject import Subject
+from swap.agents.user import Ledger as ULedger
+from swap.agents.subject import Ledger as SLedger
 
 import unittest
+from unittest.mock import patch
 
 
 class TestBureau:
@@ -129,6 +132,215 @@ class TestBureau:
         [u.ledger.recalculate() for u in b]
         b.stats()
 
+    def test_add_marks_stale(self):
+        b = Bureau(Subject)
+        b.add(Subject(0))
+
+        assert b.calculate_changes() == 1
+        assert b.get(0).ledger.bureau is b
+
+    def test_process_changes_only_stale(self):
+        b = Bureau(User)
+        [b.add(User(i)) for i in range(5)]
+        b.process_changes()
+        assert b.calculate_changes() == 0
+
+        with patch.object(ULedger, 'recalculate') as mock:
+            b.get(3).ledger.update(None)
+            assert b.calculate_changes() == 1
+
+            b.process_changes()
+            mock.assert_called_once_with()
+
+    def test_remove_clears_changes(self):
+        b = Bureau(Subject)
+        b.add(Subject(0))
+        b.remove(0)
+
+        assert b.calculate_changes() == 0
+
+    def test_notify_changes_only_changed(self):
+        users = Bureau(User)
+        subjects = Bureau(Subject)
+        [users.add(User(i)) for i in range(5)]
+
+        with patch.object(ULedger, 'notify_agents') as mock:
+            users.get(2).ledger.score = (.1, .2)
+            users.notify_changes(subjects)
+            users.notify_changes(subjects)
+
+            mock.assert_called_once_with(users, subjects)
+
+    def test_notify_changes_neighbours(self):
+        users = Bureau(User)
+        subjects = Bureau(Subject)
+        users.add(User(0))
+        [subjects.add(Subject(i)) for i in range(3)]
+
+        with patch.object(SLedger, 'notify') as mock:
+            users.get(0).ledger.score = (.1, .2)
+            users.notify_changes(subjects, lambda code: [2, 0])
+
+            assert mock.call_count == 2
+            mock.assert_called_with(0, users)
+
+    @patch('swap.config.notify_tol', .01)
+    def test_notify_changes_skips_small_changes(self):
+        users = Bureau(User)
+        subjects = Bureau(Subject)
+        [users.add(User(i)) for i in range(5)]
+
+        with patch.object(ULedger, 'notify_agents') as mock:
+            users.get(2).ledger.score = (.505, .5)
+            users.notify_changes(subjects)
+
+            mock.assert_not_called()
+            assert users.skipped_ids() == [2]
+            assert users.skipped_error() == pytest.approx(.005)
+
+    @patch('swap.config.notify_tol', .01)
+    def test_skipped_changes_accumulate(self):
+        users = Bureau(User)
+        subjects = Bureau(Subject)
+        [users.add(User(i)) for i in range(5)]
+
+        users.get(2).ledger.score = (.505, .5)
+        users.get(2).ledger.score = (.52, .5)
+        users.notify_changes(subjects)
+
+        assert users.skipped_ids() == []
+        assert users.skipped_error() == 0
+        assert users.get(2).ledger.skipped == 0
+
+    def test_process_priority(self):
+        b = Bureau(Subject)
+        [b.add(Subject(i)) for i in range(6)]
+
+        deferred = b.process_priority(lambda subject: abs(subject.id - 2), margin=1)
+        assert deferred == 3
+        assert sorted(b.deferred_ids()) == [0, 4, 5]
+        assert sorted(b.stale_ids()) == [0, 4, 5]
+        assert b.peek(4).ledger.deferred
+
+        b.get(4).score
+        assert sorted(b.deferred_ids()) == [0, 5]
+        assert sorted(b.stale_ids()) == [0, 5]
+
+    def test_process_priority_budget(self):
+        b = Bureau(Subject)
+        [b.add(Subject(i)) for i in range(6)]
+
+        b.process_priority(lambda subject: -subject.id, budget=2)
+        assert sorted(b.deferred_ids()) == [0, 1, 2, 3]
+
+    def test_process_priority_forked(self):
+        b = Bureau(Subject)
+        [b.add(Subject(i)) for i in range(6)]
+        child = b.fork()
+
+        child.process_priority(lambda subject: subject.id, budget=2)
+        assert sorted(child.deferred_ids()) == [2, 3, 4, 5]
+        assert child.peek(4) is b.peek(4)
+        assert not b.peek(4).ledger.deferred
+
+        assert child.get(4).ledger.deferred
+        child.get(4).score
+        assert sorted(child.deferred_ids()) == [2, 3, 5]
+        assert b.deferred_ids() == []
+
+    def test_score_index(self):
+        b = Bureau(Subject, index=True)
+        for i in range(6):
+            b.add(Subject(i))
+            b.get(i).ledger._set_score(i / 10)
+
+        assert b.range(.15, .35) == [2, 3]
+        assert b.top_k(2) == [5, 4]
+        assert b.bottom_k(1) == [0]
+        assert b.nearest(.38, 2) == [4, 3]
+
+        b.get(0).ledger._set_score(.9)
+        b.remove(5)
+        assert b.top_k(2) == [0, 4]
+
+        child = b.fork()
+        child.get(1).ledger._set_score(1.)
+        assert child.top_k(1) == [1]
+        assert b.top_k(1) == [0]
+
+    def test_codes(self):
+        b = Bureau(User)
+        b.add(User('a'))
+        b.get(12)
+
+        assert b.code('a') == 0
+        assert b.code(12) == 1
+        assert b.code('missing') is None
+        assert b.get_code(1).id == 12
+        assert b.codes.id(0) == 'a'
+
+    def test_remove_keeps_code(self):
+        b = Bureau(User)
+        [b.add(User(i)) for i in range(3)]
+        b.remove(1)
+
+        assert b.get_code(1) is None
+        assert b.code(1) == 1
+
+        b.add(User(1))
+        assert b.get_code(1).id == 1
+        assert len(b.codes) == 3
+
+    def test_fork_shares_agents(self):
+        b = Bureau(User)
+        [b.add(User(i)) for i in range(3)]
+        child = b.fork()
+
+        assert child.peek(1) is b.peek(1)
+        assert child.get(1) is not b.peek(1)
+        assert child.get(1) is child.peek(1)
+        assert child.get(1).ledger.bureau is child
+        assert child.get_code(1) is child.peek(1)
+
+    def test_fork_copies_on_write(self):
+        b = Bureau(User)
+        [b.add(User(i)) for i in range(3)]
+        child = b.fork()
+
+        child.get(1).ledger.score = (.1, .2)
+        b.get(2).ledger.score = (.3, .4)
+
+        assert b.get(1).score == (.5, .5)
+        assert child.get(2).score == (.5, .5)
+        assert child.get(1).score == (.1, .2)
+
+    def test_fork_new_agents(self):
+        b = Bureau(User)
+        b.add(User(0))
+        child = b.fork()
+        child.get('new')
+
+        assert 'new' not in b
+        assert b.code('new') is None
+        assert child.code('new') == 1
+
+    def test_merge(self):
+        a = Bureau(User)
+        b = Bureau(User)
+        [a.add(User(i)) for i in [0, 2]]
+        [b.add(User(i)) for i in [1, 3]]
+        b.get(3).ledger.score = (.1, .2)
+
+        merged = Bureau(User)
+        merged.merge([a, b], [3, 0, 1, 2])
+
+        assert list(merged.codes) == [3, 0, 1, 2]
+        assert [u.id for u in merged] == [3, 0, 1, 2]
+        assert merged.get(2) is a.peek(2)
+        assert merged.get(2).ledger.bureau is merged
+        assert merged.get_code(0).id == 3
+        assert merged._changed == {3}
+
     # ---------EXPORT TEST------------------------------
     @pytest.mark.skip()
     def test_export_contents(self):
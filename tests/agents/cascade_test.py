@@ -0,0 +1,45 @@
+################################################################
+# Test functions for cascade instrumentation
+
+import swap.agents.cascade as cascade
+from swap.agents.cascade import Report
+
+# pylint: disable=R0201
+
+
+class TestReport:
+
+    def test_phase(self):
+        report = Report()
+        with report.phase('a') as phase:
+            assert cascade.current is phase
+            phase.record_fanout(3)
+            phase.record_fanout(3)
+            phase.record_recalculate(1, 5)
+        assert cascade.current is None
+
+        with report.phase('b'):
+            pass
+
+        assert [p.name for p in report.phases] == ['a', 'b']
+        assert report.seconds >= 0
+
+        data = report.dict()
+        assert data['phases'][0]['fanout'] == {3: 2}
+        assert data['phases'][0]['recomputed'] == {1: 1}
+        assert data['phases'][0]['depth'] == {5: 1}
+        assert data['phases'][1]['notified'] == 0
+
+    def test_bins(self):
+        bins = cascade._bins({0: 2, 1: 1, 2: 4, 3: 1, 9: 2})
+        assert bins == '0:2 1:1 2-3:5 8-15:2'
+
+    def test_str(self):
+        report = Report()
+        with report.phase('notify') as phase:
+            phase.record_fanout(2)
+
+        s = str(report)
+        assert 'notify' in s
+        assert 'fanout' in s
+        assert 'depth' not in s
@@ -0,0 +1,140 @@
+################################################################
+# Test functions for the classification graph
+
+from swap.agents.graph import Graph, components
+
+import numpy as np
+
+
+class TestGraph:
+
+    def graph(self):
+        g = Graph(capacity=2)
+        g.add(0, 1, 1)
+        g.add(1, 1, 0)
+        g.add(0, 2, 0)
+        g.add(2, 0, 1)
+        return g
+
+    def test_add(self):
+        g = self.graph()
+        assert len(g) == 4
+        assert g.users.tolist() == [0, 1, 0, 2]
+        assert g.subjects.tolist() == [1, 1, 2, 0]
+        assert g.annotations.tolist() == [1, 0, 0, 1]
+
+    def test_neighbours(self):
+        g = self.graph()
+        assert g.subjects_of(0).tolist() == [1, 2]
+        assert g.users_of(1).tolist() == [0, 1]
+        assert g.user_edges(2).tolist() == [3]
+        assert g.subject_edges(2).tolist() == [2]
+
+    def test_unknown_code(self):
+        g = self.graph()
+        assert len(g.subjects_of(10)) == 0
+        assert len(g.users_of(10)) == 0
+
+    def test_index_updates(self):
+        g = self.graph()
+        assert g.subjects_of(1).tolist() == [1]
+
+        g.add(1, 3, 1)
+        assert g.subjects_of(1).tolist() == [1, 3]
+        assert g.users_of(3).tolist() == [1]
+
+    def test_extend(self):
+        g = self.graph()
+        g.extend([3, 3], [0, 4], [0, 1])
+
+        assert len(g) == 6
+        assert g.subjects_of(3).tolist() == [0, 4]
+        assert g.users_of(0).tolist() == [2, 3]
+
+    def test_remove(self):
+        g = self.graph()
+        g.remove(0, [2, 5])
+
+        assert len(g) == 3
+        assert g.subjects_of(0).tolist() == [1]
+        assert g.users.tolist() == [0, 1, 2]
+        assert g.users_of(2).tolist() == []
+
+    def test_remove_forked(self):
+        g = self.graph()
+        child = g.fork()
+        child.remove(0, [1])
+
+        assert len(g) == 4
+        assert g.subjects_of(0).tolist() == [1, 2]
+        assert child.subjects_of(0).tolist() == [2]
+
+    def test_remove_marks_dead(self):
+        g = self.graph()
+        g.add(3, 3, 1)
+        g.remove(3, [3])
+
+        # One dead edge of five is not compacted yet
+        assert g._removed == 1
+        assert len(g) == 4
+        assert g.users_of(3).tolist() == []
+        assert g.users.tolist() == [0, 1, 0, 2]
+
+        g.add(3, 4, 1)
+        assert g.subjects_of(3).tolist() == [4]
+
+    def test_remove_compacts(self):
+        g = self.graph()
+        g.remove(0, [1, 2])
+        g.remove(1, [1])
+
+        assert g._removed == 0
+        assert len(g) == 1
+        assert g.user_edges(2).tolist() == [0]
+        assert g.subjects_of(0).tolist() == []
+
+    def test_remove_forked_marks(self):
+        g = self.graph()
+        g.add(3, 3, 1)
+        g.remove(3, [3])
+        child = g.fork()
+        child.remove(0, [1])
+        g.remove(2, [0])
+
+        assert g.subjects_of(0).tolist() == [1, 2]
+        assert child.subjects_of(2).tolist() == [0]
+        assert child.subjects_of(0).tolist() == [2]
+
+    def test_merge(self):
+        rand = np.random.RandomState(0)
+        g = Graph()
+        for size in [5000, 10, 7000, 1]:
+            g.extend(rand.randint(0, 300, size), rand.randint(0, 900, size),
+                     np.zeros(size))
+            g.subjects_of(0)
+
+            for user in range(0, 300, 7):
+                expect = np.flatnonzero(g.users == user)
+                assert g.user_edges(user).tolist() == expect.tolist()
+            for subject in range(0, 900, 11):
+                expect = np.flatnonzero(g.subjects == subject)
+                assert g.subject_edges(subject).tolist() == expect.tolist()
+
+    def test_components(self):
+        g = self.graph()
+        g.add(3, 3, 1)
+
+        count, users, subjects = g.components()
+        assert count == 3
+        assert users[0] == users[1] == subjects[1] == subjects[2]
+        assert users[2] == subjects[0]
+        assert users[3] == subjects[3]
+        assert len({users[0], users[2], users[3]}) == 3
+
+    def test_components_unconnected(self):
+        count, users, subjects = components([0], [0], 2, 3)
+
+        assert count == 4
+        assert len(users) == 2
+        assert len(subjects) == 3
+        assert users[0] == subjects[0]
@@ -0,0 +1,82 @@
+################################################################
+# Test functions for the score index
+
+from swap.agents.index import ScoreIndex
+
+import random
+
+# pylint: disable=R0201
+
+
+def build(n=300, seed=0):
+    rand = random.Random(seed)
+    index = ScoreIndex(load=4)
+    scores = {}
+    for _ in range(n * 3):
+        code = rand.randrange(n)
+        if rand.random() < .1:
+            index.discard(code)
+            scores.pop(code, None)
+        else:
+            # Repeat scores to test ties
+            score = round(rand.random(), 2)
+            index.update(code, score)
+            scores[code] = score
+
+    return index, scores
+
+
+def ordered(scores):
+    return sorted(scores, key=lambda code: (scores[code], code))
+
+
+class TestScoreIndex:
+
+    def test_update(self):
+        index, scores = build()
+        assert len(index) == len(scores)
+        assert index.bottom_k(len(scores)) == ordered(scores)
+        for code, score in scores.items():
+            assert index.score(code) == score
+            assert code in index
+
+    def test_range(self):
+        index, scores = build()
+        expect = [c for c in ordered(scores) if .2 <= scores[c] <= .35]
+        assert index.range(.2, .35) == expect
+        assert index.range(.5, .4) == []
+        assert index.range(-1, 2) == ordered(scores)
+
+    def test_top_bottom(self):
+        index, scores = build()
+        assert index.bottom_k(5) == ordered(scores)[:5]
+        assert index.top_k(5) == ordered(scores)[::-1][:5]
+        assert index.top_k(0) == []
+
+    def test_nearest(self):
+        index, scores = build()
+        near = index.nearest(.5, 10)
+        distances = sorted(abs(s - .5) for s in scores.values())
+
+        assert len(near) == 10
+        assert [abs(scores[c] - .5) for c in near] == distances[:10]
+        assert len(index.nearest(2., len(scores) + 5)) == len(scores)
+
+    def test_empty(self):
+        index = ScoreIndex()
+        assert index.range(0, 1) == []
+        assert index.top_k(3) == []
+        assert index.bottom_k(3) == []
+        assert index.nearest(.5) == []
+
+        index.update(1, .3)
+        index.discard(1)
+        assert index.top_k(3) == []
+
+    def test_copy(self):
+        index, scores = build()
+        copy = index.copy()
+        copy.update(0, 2.)
+
+        assert index.top_k(1) != [0]
+        assert copy.top_k(1) == [0]
@@ -5,6 +5,8 @@ from swap.agents.ledger import Ledger, Transaction, StaleException
 from swap.agents.subject import Ledger as SLedger
 from swap.agents.subject import Transaction as STransaction
 from swap.agents.subject import Subject
+from swap.agents.subject import llr, posterior
+import swap.agents.subject as subject_module
 from swap.agents.user import User
 from swap.agents.user import Ledger as ULedger
 from swap.agents.user import Transaction as UTransaction
@@ -14,6 +16,8 @@ from swap.agents.bureau import Bureau
 import swap.config as config
 
 from unittest.mock import MagicMock, patch
+import numpy as np
+import pickle
 
 import pytest
 
@@ -41,7 +45,7 @@ class TestLedger:
         assert le.id == 15
         assert le.transactions == {}
         assert le.stale is True
-        assert le.changed == []
+        assert len(le.changed) == 0
 
     def test_add_transaction(self):
         le = Ledger(0)
@@ -79,12 +83,12 @@ class TestLedger:
     def test_update(self):
         le = Ledger(0)
         t0 = Transaction(mocksubject(0), 0)
-        t0.notify = MagicMock()
 
         le.add(t0)
-        le.update(0)
+        with patch.object(Transaction, 'notify') as mock:
+            le.update(0)
 
-        t0.notify.assert_not_called
+        mock.assert_not_called()
 
     def test_update_registers_change(self):
         le = Ledger(0)
@@ -97,7 +101,7 @@ class TestLedger:
         le.recalculate()
         le.update(0)
 
-        assert le.changed == [0]
+        assert list(le.changed) == [0]
         assert le.stale is True
 
     def test_recalculate_clears_changes(self):
@@ -110,7 +114,7 @@ class TestLedger:
 
         le.recalculate()
 
-        assert le.changed == []
+        assert len(le.changed) == 0
         assert le.stale is False
 
     def test_change(self):
@@ -119,6 +123,14 @@ class TestLedger:
 
         assert 1 in le.changed
 
+    def test_change_deduplicates(self):
+        le = Ledger(0)
+        le._change(1)
+        le._change(2)
+        le._change(1)
+
+        assert list(le.changed) == [1, 2]
+
     # def test_missing_bureau(self):
     #     le = Ledger(0)
 
@@ -161,11 +173,18 @@ class TestLedger:
 
         t.notify.assert_called_once_with(mock())
         assert l.stale is True
-        assert l.changed == [16]
+        assert list(l.changed) == [16]
 
 
 class TestTransaction:
 
+    def test_slots(self):
+        for t in [Transaction(mocksubject(15), 0),
+                  STransaction(mockuser(15), 0)]:
+            assert not hasattr(t, '__dict__')
+            with pytest.raises(AttributeError):
+                t.foo = 1
+
     def test_init(self):
         t = Transaction(mocksubject(15), 20)
         assert t.id == 15
@@ -260,8 +279,6 @@ class TestSubjectLedger:
         t1 = STransaction(mockuser(1), 0)
         t2 = STransaction(mockuser(2), 0)
 
-        t1.notify = MagicMock()
-
         le.add(t0)
         le.add(t1)
         le.add(t2)
@@ -284,8 +301,165 @@ class TestSubjectLedger:
         le._change(0)
         assert le.first_change == t0
 
-    @patch.object(STransaction, 'calculate', new=MagicMock(return_value=.5))
-    @patch.object(STransaction, 'get_prior', new=MagicMock(return_value=.5))
+    def test_copy(self):
+        le = SLedger(0)
+        ts = [STransaction(mockuser(i), 0) for i in range(3)]
+        [le.add(t) for t in ts]
+
+        copy = le.copy()
+        t1 = copy.get(1)
+        assert t1 != ts[1]
+        assert t1.left == copy.get(0)
+        assert t1.right == copy.get(2)
+        assert copy.last == copy.get(2)
+        assert copy.first_change == copy.get(0)
+        assert copy.bureau is None
+
+        copy.clear_changes()
+        assert le.first_change == ts[0]
+
+    def test_pickle(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i, (0.6, 0.7)), i % 2))
+         for i in range(5000)]
+        le.recalculate()
+
+        loaded = pickle.loads(pickle.dumps(le))
+        t = loaded.get(2500)
+        assert t.left == loaded.get(2499)
+        assert t.right == loaded.get(2501)
+        assert t.score == le.get(2500).score
+        assert loaded.last == loaded.get(4999)
+        assert loaded.get(0).left is None
+
+    def test_remove_relinks(self):
+        le = SLedger(0)
+        ts = [STransaction(mockuser(i), 0) for i in range(3)]
+        [le.add(t) for t in ts]
+        le.recalculate()
+
+        le.remove(1)
+        assert ts[0].right == ts[2]
+        assert ts[2].left == ts[0]
+        assert 1 not in le.transactions
+        assert le.stale is True
+
+        le.remove(2)
+        assert le.last == ts[0]
+        assert ts[0].right is None
+
+    def test_reorder(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i, (0.6, 0.7)), i % 2))
+         for i in range(4)]
+        le.recalculate()
+        score = le.score
+
+        le.reorder([2, 0, 3, 1])
+        assert [t.id for t in le] == [2, 0, 3, 1]
+        assert [t.order for t in le] == [0, 1, 2, 3]
+        assert le.get(0).left == le.get(2)
+        assert le.trace()[-1] == pytest.approx(score)
+
+    def test_rows(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i, (0.6, 0.7)), i % 2))
+         for i in range(3)]
+
+        # A transaction takes an entry in each column and no objects
+        assert len(le._annotations) == 3
+        assert len(le._orders) == 3
+        assert len(le._user_scores) == 6
+        assert le.get(1) == le.get(1)
+        assert le.get(1) != le.get(2)
+
+    def test_record_after_remove(self):
+        le = SLedger(0)
+        le.record(mockuser(0), 1, 10)
+        le.remove(0)
+        le.record(mockuser(1), 0, 5)
+
+        assert le.get(1).key == 5
+        assert len(le) == 1
+
+    def test_remove_keeps_order(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i), 0)) for i in range(3)]
+        le.remove(1)
+
+        t = STransaction(mockuser(5), 0)
+        le.add(t)
+        assert t.order == 3
+
+    def test_remove_logodds(self):
+        le = SLedger(0)
+        t0 = STransaction(mockuser(0, (.3, .8)), 1)
+        le.add(t0)
+        le.add(STransaction(mockuser(1, (.6, .7)), 0))
+        le.get(0).notify(mockuser(0, (.2, .9)))
+        le.recalculate()
+        le.remove(1)
+
+        assert le._logodds == pytest.approx(llr(1, .2, .9))
+
+    def test_add_by_key(self):
+        le = SLedger(0)
+        for i, key in enumerate([10, 30, 20, 5, 40]):
+            le.add(STransaction(mockuser(i), 0, key))
+
+        chain = []
+        t = le.get(3)
+        while t is not None:
+            chain.append(t)
+            t = t.right
+
+        assert [t.key for t in chain] == [5, 10, 20, 30, 40]
+        assert [t.order for t in chain] == sorted(t.order for t in chain)
+        assert le.last.key == 40
+        assert le.get(3).left is None
+
+    def test_add_without_key_goes_last(self):
+        le = SLedger(0)
+        le.add(STransaction(mockuser(0), 0, 10))
+        le.add(STransaction(mockuser(1), 0))
+        le.add(STransaction(mockuser(2), 0, 5))
+
+        assert le.last == le.get(2)
+        assert le.get(1).right == le.get(2)
+
+    @patch('swap.config.back_update', True)
+    def test_add_by_key_refreshes_suffix(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i), 0, i * 10)) for i in range(5)]
+        le.recalculate()
+        le.refresh()
+
+        le.add(STransaction(mockuser(9), 0, 25))
+        with patch('swap.agents.subject.posterior', wraps=posterior) as mock:
+            le.recalculate()
+            assert mock.call_count == 3
+
+    def test_first_change_order(self):
+        le = SLedger(0)
+        ts = [STransaction(mockuser(i), 0) for i in range(5)]
+        [le.add(t) for t in ts]
+        le.clear_changes()
+
+        for i in [3, 4, 1, 3, 2]:
+            le._change(i)
+
+        assert le.first_change == ts[1]
+        assert len(le.changed) == 4
+
+    def test_first_change_cleared(self):
+        le = SLedger(0)
+        t0 = STransaction(mockuser(0), 0)
+        le.add(t0)
+        le.recalculate()
+
+        assert le.first_change is None
+
+    @patch('swap.agents.subject.posterior', new=MagicMock(return_value=.5))
     @patch('swap.config.back_update', True)
     def test_recalculate_beginning(self):
         le = SLedger(0)
@@ -298,10 +472,9 @@ class TestSubjectLedger:
         le.add(t2)
 
         le.recalculate()
-        assert STransaction.calculate.call_count == 3
+        assert subject_module.posterior.call_count == 3
 
-    @patch.object(STransaction, 'calculate', new=MagicMock(return_value=.5))
-    @patch.object(STransaction, 'get_prior', new=MagicMock(return_value=.5))
+    @patch('swap.agents.subject.posterior', new=MagicMock(return_value=.5))
     @patch('swap.config.back_update', True)
     def test_recalculate_middle(self):
         le = SLedger(0)
@@ -313,9 +486,125 @@ class TestSubjectLedger:
         le.add(t1)
         le.add(t2)
 
-        le.changed = [1]
         le.recalculate()
-        assert STransaction.calculate.call_count == 2
+        subject_module.posterior.reset_mock()
+
+        le.update(1)
+        le.recalculate()
+        assert subject_module.posterior.call_count == 2
+
+    def test_recalculate_delta(self):
+        le = SLedger(0)
+        users = [mockuser(i, (.7, .6)) for i in range(3)]
+        for user in users:
+            le.add(STransaction(user, 1))
+        le.recalculate()
+
+        users[1].score = (.9, .8)
+        le.notify(1, MagicMock(get=MagicMock(return_value=users[1])))
+        score = le.recalculate()
+
+        odds = .12 / .88 * (.6 / .3) ** 2 * (.8 / .1)
+        assert score == pytest.approx(odds / (1 + odds), rel=1e-12)
+
+    def test_recalculate_perfect_user(self):
+        le = SLedger(0)
+        le.add(STransaction(mockuser(0, (1, 1)), 1))
+
+        assert le.recalculate() == pytest.approx(1)
+
+    @patch('swap.config.back_update', True)
+    def test_refresh_history(self):
+        le = SLedger(0)
+        users = [mockuser(i, (.7, .6)) for i in range(3)]
+        ts = [STransaction(user, 1) for user in users]
+        for t in ts:
+            le.add(t)
+
+        le.recalculate()
+        le.refresh()
+        assert ts[-1].score == pytest.approx(le.score, rel=1e-12)
+        assert ts[0].score < ts[1].score < ts[2].score
+
+    @pytest.mark.parametrize('back_update', [False, True])
+    def test_trace(self, back_update):
+        def expect(le):
+            chain = sorted(le, key=lambda t: t.order)
+            return [config.p0] + [t.score for t in chain]
+
+        with patch('swap.config.back_update', back_update):
+            le = SLedger(0)
+            users = [mockuser(i, (.6 + i / 50, .7)) for i in range(8)]
+            for i, key in enumerate([10, 20, 30, 40, 50]):
+                le.add(STransaction(users[i], i % 2, key))
+            le.recalculate()
+            assert list(le.trace()) == expect(le)
+            assert len(le.trace()) == 6
+
+            # Spliced in the middle, and appended
+            le.add(STransaction(users[5], 1, 25))
+            le.add(STransaction(users[6], 0, 60))
+            le.recalculate()
+            assert list(le.trace()) == expect(le)
+
+            # Changed user score
+            users[2].score = (.9, .95)
+            le.notify(2, MagicMock(get=MagicMock(return_value=users[2])))
+            le.recalculate()
+            assert list(le.trace()) == expect(le)
+
+            # Removed last, then in the middle
+            le.remove(6)
+            le.recalculate()
+            assert list(le.trace()) == expect(le)
+            le.remove(1)
+            le.recalculate()
+            assert list(le.trace()) == expect(le)
+            assert len(le.trace()) == len(le) + 1
+
+    @patch('swap.config.back_update', True)
+    def test_trace_copy(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i, (.6, .7)), 1)) for i in range(3)]
+        le.recalculate()
+        trace = le.trace()
+
+        copy = le.copy()
+        le.add(STransaction(mockuser(3, (.6, .7)), 1))
+        le.recalculate()
+
+        assert len(le.trace()) == 5
+        assert len(trace) == 4
+        assert len(copy.trace()) == 4
+
+    @patch('swap.config.back_update', True)
+    def test_trace_buffer(self):
+        le = SLedger(0)
+        [le.add(STransaction(mockuser(i, (.6, .7)), 1)) for i in range(3)]
+        trace = np.asarray(le.trace())
+
+        # A view of the trace doesn't stop the ledger from growing
+        le.record(mockuser(3, (.6, .7)), 1)
+        le.recalculate()
+        assert len(trace) == 4
+        assert len(le.trace()) == 5
+
+    @patch('swap.config.back_update', True)
+    def test_trace_apply_update(self):
+        le = SLedger(0)
+        users = [mockuser(i, (.6, .7)) for i in range(4)]
+        [le.add(STransaction(user, 1)) for user in users]
+        le.recalculate()
+        le.refresh()
+
+        users[1].score = (.8, .9)
+        le.notify(1, MagicMock(get=MagicMock(return_value=users[1])))
+        update = le.copy().compute_update()
+        le.apply_update(update)
+
+        assert list(le.trace()) == \
+            [config.p0] + [le.get(i).score for i in range(4)]
+        assert le.trace()[-1] == pytest.approx(le.score, rel=1e-12)
 
     def test_recalculate_real(self):
         def u(i):
@@ -380,7 +669,7 @@ class TestSubjectTransaction:
         assert t.right is None
 
     def test_get_prior_first(self):
-        t = STransaction(mocksubject(0), 0)
+        t = STransaction(mockuser(0), 0)
 
         assert t.get_prior() == 0.12
 
@@ -463,6 +752,18 @@ class TestUserLedger:
 
         assert mock.call_count == 0
 
+    @patch('swap.config.back_update', False)
+    def test_remove_uncounts(self):
+        le = ULedger(0)
+        le.add(UTransaction(mocksubject(0, 1), 1))
+        le.add(UTransaction(mocksubject(1, 0), 1))
+        le.add(UTransaction(mocksubject(2, 1), 0))
+
+        le.remove(0)
+        assert (le.yes.seen, le.yes.matched) == (1, 0)
+        assert (le.no.seen, le.no.matched) == (1, 0)
+        assert le.score == (le.no.score, le.yes.score)
+
     @patch('swap.config.gamma', 1)
     def test_recalculate_1(self):
         le = ULedger(0)
@@ -0,0 +1,53 @@
+################################################################
+# Test functions for parallel subject recalculation
+
+import swap.agents.parallel as parallel
+from swap.swap import SWAP
+from swap.utils.classification import Classification
+
+import pytest
+from unittest.mock import patch
+
+# pylint: disable=R0201
+
+
+@pytest.fixture
+def run(run_swap, generate, golds):
+    """
+    Function running SWAP with or without parallel recalculation
+    """
+    cls = generate(1500, users=40)
+    labels = golds()
+
+    def run(parallel_):
+        with patch('swap.config.parallel.active', parallel_):
+            return run_swap(cls, labels, process=True)
+
+    return run
+
+
+@patch('swap.config.back_update', True)
+@patch('swap.config.parallel.processes', 2)
+@patch('swap.config.parallel.chunksize', 7)
+class TestParallel:
+
+    def test_matches_serial(self, run):
+        serial = run(False)
+        pooled = run(True)
+
+        assert [s.score for s in pooled.subjects] == \
+            [s.score for s in serial.subjects]
+        assert list(pooled.history_export()) == \
+            list(serial.history_export())
+
+    def test_clears_stale(self, run):
+        swap = run(True)
+        assert swap.subjects.calculate_changes() == 0
+
+    def test_serial_fallback(self):
+        swap = SWAP()
+        swap.classify(Classification(0, 0, 1))
+
+        with patch.object(swap.subjects, 'process_changes') as mock:
+            parallel.process_changes(swap.subjects, chunksize=10)
+            mock.assert_called_once_with(None)
@@ -0,0 +1,185 @@
+################################################################
+# Test functions for user confusion matrix traces
+
+from swap.agents.traces import UserTraces
+from swap.agents.user import Counter
+
+import numpy as np
+import pickle
+import pytest
+from unittest.mock import patch
+
+# pylint: disable=R0201
+
+
+def counter(seen, matched):
+    c = Counter()
+    c.seen = seen
+    c.matched = matched
+    return c
+
+
+class TestUserTraces:
+
+    def test_record(self):
+        traces = UserTraces()
+        traces.record(3, counter(1, 1), counter(0, 0))
+        traces.record(1, counter(0, 0), counter(1, 0))
+        traces.record(3, counter(2, 1), counter(0, 0))
+
+        assert len(traces) == 3
+        assert traces.table().tolist() == [
+            [3, 1, 1, 0, 0], [1, 0, 0, 1, 0], [3, 2, 1, 0, 0]]
+        assert traces.columns()['no_seen'].tolist() == [1, 0, 2]
+        assert traces.user(3).tolist() == [[1, 1, 0, 0], [2, 1, 0, 0]]
+
+    def test_empty(self):
+        traces = UserTraces()
+        assert len(traces) == 0
+        assert traces.table().shape == (0, 5)
+        assert list(traces.user_scores()) == []
+
+    def test_by_user(self):
+        traces = UserTraces()
+        for code, n in [(2, 1), (0, 1), (2, 2), (0, 2), (2, 3)]:
+            traces.record(code, counter(n, 0), counter(0, 0))
+
+        codes, offsets, counts = traces.by_user()
+        assert codes.tolist() == [0, 2]
+        assert offsets.tolist() == [0, 2, 5]
+        assert counts[:, 0].tolist() == [1, 2, 1, 2, 3]
+
+    def test_views(self):
+        traces = UserTraces(capacity=2)
+        traces.record(3, counter(1, 1), counter(0, 0))
+        traces.record(1, counter(0, 0), counter(1, 0))
+        table = traces.table()
+        user = traces.user(3)
+
+        assert traces.user(3).base is user.base
+        assert not user.flags.writeable
+        with pytest.raises(ValueError):
+            table[0, 0] = 2
+
+        traces.record(3, counter(2, 1), counter(0, 0))
+        assert table.tolist() == [[3, 1, 1, 0, 0], [1, 0, 0, 1, 0]]
+        assert user.tolist() == [[1, 1, 0, 0]]
+        assert traces.user(3).tolist() == [[1, 1, 0, 0], [2, 1, 0, 0]]
+        assert traces.user(2).tolist() == []
+
+    def test_scores(self):
+        traces = UserTraces()
+        no = counter(4, 3)
+        yes = counter(6, 1)
+        traces.record(0, no, yes)
+
+        [(code, u0, u1)] = list(traces.user_scores())
+        assert code == 0
+        assert u0.tolist() == [pytest.approx(no.score)]
+        assert u1.tolist() == [pytest.approx(yes.score)]
+
+    def test_copy(self):
+        traces = UserTraces()
+        traces.record(0, counter(1, 1), counter(0, 0))
+        copy = traces.copy()
+        copy.record(0, counter(2, 2), counter(0, 0))
+        traces.record(1, counter(0, 0), counter(3, 3))
+
+        assert traces.table().tolist() == [
+            [0, 1, 1, 0, 0], [1, 0, 0, 3, 3]]
+        assert copy.table().tolist() == [
+            [0, 1, 1, 0, 0], [0, 2, 2, 0, 0]]
+
+    def test_extend(self):
+        traces = UserTraces()
+        traces.record(0, counter(1, 1), counter(0, 0))
+        other = UserTraces()
+        other.record(1, counter(1, 0), counter(0, 0))
+        other.record(0, counter(0, 0), counter(1, 1))
+
+        traces.extend(other, np.array([5, 7]))
+        assert traces.columns()['user'].tolist() == [0, 7, 5]
+
+    def test_pickle(self):
+        traces = UserTraces()
+        traces.record(0, counter(1, 1), counter(0, 0))
+        traces.user(0)
+        loaded = pickle.loads(pickle.dumps(traces))
+        loaded.record(2, counter(0, 0), counter(1, 1))
+
+        assert loaded.table().tolist() == [
+            [0, 1, 1, 0, 0], [2, 0, 0, 1, 1]]
+        assert loaded.user(2).tolist() == [[0, 0, 1, 1]]
+
+    @pytest.mark.parametrize('compress', [False, True])
+    def test_save(self, tmpdir, compress):
+        traces = UserTraces()
+        for i in range(20):
+            traces.record(i % 3, counter(i, i // 2), counter(i // 3, 0))
+
+        fname = str(tmpdir.join('traces'))
+        traces.save(fname, compress)
+        assert UserTraces.load(fname).table().tolist() == \
+            traces.table().tolist()
+
+
+@pytest.fixture
+def data(generate, golds):
+    return generate(400, users=10, subjects=40), golds(40, step=2)
+
+
+class TestSwapUserTraces:
+
+    def test_off(self, run_swap, data):
+        cls, golds = data
+        assert run_swap(cls, golds).users.traces is None
+
+    @pytest.mark.parametrize('back_update', [False, True])
+    @patch('swap.config.user_traces', True)
+    def test_matches_counters(self, run_swap, data, back_update):
+        cls, golds = data
+        with patch('swap.config.back_update', back_update):
+            swap = run_swap(cls, golds)
+            if back_update:
+                swap.process_changes(with_bar=False)
+
+        # Repeated classifications are ignored
+        gold_cls = len({(cl.user, cl.subject)
+                        for cl in cls if cl.subject in golds})
+        traces = swap.users.traces
+        assert 0 < len(traces) <= gold_cls
+
+        # The last record of each user is its current confusion matrix
+        codes, offsets, counts = traces.by_user()
+        for i, code in enumerate(codes.tolist()):
+            user = swap.users.get_code(code)
+            last = counts[offsets[i + 1] - 1].tolist()
+            assert last == [user.ledger.no.seen, user.ledger.no.matched,
+                            user.ledger.yes.seen, user.ledger.yes.matched]
+
+        # One record per classification of a gold subject
+        if not back_update:
+            assert len(traces) == gold_cls
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.user_traces', True)
+    def test_relabel(self, run_swap, data):
+        cls, golds = data
+        swap = run_swap(cls, golds)
+        swap.process_changes(with_bar=False)
+        before = len(swap.users.traces)
+
+        swap.set_gold_labels({0: 1 - golds[0]}, with_bar=False)
+        swap.process_changes(with_bar=False)
+        assert len(swap.users.traces) > before
+
+    @patch('swap.config.user_traces', True)
+    def test_fork(self, run_swap, data):
+        cls, golds = data
+        swap = run_swap(cls[:200], golds)
+        fork = swap.fork()
+        fork.classify_many(cls[200:])
+
+        assert len(fork.users.traces) > len(swap.users.traces)
+        assert fork.users.traces.table()[:len(swap.users.traces)].tolist() \
+            == swap.users.traces.table().tolist()
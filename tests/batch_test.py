@@ -0,0 +1,192 @@
+################################################################
+# Test functions for the array-backed batch SWAP
+
+from swap.batch import BatchSWAP
+from swap.utils.classification import Classification
+
+import pytest
+from unittest.mock import patch
+
+# pylint: disable=R0201
+
+
+@pytest.fixture
+def cls(generate):
+    return generate(800, users=30, subjects=40)
+
+
+@pytest.fixture
+def labels(golds):
+    return golds(40)
+
+
+def histories(export):
+    return {id_: (gold, scores) for id_, gold, scores in export}
+
+
+def assert_same(batch, swap):
+    """
+    Compare score histories, allowing for rounding in log and exp
+    """
+    batch = histories(batch)
+    swap = histories(swap)
+
+    assert batch.keys() == swap.keys()
+    for id_, (gold, scores) in swap.items():
+        assert batch[id_][0] == gold
+        assert batch[id_][1] == pytest.approx(scores, rel=1e-12)
+
+
+@patch('swap.config.back_update', False)
+class TestBatchSWAP:
+
+    def relabel_swap(self, run_swap, cls, labels, relabel):
+        """
+        SWAP relabelling gold subjects halfway through cls
+        """
+        half = len(cls) // 2
+        swap = run_swap(cls[:half], labels)
+        swap.set_gold_labels(relabel, with_bar=False)
+        swap.classify_many(cls[half:])
+        return swap
+
+    def test_matches_swap(self, run_swap, cls, labels):
+        swap = run_swap(cls, labels)
+
+        batch = BatchSWAP()
+        batch.set_gold_labels(labels)
+        batch.classify_all(cls)
+
+        assert_same(batch.history_export(), swap.history_export())
+        assert batch.user_scores == {u.id: u.score for u in swap.users}
+        assert batch.golds == swap.golds
+
+    def test_history_store(self, cls, labels):
+        batch = BatchSWAP()
+        batch.set_gold_labels(labels)
+        batch.classify_all(cls)
+
+        store = batch.history_store()
+        export = histories(batch.history_export())
+        assert sorted(store.ids) == sorted(export)
+        for id_, gold, scores in store:
+            assert gold == export[id_][0]
+            assert scores.tolist() == pytest.approx(export[id_][1], abs=1e-6)
+
+    def test_batches_match_single_batch(self, cls, labels):
+        single = BatchSWAP()
+        single.set_gold_labels(labels)
+        single.classify_all(cls)
+
+        split = BatchSWAP()
+        split.set_gold_labels(labels)
+        for i in range(0, len(cls), 150):
+            split.classify_all(cls[i:i + 150])
+
+        assert histories(split.history_export()) == \
+            histories(single.history_export())
+        assert split.user_scores == single.user_scores
+
+    def test_relabel_matches_swap(self, run_swap, cls, labels, golds):
+        relabel = golds(40, seed=5)
+        swap = self.relabel_swap(run_swap, cls, labels, relabel)
+
+        batch = BatchSWAP()
+        batch.set_gold_labels(labels)
+        half = len(cls) // 2
+        batch.classify_all(cls[:half])
+        batch.set_gold_labels(relabel)
+        batch.classify_all(cls[half:])
+
+        assert_same(batch.history_export(), swap.history_export())
+
+    def test_ignores_repeat_classifications(self):
+        batch = BatchSWAP()
+        batch.classify([0, 0, 1], [0, 0, 0], [1, 0, 1])
+        batch.classify([0], [0], [0])
+
+        trace = batch.history_export().get(0).scores
+        assert len(trace) == 3
+
+    def test_codes(self):
+        batch = BatchSWAP()
+        users, subjects, annotations = batch.encode([
+            Classification('a', 10, 1),
+            Classification('b', 12, 0),
+            Classification('a', 12, 1)])
+
+        assert users.tolist() == [0, 1, 0]
+        assert subjects.tolist() == [0, 1, 1]
+        assert annotations.tolist() == [1, 0, 1]
+        assert batch.users.id(1) == 'b'
+        assert batch.subjects.id(1) == 12
+
+    def test_bad_annotation(self):
+        batch = BatchSWAP()
+        with pytest.raises(ValueError):
+            batch.classify([0], [0], [2])
+
+    def test_column_lengths(self):
+        batch = BatchSWAP()
+        with pytest.raises(ValueError):
+            batch.classify([0, 1], [0], [1])
+
+
+class TestConverge:
+
+    @pytest.fixture
+    def batch(self, cls, labels):
+        batch = BatchSWAP()
+        batch.set_gold_labels(labels)
+        batch.classify_all(cls)
+        return batch
+
+    @patch('swap.config.back_update', True)
+    def test_hard_labels_match_static_swap(self, run_swap, cls, labels,
+                                           batch):
+        swap = run_swap(cls, labels, process=True)
+
+        result = batch.converge(soft=False)
+
+        assert result.converged
+        assert result.iterations == 1
+
+        scores = {s.id: s.score for s in swap.subjects}
+        assert result.subject_scores == pytest.approx(scores, rel=1e-12)
+        users = result.user_scores
+        for user in swap.users:
+            assert users[user.id] == pytest.approx(user.score, rel=1e-12)
+
+    def test_converges(self, batch):
+        result = batch.converge(tol=1e-10)
+
+        assert result.converged
+        assert result.iterations > 1
+        assert result.residuals[-1] <= 1e-10
+        assert len(result.residuals) == result.iterations
+
+        again = batch.converge(tol=1e-10, max_iter=result.iterations + 1)
+        assert again.subject_scores == \
+            pytest.approx(result.subject_scores, abs=1e-9)
+
+    def test_max_iter(self, batch):
+        result = batch.converge(tol=0, max_iter=3)
+
+        assert not result.converged
+        assert result.iterations == 3
+
+    def test_keeps_dynamic_scores(self, batch):
+        before = batch.subject_scores
+        batch.converge()
+
+        assert batch.subject_scores == before
+
+    @patch('swap.config.back_update', True)
+    def test_from_swap(self, run_swap, cls, labels, batch):
+        swap = run_swap(cls, labels)
+
+        converted = BatchSWAP.from_swap(swap)
+        assert converted.golds == swap.golds
+        assert list(converted.users) == list(swap.users.codes)
+        assert converted.converge().subject_scores == \
+            pytest.approx(batch.converge().subject_scores, rel=1e-12)
@@ -0,0 +1,39 @@
+################################################################
+# Test functions for the online SWAP controller
+
+import swap.caesar.control as control
+from swap.db.classifications import Classifications
+
+from unittest.mock import patch
+
+# pylint: disable=R0201
+
+
+class TestOnlineControl:
+
+    @patch.object(control.OnlineControl, 'get_gold_labels', return_value={})
+    def test_run_continues_after_last(self, _):
+        dump = [{'user_id': 0, 'session_id': None, 'subject_id': 0,
+                 'annotation': 1, 'classification_id': 4}]
+        caesar = [{'user_id': 1, 'session_id': None, 'subject_id': 0,
+                   'annotation': 0, 'classification_id': 9}]
+        queries = []
+
+        def get_classifications(after=None):
+            queries.append(after)
+            # The dump is queried first, then caesar
+            cls = dump if len(queries) % 2 == 1 else caesar
+            return iter([cl for cl in cls if after is None or
+                         cl['classification_id'] > after])
+
+        c = control.OnlineControl()
+        with patch.object(Classifications, 'getClassifications',
+                          side_effect=get_classifications):
+            c.run(amount=2)
+            assert c.swap.last_classification == 9
+            assert len(c.swap.graph) == 2
+
+            c.run(amount=0)
+
+        assert queries == [None, None, 9, 9]
+        assert len(c.swap.graph) == 2
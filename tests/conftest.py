@@ -0,0 +1,56 @@
+################################################################
+# Fixtures shared by the SWAP tests
+
+from swap.swap import SWAP
+from swap.utils.classification import Classification
+
+import random
+import pytest
+
+
+@pytest.fixture
+def generate():
+    """
+    Function making random classifications
+    """
+    def generate(n=600, users=20, subjects=60, seed=0):
+        """
+        n classifications by users of subjects. users is a number of
+        users or a list of user ids, subjects a number of subjects.
+        """
+        rand = random.Random(seed)
+        if isinstance(users, int):
+            users = range(users)
+        return [Classification(
+            rand.choice(users), rand.randrange(subjects), rand.randint(0, 1))
+            for _ in range(n)]
+
+    return generate
+
+
+@pytest.fixture
+def golds():
+    """
+    Function making random gold labels for every step-th subject
+    """
+    def golds(subjects=60, step=3, seed=1):
+        rand = random.Random(seed)
+        return {i: rand.randint(0, 1) for i in range(0, subjects, step)}
+
+    return golds
+
+
+@pytest.fixture
+def run_swap():
+    """
+    Function running SWAP over classifications
+    """
+    def run_swap(cls, golds=None, process=False):
+        swap = SWAP()
+        swap.set_gold_labels(golds or {}, with_bar=False)
+        swap.classify_many(cls)
+        if process:
+            swap.process_changes(with_bar=False)
+        return swap
+
+    return run_swap
@@ -7,8 +7,11 @@ from swap.db.golds import Golds
 from swap.db import DB
 from swap.control import Control
 from swap.utils.golds import GoldGetter
+import swap.utils.checkpoint as checkpoint
 
 from unittest.mock import MagicMock, patch
+from datetime import datetime, timedelta
+import random
 import pytest
 
 # pylint: disable=R0201
@@ -41,6 +44,152 @@ class TestControl:
 
         mock.assert_called_with()
 
+    @patch('swap.config.control.batch_size', 3)
+    @patch.object(Control, 'get_gold_labels', return_value={})
+    def test_run_batches(self, _):
+        cls = [{'user_id': i % 3, 'session_id': None, 'subject_id': i % 4,
+                'annotation': i % 2} for i in range(8)]
+
+        c = Control()
+        with patch.object(Control, 'get_classifications',
+                          return_value=iter(cls)), \
+                patch('swap.swap.SWAP.classify_many') as mock:
+            c.run(amount=len(cls))
+
+        sizes = [len(call[0][0]) for call in mock.call_args_list]
+        assert sizes == [3, 3, 2]
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.control.window_size', 3)
+    @patch.object(Control, 'get_gold_labels', return_value={})
+    def test_run_windows(self, _):
+        cls = [{'user_id': i % 3, 'session_id': None, 'subject_id': i % 4,
+                'annotation': i % 2} for i in range(8)]
+
+        c = Control()
+        windows = []
+
+        def end_window(window, count):
+            windows.append((window.count, count, len(c.swap.graph)))
+
+        with patch.object(Control, 'get_classifications',
+                          return_value=iter(cls)), \
+                patch.object(c, '_end_window', side_effect=end_window):
+            c.run(amount=len(cls))
+
+        assert windows == [(3, 3, 3), (3, 6, 6)]
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.control.window_seconds', 60)
+    @patch.object(Control, 'get_gold_labels', return_value={})
+    def test_run_time_windows(self, _):
+        start = datetime(2017, 1, 1)
+        minutes = [0, .5, 1.5, 2, 2.2, 4]
+        cls = [{'user_id': i, 'session_id': None, 'subject_id': 0,
+                'annotation': 1, 'time_stamp': start + timedelta(minutes=m)}
+               for i, m in enumerate(minutes)]
+
+        c = Control()
+        windows = []
+        with patch.object(Control, 'get_classifications',
+                          return_value=iter(cls)), \
+                patch.object(c, '_end_window', side_effect=lambda w, n:
+                             windows.append(n)):
+            c.run(amount=len(cls))
+
+        assert windows == [2, 5]
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.control.window_size', 50)
+    def test_windows_match_single_update(self):
+        rand = random.Random(0)
+        cls = [{'user_id': rand.randrange(10), 'session_id': None,
+                'subject_id': rand.randrange(30),
+                'annotation': rand.randint(0, 1)} for _ in range(300)]
+        golds = {i: rand.randint(0, 1) for i in range(0, 30, 3)}
+
+        def run():
+            c = Control()
+            with patch.object(Control, 'get_classifications',
+                              return_value=iter(cls)), \
+                    patch.object(Control, 'get_gold_labels',
+                                 return_value=golds):
+                c.run(amount=len(cls))
+            return {s.id: s.score for s in c.swap.subjects}
+
+        windowed = run()
+        with patch('swap.config.control.window_size', None):
+            single = run()
+
+        assert windowed == pytest.approx(single, rel=1e-9)
+
+    @patch('swap.config.back_update', True)
+    def test_resume(self, tmpdir):
+        rand = random.Random(1)
+        cls = [{'user_id': rand.randrange(10), 'session_id': None,
+                'subject_id': rand.randrange(30), 'classification_id': i,
+                'annotation': rand.randint(0, 1)} for i in range(300)]
+        golds = {i: rand.randint(0, 1) for i in range(0, 30, 3)}
+        # Gold labels that changed after the checkpoint
+        new_golds = dict(golds)
+        new_golds[0] = 1 - golds[0]
+        del new_golds[3]
+        new_golds[4] = 1
+
+        def run(control, cls, golds, resume=None):
+            queries = []
+
+            def get_classifications(after=None):
+                queries.append(after)
+                return iter([cl for cl in cls if after is None or
+                             cl['classification_id'] > after])
+
+            with patch.object(Control, 'get_classifications',
+                              side_effect=get_classifications), \
+                    patch.object(Control, 'get_gold_labels',
+                                 return_value=golds):
+                if resume is None:
+                    control.run(amount=len(cls))
+                else:
+                    control.resume(resume, amount=len(cls))
+            return queries
+
+        c = Control()
+        assert run(c, cls[:200], golds) == [None]
+        assert c.swap.last_classification == 199
+
+        fname = str(tmpdir.join('swap.ckpt'))
+        checkpoint.save(c.swap, fname)
+
+        resumed = Control()
+        assert run(resumed, cls, new_golds, fname) == [199]
+        assert resumed.swap.last_classification == 299
+
+        full = Control()
+        run(full, cls, new_golds)
+        assert len(resumed.swap.graph) == len(full.swap.graph)
+        assert resumed.swap.golds == full.swap.golds
+
+        scores = {s.id: s.score for s in resumed.swap.subjects}
+        expect = {s.id: s.score for s in full.swap.subjects}
+        assert scores == pytest.approx(expect, rel=1e-9)
+
+    @patch.object(Control, 'get_gold_labels', return_value={})
+    def test_resume_nothing_new(self, _):
+        cls = [{'user_id': 0, 'session_id': None, 'subject_id': 0,
+                'annotation': 1, 'classification_id': 7}]
+
+        c = Control()
+        with patch.object(Control, 'get_classifications',
+                          return_value=iter(cls)):
+            c.run(amount=1)
+        with patch.object(Control, 'get_classifications',
+                          return_value=iter([])) as mock:
+            c.run(amount=1)
+
+        mock.assert_called_with(7)
+        assert c.swap.last_classification == 7
+
 
 # def test_classifications_projection():
 #     q = Query()
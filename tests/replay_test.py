@@ -0,0 +1,114 @@
+################################################################
+# Test functions for replaying classifications by connected component
+
+from swap.replay import replay
+from swap.utils.classification import Classification
+import swap.config as config
+
+import random
+import pytest
+from unittest.mock import patch
+
+# pylint: disable=R0201
+
+
+def generate(groups=12, seed=0):
+    """
+    Classifications of separate groups of users and subjects,
+    interleaved
+    """
+    rand = random.Random(seed)
+    cls = []
+    for group in range(groups):
+        for _ in range(80):
+            cls.append(Classification(
+                group * 10 + rand.randrange(10),
+                group * 20 + rand.randrange(20),
+                rand.randint(0, 1)))
+
+    rand.shuffle(cls)
+    return cls
+
+
+@pytest.fixture
+def gold_labels(golds):
+    labels = golds(240)
+    # Gold subject without classifications
+    labels[1000] = 1
+    return labels
+
+
+@pytest.fixture
+def serial(run_swap, gold_labels):
+    """
+    Function running SWAP over classifications in order
+    """
+    def serial(cls):
+        return run_swap(cls, gold_labels, process=config.back_update)
+
+    return serial
+
+
+def assert_same(swap, serial):
+    assert list(swap.users.codes) == list(serial.users.codes)
+    assert list(swap.subjects.codes) == list(serial.subjects.codes)
+
+    assert [u.score for u in swap.users] == [u.score for u in serial.users]
+    assert [s.score for s in swap.subjects] == \
+        [s.score for s in serial.subjects]
+    assert list(swap.history_export()) == list(serial.history_export())
+    assert swap.golds == serial.golds
+
+    for name in ['users', 'subjects', 'annotations']:
+        assert getattr(swap.graph, name).tolist() == \
+            getattr(serial.graph, name).tolist()
+
+
+class TestReplay:
+
+    @patch('swap.config.back_update', False)
+    def test_matches_serial(self, serial, gold_labels):
+        cls = generate()
+        swap = replay(cls, gold_labels, processes=2)
+        other = serial(cls)
+
+        assert_same(swap, other)
+
+    @patch('swap.config.back_update', True)
+    def test_matches_serial_back_update(self, serial, gold_labels):
+        cls = generate()
+        swap = replay(cls, gold_labels, processes=2)
+
+        assert_same(swap, serial(cls))
+        assert swap.users.calculate_changes() == 0
+        assert swap.subjects.calculate_changes() == 0
+
+    @patch('swap.config.back_update', True)
+    def test_merged_swap_continues(self, serial, gold_labels):
+        cls = generate()
+        swap = replay(cls[:500], gold_labels, processes=2)
+        swap.classify_many(cls[500:])
+        swap.process_changes(with_bar=False)
+
+        # Changed user scores are taken into the subject scores when
+        # the changes are processed, so both process after 500
+        expected = serial(cls[:500])
+        expected.classify_many(cls[500:])
+        expected.process_changes(with_bar=False)
+        assert_same(swap, expected)
+
+    def test_dicts(self):
+        cls = [{'user_id': i % 3, 'subject_id': i % 5,
+                'annotation': 1, 'session_id': None} for i in range(10)]
+        swap = replay(cls, processes=2)
+
+        assert len(swap.users) == 3
+        assert len(swap.subjects) == 5
+
+    def test_serial_fallback(self):
+        cls = generate(groups=1)
+        with patch('multiprocessing.pool.Pool') as mock:
+            swap = replay(cls, processes=4)
+            mock.assert_not_called()
+
+        assert len(swap.graph) > 0
@@ -4,9 +4,14 @@ from swap.agents.bureau import Bureau
 from swap.agents.user import User
 from swap.agents.subject import Subject
 from swap.utils.stats import Stats
+import swap.config as config
 
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+import math
+import os
+import pickle
+import random
 import pytest
 
 # pylint: disable=R0201
@@ -89,6 +94,51 @@ class TestSwap:
 
         assert swap.golds == labels
 
+    def test_set_gold_only_changes(self):
+        swap = SWAP()
+        swap.set_gold_labels({0: 1, 1: 1, 2: 0}, with_bar=False)
+
+        with patch.object(Subject, 'set_gold_label') as mock:
+            swap.set_gold_labels({0: 1, 1: 0, 3: 1}, with_bar=False)
+            changed = sorted(c[0][0] for c in mock.call_args_list)
+            assert mock.call_count == 3
+            assert changed == [-1, 0, 1]
+
+    def test_update_gold_labels(self):
+        swap = SWAP()
+        swap.set_gold_labels({0: 1, 1: 1, 2: 0}, with_bar=False)
+        swap.update_gold_labels({1: -1, 2: 1, 4: 0})
+
+        assert swap.golds == {0: 1, 2: 1, 4: 0}
+        swap.set_gold_labels({0: 1}, with_bar=False)
+        assert swap.golds == {0: 1}
+
+    @patch('swap.config.back_update', True)
+    def test_update_gold_labels_notifies(self, generate, golds, run_swap):
+        cls = generate(400, 10, 40, seed=6)
+        labels = golds(40, 2)
+
+        def run(relabel):
+            swap = run_swap(cls, labels, process=True)
+            relabel(swap)
+            swap.process_changes()
+            return swap
+
+        changes = {0: 1 - labels[0], 2: -1, 1: 1}
+        new = dict(labels)
+        new.pop(2)
+        new[0] = changes[0]
+        new[1] = 1
+
+        fresh = run_swap(cls, new, process=True)
+
+        for swap in [run(lambda swap: swap.update_gold_labels(changes)),
+                     run(lambda swap: swap.set_gold_labels(
+                         new, with_bar=False))]:
+            assert swap.golds == new
+            assert {u.id: u.score for u in swap.users} == \
+                {u.id: u.score for u in fresh.users}
+
     def test_stats_empty(self):
         swap = SWAP()
         swap.stats
@@ -169,6 +219,403 @@ class TestSwap:
         print(bureau.get(1))
         assert bureau.get(2).gold == 0
 
+    def test_graph(self):
+        swap = SWAP()
+        swap.classify(Classification('a', 10, 1))
+        swap.classify(Classification('b', 10, 0))
+        swap.classify(Classification('a', 12, 0))
+        swap.classify(Classification('a', 10, 0))
+
+        graph = swap.graph
+        assert len(graph) == 3
+
+        users = swap.users.codes
+        subjects = swap.subjects.codes
+        assert [subjects.id(c) for c in graph.subjects_of(0)] == [10, 12]
+        assert [users.id(c) for c in graph.users_of(0)] == ['a', 'b']
+
+    def test_classify_many(self, generate, golds):
+        cls = generate(seed=1)
+        labels = golds()
+        relabel = golds(60, 4, seed=2)
+
+        one = SWAP()
+        one.set_gold_labels(labels, with_bar=False)
+        for cl in cls[:300]:
+            one.classify(cl)
+        one.set_gold_labels(relabel, with_bar=False)
+        for cl in cls[300:]:
+            one.classify(cl)
+
+        many = SWAP()
+        many.set_gold_labels(labels, with_bar=False)
+        assert many.classify_many(cls[:300]) == 300
+        many.set_gold_labels(relabel, with_bar=False)
+        many.classify_many({
+            'user_id': cl.user, 'session_id': None,
+            'subject_id': cl.subject, 'annotation': cl.annotation}
+            for cl in cls[300:])
+
+        def traces(swap):
+            return {id_: list(scores)
+                    for id_, _, scores in swap.history_export()}
+
+        assert traces(many) == traces(one)
+        assert {u.id: u.score for u in many.users} == \
+            {u.id: u.score for u in one.users}
+        assert many.graph.users.tolist() == one.graph.users.tolist()
+
+    @patch('swap.config.back_update', True)
+    def test_fork(self, generate, golds, run_swap):
+        cls = generate(seed=2)
+        labels = golds()
+        relabel = dict(labels)
+        relabel[0] = 1 - labels[0]
+
+        def scores(swap):
+            return {s.id: s.score for s in swap.subjects}
+
+        def user_scores(swap):
+            return {u.id: u.score for u in swap.users}
+
+        parent = run_swap(cls, labels, process=True)
+        before = scores(parent), user_scores(parent)
+
+        child = parent.fork()
+        child.set_gold_labels(relabel, with_bar=False)
+        child.process_changes()
+
+        fresh = run_swap(cls, relabel, process=True)
+        assert scores(child) == pytest.approx(scores(fresh))
+        assert user_scores(child) == user_scores(fresh)
+        assert (scores(parent), user_scores(parent)) == before
+        assert parent.golds == labels
+        assert child.golds == relabel
+
+        # Only the relabelled subject's users and their subjects
+        # were copied
+        assert len(child.users._owned) < len(child.users)
+
+        parent.classify(Classification('new', 0, 1))
+        assert 'new' not in child.users
+        assert len(parent.graph) == len(child.graph) + 1
+
+        child.classify(Classification('other', 0, 0))
+        code = parent.subjects.code(0)
+        assert parent.users.codes.id(parent.graph.users_of(code)[-1]) == 'new'
+        assert child.users.codes.id(child.graph.users_of(code)[-1]) == 'other'
+
+    @patch('swap.config.back_update', True)
+    def test_retract(self, generate, golds, run_swap):
+        cls = generate(seed=3)
+        labels = golds()
+
+        def scores(swap):
+            return {s.id: s.score for s in swap.subjects}
+
+        swap = run_swap(cls, labels, process=True)
+        gold = next(cl for cl in cls if cl.subject in labels)
+        assert swap.retract(gold)
+        assert not swap.retract(gold)
+        swap.process_changes()
+
+        # Later repeats of the retracted classification were ignored
+        # in the first run, so skip them in the fresh one too
+        expect = run_swap(
+            [cl for cl in cls
+             if (cl.user, cl.subject) != (gold.user, gold.subject)],
+            labels, process=True)
+        assert scores(swap) == pytest.approx(scores(expect))
+        assert len(swap.graph) == len(expect.graph)
+
+    @patch('swap.config.back_update', True)
+    def test_retract_user(self, generate, golds, run_swap):
+        cls = generate(seed=4)
+        labels = golds()
+
+        swap = run_swap(cls, labels, process=True)
+        n = len(swap.users.peek(7).ledger)
+        assert swap.retract_user(7) == n
+        assert 7 not in swap.users
+        swap.process_changes()
+
+        expect = run_swap(
+            [cl for cl in cls if cl.user != 7], labels, process=True)
+        assert {s.id: s.score for s in swap.subjects} == \
+            pytest.approx({s.id: s.score for s in expect.subjects})
+        assert {u.id: u.score for u in swap.users} == \
+            {u.id: u.score for u in expect.users}
+        assert len(swap.graph) == len(expect.graph)
+
+    def test_retract_dynamic(self):
+        swap = SWAP()
+        swap.classify(Classification(0, 1, 1))
+        swap.classify(Classification(2, 1, 0))
+        swap.classify(Classification(3, 1, 1))
+        swap.retract(Classification(2, 1, 0))
+
+        expect = SWAP()
+        expect.classify(Classification(0, 1, 1))
+        expect.classify(Classification(3, 1, 1))
+
+        assert swap.history_export().get(1).scores == \
+            pytest.approx(expect.history_export().get(1).scores)
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.order_key', 'classification_id')
+    def test_order_key(self, generate, golds, run_swap):
+        cls = [{'user_id': cl.user, 'session_id': None,
+                'subject_id': cl.subject, 'annotation': cl.annotation,
+                'classification_id': i}
+               for i, cl in enumerate(generate(seed=5))]
+        labels = golds()
+
+        def run(cls):
+            swap = run_swap(cls, labels, process=True)
+            return {id_: list(scores)
+                    for id_, _, scores in swap.history_export()}
+
+        shuffled = list(cls)
+        random.Random(5).shuffle(shuffled)
+
+        in_order = run(cls)
+        late = run(shuffled)
+        assert late.keys() == in_order.keys()
+        for id_, scores in in_order.items():
+            assert late[id_] == pytest.approx(scores)
+
+    @pytest.mark.parametrize('back_update', [False, True])
+    @patch('swap.config.order_key', 'classification_id')
+    def test_order_key_repeat(self, back_update):
+        def cl(annotation, key):
+            return {'user_id': 0, 'subject_id': 1, 'session_id': None,
+                    'annotation': annotation, 'classification_id': key}
+
+        with patch('swap.config.back_update', back_update):
+            swap = SWAP()
+            swap.classify_many([cl(1, 20), cl(0, 10), cl(1, 30)])
+            swap.process_changes(with_bar=False)
+
+            expect = SWAP()
+            expect.classify(cl(0, 10))
+            expect.process_changes(with_bar=False)
+
+        t = swap.subjects.get(1).ledger.get(0)
+        assert (t.annotation, t.key) == (0, 10)
+        assert swap.users.get(0).ledger.get(1).annotation == 0
+        assert swap.subjects.get(1).score == expect.subjects.get(1).score
+        assert swap.graph.annotations.tolist() == [0]
+
+    @pytest.mark.parametrize('back_update', [False, True])
+    def test_score_index(self, back_update, generate, golds, run_swap):
+        with patch('swap.config.back_update', back_update):
+            swap = run_swap(
+                generate(2000, 20, 100, seed=4), golds(100, 4), process=True)
+
+        scores = {s.id: s.score for s in swap.subjects}
+        ids = sorted(scores, key=lambda id_: (scores[id_], id_))
+
+        assert swap.subjects.bottom_k(10) == ids[:10]
+        assert swap.subjects.top_k(10) == ids[::-1][:10]
+        assert swap.subjects.range(.2, .8) == \
+            [id_ for id_ in ids if .2 <= scores[id_] <= .8]
+
+        uncertain = swap.subjects.nearest(.5, 5)
+        distances = sorted(abs(p - .5) for p in scores.values())
+        assert [abs(scores[id_] - .5) for id_ in uncertain] == \
+            distances[:5]
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.priority.active', True)
+    @patch('swap.config.priority.margin', 1.)
+    def test_priority(self, generate, golds, run_swap):
+        cls = generate(6000, 40, 300, seed=2)
+        labels = golds(300)
+
+        def run(thresholds):
+            swap = run_swap(cls[:3000], labels, process=True)
+            swap.thresholds = thresholds
+            swap.classify_many(cls[3000:])
+            swap.process_changes()
+            return swap
+
+        full = run(None)
+        assert full.subjects.deferred_ids() == []
+
+        swap = run((.01, .9))
+        deferred = swap.subjects.deferred_ids()
+        assert 0 < len(deferred) < len(swap.subjects)
+        priority = swap._priority()
+        for id_ in deferred:
+            subject = swap.subjects.get(id_)
+            assert subject.ledger.stale
+            assert priority(subject) > 1.
+
+        # Reading a deferred score recalculates it
+        id_ = deferred[0]
+        assert swap.subjects.get(id_).score == full.subjects.get(id_).score
+        assert id_ not in swap.subjects.deferred_ids()
+
+        assert swap.process_deferred(limit=5) == len(deferred) - 6
+        assert swap.process_deferred() == 0
+
+        assert [s.score for s in swap.subjects] == \
+            [s.score for s in full.subjects]
+        assert list(swap.history_export()) == list(full.history_export())
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.priority.active', True)
+    @patch('swap.config.priority.margin', None)
+    @patch('swap.config.priority.budget', 10)
+    def test_priority_budget(self):
+        swap = SWAP()
+        swap.thresholds = (.01, .9)
+        for i in range(50):
+            swap.classify(Classification(i % 7, i, i % 2))
+        swap.process_changes()
+
+        assert len(swap.subjects.deferred_ids()) == 40
+        assert len(list(swap.history_export())) == 50
+        assert swap.subjects.deferred_ids() == []
+
+    @patch('swap.config.back_update', True)
+    def test_history_follows_changes(self, generate, golds, run_swap):
+        cls = generate(900, seed=4)
+        labels = golds()
+
+        def rebuilt(swap):
+            history = {}
+            for subject in swap.subjects:
+                if len(subject.ledger) > 0:
+                    chain = sorted(subject.ledger, key=lambda t: t.order)
+                    history[subject.id] = \
+                        [config.p0] + [t.score for t in chain]
+            return history
+
+        def traces(swap):
+            return {id_: list(scores)
+                    for id_, _, scores in swap.history_export()}
+
+        swap = run_swap(cls[:500], labels, process=True)
+        export = swap.history_export()
+        before = rebuilt(swap)
+        assert traces(swap) == before
+
+        labels[0] = 1 - labels[0]
+        swap.set_gold_labels(labels, with_bar=False)
+        swap.retract_user(3)
+        swap.classify_many(cls[500:])
+        swap.process_changes()
+        assert traces(swap) == rebuilt(swap)
+
+        # Earlier exports keep the scores they were made with
+        assert list(export.get(0).scores) == before[0]
+
+    @patch('swap.config.back_update', True)
+    def test_history_export_snapshot(self, generate, run_swap):
+        cls = generate(400, 10, 20)
+        swap = run_swap(cls[:200], process=True)
+        export = swap.history_export()
+        scores = {id_: list(scores) for id_, _, scores in export}
+
+        # New transactions aren't scored until the changes are processed
+        swap.classify_many(cls[200:])
+        for id_, _, exported in export:
+            assert list(exported) == scores[id_]
+            assert not any(math.isnan(score) for score in exported)
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.instrument', True)
+    def test_instrument(self, generate, golds, run_swap):
+        labels = golds(50, 2)
+        swap = run_swap(generate(300, 10, 50, seed=1), labels, process=True)
+
+        # Relabel one gold subject
+        labels[0] = 1 - labels[0]
+        swap.set_gold_labels(labels, with_bar=False)
+        swap.process_changes()
+
+        assert len(swap.reports) == 2
+        phases = {p.name: p for p in swap.reports[1].phases}
+        assert list(phases) == [
+            'notify users', 'recalculate users',
+            'notify subjects', 'recalculate subjects']
+
+        users = len(swap.subjects.get(0).ledger)
+        notify = phases['notify subjects']
+        assert sum(notify.fanout.values()) == users
+        assert notify.notified == \
+            sum(n * count for n, count in notify.fanout.items())
+
+        # Every notified transaction is committed once
+        recalculate = phases['recalculate subjects']
+        assert notify.notified == sum(
+            n * count for n, count in recalculate.recomputed.items())
+        assert max(recalculate.depth) <= max(
+            len(s.ledger) for s in swap.subjects)
+        assert swap.reports[1].dict()['phases'][3]['name'] == \
+            'recalculate subjects'
+
+    def test_instrument_off(self):
+        swap = SWAP()
+        swap.classify(Classification(0, 0, 1))
+        swap.process_changes()
+        assert swap.reports == []
+
+    @patch('swap.config.back_update', True)
+    def test_notify_tol(self, generate, golds, run_swap):
+        cls = generate(20000, 50, 200, seed=0)
+        labels = golds(200, 2)
+
+        def run(tol):
+            with patch('swap.config.notify_tol', tol):
+                swap = run_swap(cls, labels, process=True)
+
+                relabel = dict(labels)
+                relabel[0] = 1 - labels[0]
+                swap.set_gold_labels(relabel, with_bar=False)
+                swap.process_changes()
+            return swap
+
+        exact = run(0.)
+        assert exact.users.skipped_ids() == []
+        for subject in exact.subjects:
+            for t in subject.ledger:
+                assert t.user_score == exact.users.get(t.id).score
+
+        tol = .05
+        swap = run(tol)
+        assert len(swap.users.skipped_ids()) > 0
+        assert 0 < swap.users.skipped_error() <= tol
+
+        # Subjects use user scores no more than tol out of date
+        for subject in swap.subjects:
+            for t in subject.ledger:
+                user = swap.users.get(t.id)
+                assert t.user_score == pytest.approx(user.score, abs=tol)
+
+    @patch('swap.config.back_update', True)
+    def test_load_old_pickle(self):
+        # SWAP pickled before transactions were slotted, with the
+        # user and subject scores it had
+        path = os.path.join(os.path.dirname(__file__), 'baseline_swap.pkl')
+        with open(path, 'rb') as file:
+            swap, subjects, users = pickle.load(file)
+
+        for id_, score in subjects.items():
+            assert swap.subjects.get(id_).score == pytest.approx(score)
+            assert swap.subjects.get(id_).ledger.trace()[-1] == \
+                pytest.approx(score)
+        for id_, score in users.items():
+            assert swap.users.get(id_).score == score
+        assert len(swap.graph) == \
+            sum(len(user.ledger) for user in swap.users)
+
+        swap.classify(Classification(1, 100, 1))
+        swap.process_changes()
+        assert 100 in swap.subjects
+        assert len(swap.graph.users_of(swap.subjects.code(100))) == 1
+
     # def test_subject_gold_label_1(self):
     #     swap = SWAP(p0=2e-4, epsilon=1.0)
     #     swap.gold_from_cl = True
@@ -0,0 +1,160 @@
+################################################################
+# Test functions for SWAP checkpoint files
+
+from swap.swap import SWAP
+import swap.utils.checkpoint as checkpoint
+
+import json
+import random
+import struct
+import pytest
+from unittest.mock import patch
+
+# pylint: disable=R0201
+
+
+def round_trip(swap, tmpdir, compress=None):
+    fname = str(tmpdir.join('swap.ckpt'))
+    checkpoint.save(swap, fname, compress)
+    return checkpoint.load(fname)
+
+
+def assert_same(swap, other):
+    for name in ['users', 'subjects']:
+        a = getattr(swap, name)
+        b = getattr(other, name)
+        assert list(a.codes) == list(b.codes)
+        assert [agent.id for agent in a] == [agent.id for agent in b]
+        assert a.stale_ids() == b.stale_ids()
+        assert a._changed == b._changed
+        assert a.skipped_ids() == b.skipped_ids()
+        assert a.deferred_ids() == b.deferred_ids()
+
+        for agent in a:
+            ledger = agent.ledger
+            copy = b.peek(agent.id).ledger
+            assert ledger._score == copy._score
+            assert ledger._next_order == copy._next_order
+            assert list(ledger.changed) == list(copy.changed)
+
+    for agent in swap.subjects:
+        assert agent.gold == other.subjects.peek(agent.id).gold
+
+    assert list(swap.history_export()) == list(other.history_export())
+    for name in ['users', 'subjects', 'annotations']:
+        assert getattr(swap.graph, name).tolist() == \
+            getattr(other.graph, name).tolist()
+
+
+class TestCheckpoint:
+
+    @pytest.mark.parametrize('compress', [False, True])
+    @pytest.mark.parametrize('back_update', [False, True])
+    def test_round_trip(self, run_swap, generate, golds, tmpdir, compress,
+                        back_update):
+        with patch('swap.config.back_update', back_update):
+            swap = run_swap(generate(), golds(), process=back_update)
+            swap.thresholds = (.1, .9)
+            loaded = round_trip(swap, tmpdir, compress=compress)
+
+            assert_same(swap, loaded)
+            assert loaded.thresholds == swap.thresholds
+
+            # Both carry on the same
+            more = generate(200, seed=1)
+            for s in [swap, loaded]:
+                s.classify_many(more)
+                if back_update:
+                    s.process_changes(with_bar=False)
+            assert_same(swap, loaded)
+
+    @patch('swap.config.back_update', True)
+    def test_pending_changes(self, run_swap, generate, golds, tmpdir):
+        swap = run_swap(generate(), golds())
+        assert len(swap.users.stale_ids()) > 0
+
+        loaded = round_trip(swap, tmpdir)
+        assert_same(swap, loaded)
+
+        swap.process_changes(with_bar=False)
+        loaded.process_changes(with_bar=False)
+        assert_same(swap, loaded)
+
+    @patch('swap.config.back_update', True)
+    def test_removed_agents(self, run_swap, generate, golds, tmpdir):
+        swap = run_swap(generate(), golds(), process=True)
+        swap.retract_user(3)
+        swap.process_changes(with_bar=False)
+
+        loaded = round_trip(swap, tmpdir)
+        assert 3 not in loaded.users
+        assert loaded.users.code(3) == swap.users.code(3)
+        assert_same(swap, loaded)
+
+    @patch('swap.config.user_traces', True)
+    def test_user_traces(self, run_swap, generate, golds, tmpdir):
+        swap = run_swap(generate(), golds(), process=True)
+        loaded = round_trip(swap, tmpdir)
+
+        assert loaded.users.traces.table().tolist() == \
+            swap.users.traces.table().tolist()
+
+    def test_no_user_traces(self, run_swap, generate, golds, tmpdir):
+        swap = run_swap(generate(), golds(), process=True)
+        with patch('swap.config.user_traces', True):
+            loaded = round_trip(swap, tmpdir)
+        assert loaded.users.traces is None
+
+    def test_mixed_ids(self, run_swap, generate, golds, tmpdir):
+        users = [1, 2, 'a', '2', 'not-logged-in-x']
+        swap = run_swap(generate(users=users), golds(), process=True)
+        loaded = round_trip(swap, tmpdir)
+
+        assert list(loaded.users.codes) == list(swap.users.codes)
+        assert_same(swap, loaded)
+
+    @patch('swap.config.back_update', True)
+    @patch('swap.config.order_key', 'classification_id')
+    def test_order_keys(self, run_swap, golds, tmpdir):
+        rand = random.Random(2)
+        cls = [{'user_id': rand.randrange(10), 'session_id': None,
+                'subject_id': rand.randrange(30),
+                'annotation': rand.randint(0, 1), 'classification_id': i}
+               for i in range(200)]
+        rand.shuffle(cls)
+
+        swap = run_swap(cls[:100], golds(), process=True)
+        loaded = round_trip(swap, tmpdir)
+        assert_same(swap, loaded)
+
+        for s in [swap, loaded]:
+            s.classify_many(cls[100:])
+            s.process_changes(with_bar=False)
+        assert_same(swap, loaded)
+
+    def test_empty(self, tmpdir):
+        swap = SWAP()
+        loaded = round_trip(swap, tmpdir)
+        assert len(loaded.users) == 0
+        assert len(loaded.subjects) == 0
+        assert len(loaded.graph) == 0
+
+    def test_is_checkpoint(self, tmpdir):
+        fname = str(tmpdir.join('swap.ckpt'))
+        checkpoint.save(SWAP(), fname)
+        assert checkpoint.is_checkpoint(fname)
+
+        other = tmpdir.join('other')
+        other.write('not a checkpoint')
+        assert not checkpoint.is_checkpoint(str(other))
+        with pytest.raises(ValueError):
+            checkpoint.load(str(other))
+
+    def test_newer_version(self, tmpdir):
+        header = json.dumps({'version': checkpoint.VERSION + 1}).encode()
+        fname = tmpdir.join('swap.ckpt')
+        fname.write_binary(
+            checkpoint.MAGIC + struct.pack('<Q', len(header)) + header)
+
+        with pytest.raises(ValueError):
+            checkpoint.load(str(fname))
@@ -0,0 +1,44 @@
+################################################################
+# Test functions for id interning
+
+from swap.utils.codes import Codes
+
+import pytest
+
+
+class TestCodes:
+
+    def test_code(self):
+        codes = Codes()
+        assert codes.code('a') == 0
+        assert codes.code(10) == 1
+        assert codes.code('a') == 0
+        assert len(codes) == 2
+
+    def test_id(self):
+        codes = Codes()
+        codes.code('a')
+        codes.code(10)
+
+        assert codes.id(1) == 10
+        assert list(codes) == ['a', 10]
+
+    def test_get_doesnt_register(self):
+        codes = Codes()
+        assert codes.get('a') is None
+        assert 'a' not in codes
+        assert len(codes) == 0
+
+    def test_extend(self):
+        codes = Codes()
+        codes.code('a')
+        codes.extend(3)
+
+        assert list(codes) == ['a', 1, 2]
+
+    def test_extend_conflict(self):
+        codes = Codes()
+        codes.code(1)
+
+        with pytest.raises(ValueError):
+            codes.extend(2)
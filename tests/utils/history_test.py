@@ -0,0 +1,149 @@
+################################################################
+# Test functions for score histories
+
+from swap.swap import SWAP
+from swap.utils.classification import Classification
+from swap.utils.history import History, HistoryExport, HistoryStore
+
+import numpy as np
+import random
+import pytest
+from unittest.mock import MagicMock, patch
+
+# pylint: disable=R0201
+
+
+def traces(seed=0, n=50):
+    rand = random.Random(seed)
+    return [[.12] + [rand.random() for _ in range(rand.randrange(12))]
+            for _ in range(n)]
+
+
+def store(delta=False, seed=0):
+    traces_ = traces(seed)
+    ids = list(range(100, 100 + len(traces_)))
+    golds = [i % 3 - 1 for i in range(len(traces_))]
+    return HistoryStore.from_traces(ids, golds, traces_, delta), traces_
+
+
+def export(traces_):
+    history = {}
+    for i, trace in enumerate(traces_):
+        history[100 + i] = History(100 + i, i % 3 - 1, trace)
+    return HistoryExport(history, gold_getter=MagicMock())
+
+
+def approx(values):
+    return pytest.approx(values, abs=1e-6)
+
+
+class TestHistoryStore:
+
+    @pytest.mark.parametrize('delta', [False, True])
+    def test_trace(self, delta):
+        s, traces_ = store(delta)
+        assert len(s) == len(traces_)
+        assert s.lengths.tolist() == [len(t) for t in traces_]
+        assert s.scores.dtype == np.float32
+
+        for i, trace in enumerate(traces_):
+            assert s.trace(100 + i).tolist() == approx(trace)
+
+    @pytest.mark.parametrize('delta', [False, True])
+    def test_score(self, delta):
+        s, traces_ = store(delta)
+        for i, trace in enumerate(traces_):
+            for k in range(len(trace)):
+                assert s.score(100 + i, k) == approx(trace[k])
+            # Past the end of the trace
+            assert s.score(100 + i, 50) == approx(trace[-1])
+
+        with pytest.raises(ValueError):
+            s.score(100, -1)
+
+    @pytest.mark.parametrize('delta', [False, True])
+    def test_step(self, delta):
+        s, traces_ = store(delta)
+        for k in [0, 1, 5, 20]:
+            expect = [t[min(k, len(t) - 1)] for t in traces_]
+            assert s.step(k).tolist() == approx(expect)
+
+    def test_trace_is_a_view(self):
+        s, _ = store()
+        assert s.trace(100).base is not None
+
+    @pytest.mark.parametrize('delta', [False, True])
+    def test_decoded(self, delta):
+        s, traces_ = store(delta)
+        assert s.decoded().tolist() == approx(sum(traces_, []))
+
+    @pytest.mark.parametrize('thresholds', [None, (.1, .9), (.3, .6)])
+    @pytest.mark.parametrize('delta', [False, True])
+    def test_retire(self, thresholds, delta):
+        s, traces_ = store(delta)
+        ncl, p = s.retire(thresholds)
+
+        for i, trace in enumerate(traces_):
+            n, p_ = History(i, 0, trace).retire(thresholds)
+            assert ncl[i] == n
+            assert p[i] == approx(p_)
+
+    @patch('swap.utils.scores.GoldGetter', MagicMock())
+    def test_score_export(self):
+        s, traces_ = store(seed=1)
+        thresholds = (.1, .9)
+
+        scores = s.score_export(thresholds).scores
+        expect = export(traces_).score_export(thresholds).scores
+        assert scores.keys() == expect.keys()
+        for id_, score in expect.items():
+            assert scores[id_].p == approx(score.p)
+            assert scores[id_].ncl == score.ncl
+            assert scores[id_].gold == score.gold
+
+    def test_from_export(self):
+        traces_ = traces()
+        s = export(traces_).store()
+        assert s.trace(105).tolist() == approx(traces_[5])
+
+    def test_iter(self):
+        s, traces_ = store()
+        items = list(s)
+        assert [id_ for id_, _, _ in items] == s.ids
+        assert items[4][1] == s.golds[4]
+        assert items[4][2].tolist() == approx(traces_[4])
+        assert [g for g, _ in s.traces()] == s.golds.tolist()
+
+    @pytest.mark.parametrize('mmap', [False, True])
+    @pytest.mark.parametrize('compress', [False, True])
+    @pytest.mark.parametrize('delta', [False, True])
+    def test_save(self, tmpdir, mmap, compress, delta):
+        s, traces_ = store(delta)
+        fname = str(tmpdir.join('history'))
+        s.save(fname, compress)
+
+        loaded = HistoryStore.load(fname, mmap)
+        assert loaded.ids == s.ids
+        assert loaded.delta == delta
+        assert loaded.golds.tolist() == s.golds.tolist()
+        assert loaded.scores.tolist() == s.scores.tolist()
+        assert loaded.score(103, 2) == s.score(103, 2)
+        assert isinstance(loaded.scores, np.memmap) == \
+            (mmap and not compress)
+
+    def test_swap(self):
+        rand = random.Random(3)
+        swap = SWAP()
+        swap.set_gold_labels({i: i % 2 for i in range(0, 40, 4)},
+                             with_bar=False)
+        swap.classify_many(Classification(
+            rand.randrange(10), rand.randrange(40), rand.randint(0, 1))
+            for _ in range(300))
+
+        s = swap.history_store()
+        history = {id_: (gold, scores)
+                   for id_, gold, scores in swap.history_export()}
+        assert sorted(s.ids) == sorted(history)
+        for id_, gold, scores in s:
+            assert gold == history[id_][0]
+            assert scores.tolist() == approx(history[id_][1])
@@ -0,0 +1,78 @@
+"""
+Time back_update on popular subjects.
+
+A changed user score on the first transaction of each subject is taken
+into the subject score through its log-odds, see
+swap.agents.subject.Ledger. This is timed against walking the score
+history from that transaction on, which is what recalculate did before.
+
+    python tools/benchmark_back_update.py [classifications] [subjects]
+"""
+
+from swap.swap import SWAP
+from swap.utils.classification import Classification
+import swap.config as config
+
+import random
+import sys
+import time
+
+
+def build(n, subjects, users=2000, seed=0):
+    rand = random.Random(seed)
+    swap = SWAP()
+    swap.set_gold_labels(
+        {i: rand.randint(0, 1) for i in range(0, subjects, 5)},
+        with_bar=False)
+
+    start = time.perf_counter()
+    swap.classify_many(Classification(
+        rand.randrange(users), rand.randrange(subjects), rand.randint(0, 1))
+        for _ in range(n))
+    classify = time.perf_counter() - start
+
+    start = time.perf_counter()
+    swap.process_changes(with_bar=False)
+    process = time.perf_counter() - start
+
+    return swap, classify, process
+
+
+def delta(ledgers, repeat):
+    scores = [(.6, .7), (.7, .6)]
+    start = time.perf_counter()
+    for i in range(repeat):
+        for ledger in ledgers:
+            ledger._change(ledger._ids[0], scores[i % 2])
+            ledger.recalculate()
+    return time.perf_counter() - start
+
+
+def walk(ledgers, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for ledger in ledgers:
+            ledger._walk(0)
+    return time.perf_counter() - start
+
+
+def main(n=100000, subjects=100, repeat=20):
+    config.back_update = True
+    swap, classify, process = build(n, subjects)
+    ledgers = [subject.ledger for subject in swap.subjects]
+    length = sum(len(ledger) for ledger in ledgers) / len(ledgers)
+
+    print('%d classifications of %d subjects, %.0f per subject' %
+          (n, subjects, length))
+    print('classify %.2fs  process_changes %.2fs' % (classify, process))
+
+    changes = repeat * len(ledgers)
+    t_delta = delta(ledgers, repeat)
+    t_walk = walk(ledgers, repeat)
+    print('changed first user score, per change:')
+    print('  log-odds delta %8.2f us' % (1e6 * t_delta / changes))
+    print('  walk           %8.2f us' % (1e6 * t_walk / changes))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])